@@ -1,14 +1,33 @@
-from flask import Flask, render_template, request, send_file, redirect, url_for, flash, jsonify
+from flask import Flask, Request, Response, g, render_template, request, send_file, redirect, url_for, flash, jsonify, stream_with_context
+from werkzeug.exceptions import ClientDisconnected
 from werkzeug.utils import secure_filename
-from io import BytesIO
+from werkzeug.wsgi import FileWrapper
+from io import BufferedReader, BytesIO, RawIOBase
+import asyncio
+import atexit
+import contextvars
 import os
+import sys
+import errno
 import shutil
-from datetime import datetime
+import tempfile
+from datetime import datetime, timezone
 import mimetypes
+import json
+import base64
 import re
 import hashlib
-from PIL import Image
-from PIL.ExifTags import TAGS
+import secrets
+import sqlite3
+import subprocess
+import threading
+import time
+import zipfile
+from urllib.parse import quote
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import BrokenExecutor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from PIL import Image, features
 from PIL.Image import Exif
 
 # OpenCV опционально (для миниатюр видео)
@@ -21,6 +40,26 @@ except ImportError:
     OPENCV_AVAILABLE = False
     print("⚠️  OpenCV не установлен. Миниатюры видео будут недоступны.")
 
+# ffmpeg опционально (облегчённые копии видео для просмотра на телефоне)
+FFMPEG_PATH = shutil.which('ffmpeg')
+FFMPEG_AVAILABLE = FFMPEG_PATH is not None
+if FFMPEG_AVAILABLE:
+    print("✅ ffmpeg найден - тяжёлые видео будут перекодироваться для просмотра")
+
+# watchdog опционально (изменения в storage в обход приложения видны сразу, через inotify)
+try:
+    from watchdog.observers import Observer
+    WATCHDOG_AVAILABLE = True
+except ImportError:
+    WATCHDOG_AVAILABLE = False
+
+# uvicorn опционально (асинхронный режим: python app.py --async)
+try:
+    import uvicorn
+    UVICORN_AVAILABLE = True
+except ImportError:
+    UVICORN_AVAILABLE = False
+
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-change-this'
 app.config['MAX_CONTENT_LENGTH'] = 500 * 1024 * 1024  # 500 MB для больших файлов
@@ -28,10 +67,70 @@ app.config['MAX_CONTENT_LENGTH'] = 500 * 1024 * 1024  # 500 MB для больш
 # Конфигурация
 UPLOAD_FOLDER = 'storage'
 THUMBNAIL_CACHE_FOLDER = '.thumbcache'
+INDEX_DB_PATH = '.cloudindex.db'
+METRICS_FOLDER = '.metrics'  # Счётчики каждого процесса для /metrics (рядом с app.py)
+METRICS_FLUSH_INTERVAL = 5  # Секунд между сохранениями счётчиков процесса на диск
+PROFILE_FOLDER = '.profiles'  # Профили медленных запросов (рядом с app.py), см. /profiles
+PROFILE_SLOW_THRESHOLD = None  # Секунд: у запроса дольше сохраняется профиль (None - не следить)
+PROFILE_INTERVAL = 0.005  # Секунд между снимками стека профилируемого запроса
+PROFILE_KEEP = 100  # Сколько последних профилей хранить, старые удаляются
+PROFILE_ALL_DURATION = 600  # Секунд профилирования всех запросов после включения через POST /profiles
+INGEST_FOLDER = '.incoming'  # Внутри storage: принятый файл переносится на место переименованием
+INGEST_HEAD_BYTES = 128 * 1024  # Сколько первых байт загрузки держать в памяти для чтения EXIF
+UPLOAD_CHUNK_MAX = 64 * 1024 * 1024  # Наибольшая часть в одном PATCH при загрузке частями
+UPLOAD_EXPIRE = 24 * 3600  # Брошенная загрузка частями удаляется через сутки без новых частей
+DEDUP_MODE = 'link'  # Повторная загрузка того же файла: 'link' - жёсткая ссылка, 'skip' - не сохранять, 'off' - копия
+FOLDER_INDEX_TTL = 300  # Секунд между глубокими сверками индекса папок с диском
+WATCHER_DEBOUNCE = 2  # Секунд тишины после изменений в storage в обход приложения до обновления индекса
+WATCHER_MAX_DELAY = 10  # Но не дольше стольких секунд с первого изменения пачки
+WATCHER_RECONCILE_INTERVAL = 900  # Секунд между сверками всего хранилища с диском
+SEARCH_DEFAULT_LIMIT = 200  # Сколько результатов поиска отдавать за один запрос
+SEARCH_MAX_LIMIT = 1000
+LIST_PAGE_SIZE = 60  # Элементов на странице /api/list (и в первой отрисовке browse)
+
+THUMBNAIL_WORKERS = max(1, (os.cpu_count() or 2) // 2)  # Воркеров для генерации миниатюр
+THUMBNAIL_QUEUE_LIMIT = 64  # Максимум задач в очереди, дальше - 503 с Retry-After
+THUMBNAIL_TIMEOUT = 60  # Секунд ожидания одной миниатюры
+# Классы размеров миниатюр (параметр ?s=): список, плитка, полноэкранный просмотр → качество
+THUMBNAIL_SIZES = {64: 60, 200: 60, 1280: 80}
+THUMBNAIL_DEFAULT_SIZE = 200
+WEBP_AVAILABLE = features.check('webp')
+VIDEO_POSTER_POSITIONS = (0.1, 0.25, 0.5, 0.75, 0.0)  # Где искать кадр для постера (доли длительности)
+VIDEO_BLACK_THRESHOLD = 24  # Средняя яркость кадра (0-255), ниже которой он считается чёрным
+VIDEO_STRIP_FRAMES = 8  # Кадров в полосе для перемотки наведением
+VIDEO_STRIP_SIZE = 160
+THUMBNAIL_CACHE_MAX_BYTES = 500 * 1024 * 1024  # Бюджет кеша миниатюр, сверх него удаляются давно не открытые
+THUMBNAIL_SWEEP_INTERVAL = 3600  # Секунд между фоновыми чистками кеша от миниатюр удалённых файлов
+TRANSCODE_HEIGHT = 720  # Высота облегчённой копии видео (H.264)
+TRANSCODE_VIDEO_BITRATE = '1500k'  # Предел битрейта копии - смотрится по Wi-Fi без пауз
+TRANSCODE_MAX_SOURCE_BITRATE = 8_000_000  # Видео с битрейтом выше (бит/с) смотрится через копию
+TRANSCODE_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024  # Свой бюджет для копий видео в .thumbcache
+TRANSCODE_TIMEOUT = 3 * 3600  # Секунд на перекодирование одного видео
+TRANSCODE_RETRY_AFTER = 3600  # Секунд после неудачи, через которые видео можно перекодировать снова
+# Кеширование миниатюр и просмотра в браузере: URL с отпечатком (?v=) не меняется
+# вместе с файлом, без отпечатка - каждый раз сверка по ETag
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE_CONTROL = 'no-cache'
+# Отдача файлов фронт-сервером: 'accel' - X-Accel-Redirect (nginx), 'sendfile' - X-Sendfile
+# (lighttpd, Apache с mod_xsendfile), None - файлы отдаёт сам Python (без фронт-сервера)
+SENDFILE_MODE = None
+ACCEL_STORAGE_PREFIX = '/_storage/'  # internal-локации nginx для storage и кеша миниатюр (см. nginx.conf.example)
+ACCEL_THUMBS_PREFIX = '/_thumbs/'
+
+# Специальные папки показываются первыми в этом порядке, остальные - по алфавиту
+FOLDER_ORDER = {'Фото': 0, 'Видео': 1, 'Документы': 2}
 ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'doc', 'docx', 
                       'xls', 'xlsx', 'zip', 'rar', 'mp3', 'mp4', 'avi', 'mkv', 
                       'py', 'js', 'html', 'css', 'json', 'xml'}
 
+# Категории (фото, видео, документы) по расширению - по ним строятся разделы /category/
+CATEGORY_EXTENSIONS = {
+    'image': ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp'),
+    'video': ('.mp4', '.avi', '.mkv', '.mov', '.wmv', '.flv'),
+    'document': ('.doc', '.docx', '.pdf', '.txt', '.xls', '.xlsx', '.ppt', '.pptx')
+}
+CATEGORY_NAMES = {'image': 'Фото', 'video': 'Видео', 'document': 'Документы'}
+
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
 # Создаем папки
@@ -59,64 +158,44 @@ def safe_filename(filename):
         filename = 'file'
     return filename
 
-def rename_by_date_if_long(filepath, max_length=30):
-    """Переименовать файл по дате съемки если имя слишком длинное
-    
-    Args:
-        filepath: путь к файлу
-        max_length: максимальная длина имени (без расширения)
-    
-    Returns:
-        новый путь к файлу (или старый, если не переименован)
-    """
-    try:
-        filename = os.path.basename(filepath)
-        name_without_ext, ext = os.path.splitext(filename)
-        
-        # Проверяем длину имени (без расширения)
-        if len(name_without_ext) <= max_length:
-            return filepath
-        
-        print(f"📏 Длинное имя ({len(name_without_ext)} символов): {filename}")
-        
-        # Получаем дату из EXIF
-        date_obj = get_image_date(filepath)
-        
-        # Форматируем имя: DDMMYYYY
-        new_name = date_obj.strftime('%d%m%Y')
-        
-        # Добавляем расширение
-        new_filename = f"{new_name}{ext}"
-        
-        # Путь к новому файлу
-        directory = os.path.dirname(filepath)
-        new_filepath = os.path.join(directory, new_filename)
-        
-        # Если файл с таким именем уже существует, добавляем счетчик
-        counter = 1
-        while os.path.exists(new_filepath):
-            new_filename = f"{new_name}_{counter}{ext}"
-            new_filepath = os.path.join(directory, new_filename)
-            counter += 1
-        
-        # Переименовываем файл
-        os.rename(filepath, new_filepath)
-        print(f"✅ Переименовано: {filename} → {new_filename}")
-        
-        return new_filepath
+def shorten_name_by_date(filename, date_obj, max_length=30):
+    """Имя по дате съемки (DDMMYYYY.ext), если имя без расширения длиннее max_length"""
+    name_without_ext, ext = os.path.splitext(filename)
+    if len(name_without_ext) <= max_length:
+        return filename
     
-    except Exception as e:
-        print(f"❌ Ошибка переименования {filepath}: {e}")
-        return filepath
+    new_filename = f"{date_obj.strftime('%d%m%Y')}{ext}"
+    print(f"📏 Длинное имя ({len(name_without_ext)} символов): {filename} → {new_filename}")
+    return new_filename
+
+def unique_path(directory, filename):
+    """Свободный путь в папке: name.ext, а если занято - name_1.ext, name_2.ext..."""
+    path = os.path.join(directory, filename)
+    name, ext = os.path.splitext(filename)
+    counter = 1
+    while os.path.exists(path):
+        path = os.path.join(directory, f"{name}_{counter}{ext}")
+        counter += 1
+    return path
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 def get_folder_size(folder_path):
     """Получить размер папки (сумма всех файлов внутри)"""
+    try:
+        stats = folder_stats(rel_path(folder_path))
+        if stats is not None:
+            return stats['size']
+    except sqlite3.Error as e:
+        print(f"⚠️  Индекс папок недоступен: {e}")
+    
+    # Запасной вариант - полный обход (если индекс недоступен)
     total_size = 0
     try:
         for dirpath, dirnames, filenames in os.walk(folder_path):
+            dirnames[:] = [name for name in dirnames if name != INGEST_FOLDER]
+            metric_inc('cloud_fs_entries_visited_total', len(dirnames) + len(filenames), walker='size')
             for filename in filenames:
                 filepath = os.path.join(dirpath, filename)
                 try:
@@ -138,21 +217,40 @@ def get_file_info(filepath):
     else:
         size = stat.st_size
     
+    return make_file_info(os.path.basename(filepath), size, stat.st_mtime, is_dir)
+
+def make_file_info(name, size, mtime, is_dir, media=None):
+    """Словарь с информацией о файле для шаблонов и JSON API
+    
+    media - строка таблицы media (дата съемки, размеры и т.д.), если уже известна.
+    """
     # Определить тип файла
-    name = os.path.basename(filepath)
     is_image = not is_dir and name.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp'))
     is_video = not is_dir and name.lower().endswith(('.mp4', '.avi', '.mov', '.mkv', '.webm'))
     
-    return {
+    info = {
         'name': name,
         'size': size,
         'size_formatted': format_size(size),
-        'modified': datetime.fromtimestamp(stat.st_mtime).strftime('%Y-%m-%d %H:%M:%S'),
-        'modified_timestamp': stat.st_mtime,
+        'modified': datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M:%S'),
+        'modified_timestamp': mtime,
         'is_dir': is_dir,
         'is_image': is_image,
         'is_video': is_video
     }
+    if media:
+        if media['taken']:
+            info['taken'] = datetime.fromtimestamp(media['taken']).strftime('%Y-%m-%d %H:%M:%S')
+            info['taken_timestamp'] = media['taken']
+        if media['width'] and media['height']:
+            # Ориентации 5-8 поворачивают кадр на 90°
+            rotated = media['orientation'] in (5, 6, 7, 8)
+            info['width'], info['height'] = ((media['height'], media['width']) if rotated
+                                             else (media['width'], media['height']))
+        for key in ('camera', 'duration', 'codec'):
+            if media[key]:
+                info[key] = media[key]
+    return info
 
 def format_size(size):
     """Форматировать размер файла"""
@@ -162,6 +260,1107 @@ def format_size(size):
         size /= 1024.0
     return f"{size:.1f} ПБ"
 
+# ==================== Метрики ====================
+# Счётчики и гистограммы в памяти процесса, /metrics отдаёт их в текстовом
+# формате Prometheus. Запись метрики - сложение под блокировкой, без обращений к
+# диску, так что метрики можно не выключать. Под gunicorn у каждого воркера свои
+# счётчики: раз в METRICS_FLUSH_INTERVAL (после запроса) процесс сохраняет их в
+# .metrics/<pid>.json, а /metrics складывает файлы всех процессов. Счётчики
+# завершившихся процессов сохраняются (иначе суммы пошли бы назад), их текущие
+# значения (запросы в работе) отбрасываются.
+
+METRIC_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Имя → (тип, описание); метрики без описания не выводятся
+METRICS = {
+    'cloud_http_request_duration_seconds': ('histogram', 'Время обработки запроса до начала ответа'),
+    'cloud_http_responses_total': ('counter', 'Ответы по обработчику и коду'),
+    'cloud_http_response_bytes_total': ('counter', 'Отданные байты тела ответа'),
+    'cloud_http_requests_in_flight': ('gauge', 'Запросы в работе'),
+    'cloud_thumbnail_requests_total': ('counter', 'Запросы миниатюр: hit - из кеша, miss - пришлось рисовать'),
+    'cloud_thumbnail_generate_seconds': ('histogram', 'Время получения новой миниатюры (очередь и отрисовка)'),
+    'cloud_thumbnail_evictions_total': ('counter', 'Файлы кеша миниатюр, удалённые по бюджету'),
+    'cloud_exif_parse_seconds': ('histogram', 'Время чтения EXIF (upload - из начала загрузки, file - с диска)'),
+    'cloud_fs_entries_visited_total': ('counter', 'Записи каталогов, прочитанные с диска при обходе'),
+}
+
+_metrics_lock = threading.Lock()
+_metric_values = {}  # (имя, метки) → число или [счётчики корзин..., сумма, количество]
+_metrics_flushed_at = 0.0
+
+def _metric_key(name, labels):
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def metric_inc(name, value=1, **labels):
+    """Прибавить к счётчику (или к текущему значению, value может быть < 0)"""
+    key = _metric_key(name, labels)
+    with _metrics_lock:
+        _metric_values[key] = _metric_values.get(key, 0) + value
+
+def metric_observe(name, seconds, **labels):
+    """Записать значение в гистограмму"""
+    key = _metric_key(name, labels)
+    with _metrics_lock:
+        values = _metric_values.get(key)
+        if values is None:
+            values = _metric_values[key] = [0] * (len(METRIC_LATENCY_BUCKETS) + 2)
+        for i, bound in enumerate(METRIC_LATENCY_BUCKETS):
+            if seconds <= bound:
+                values[i] += 1
+                break
+        values[-2] += seconds
+        values[-1] += 1
+
+@contextmanager
+def metric_timer(name, **labels):
+    """Измерить время блока в гистограмму name"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metric_observe(name, time.perf_counter() - started, **labels)
+
+def _metrics_snapshot():
+    with _metrics_lock:
+        return [[name, dict(labels), value] for (name, labels), value in _metric_values.items()]
+
+def metrics_flush():
+    """Сохранить счётчики процесса для /metrics других воркеров (атомарной заменой файла)"""
+    global _metrics_flushed_at
+    _metrics_flushed_at = time.time()
+    path = os.path.join(METRICS_FOLDER, f'{os.getpid()}.json')
+    try:
+        os.makedirs(METRICS_FOLDER, exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(_metrics_snapshot(), f)
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        print(f"⚠️  Не удалось сохранить метрики: {e}")
+
+atexit.register(metrics_flush)
+
+def _process_alive(pid):
+    if os.name == 'nt':
+        return True  # os.kill в Windows завершает процесс, а не проверяет его
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass  # Процесс есть, но чужой
+    return True
+
+def _metrics_archive(dead):
+    """Перенести счётчики завершившихся процессов в .metrics/archive.json
+    
+    Иначе после каждого перезапуска воркеров файлов становилось бы больше.
+    Переносит один процесс за раз (блокировка O_EXCL), остальные пропускают.
+    """
+    lock_path = os.path.join(METRICS_FOLDER, 'archive.lock')
+    try:
+        os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        try:
+            if time.time() - os.path.getmtime(lock_path) > 60:
+                os.remove(lock_path)  # Блокировка упавшего процесса
+        except OSError:
+            pass
+        return
+    archive_path = os.path.join(METRICS_FOLDER, 'archive.json')
+    try:
+        archive = {}
+        for path in [archive_path] + dead:
+            try:
+                with open(path) as f:
+                    entries = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for name, labels, value in entries:
+                if METRICS.get(name, ('gauge',))[0] == 'gauge':
+                    continue
+                key = _metric_key(name, labels)
+                if isinstance(value, list):
+                    current = archive.setdefault(key, [0] * len(value))
+                    archive[key] = [a + b for a, b in zip(current, value)]
+                else:
+                    archive[key] = archive.get(key, 0) + value
+        with open(archive_path + '.tmp', 'w') as f:
+            json.dump([[name, dict(labels), value] for (name, labels), value in archive.items()], f)
+        os.replace(archive_path + '.tmp', archive_path)
+        for path in dead:
+            os.remove(path)
+    except OSError as e:
+        print(f"⚠️  Не удалось перенести метрики завершившихся процессов: {e}")
+    finally:
+        try:
+            os.remove(lock_path)
+        except OSError:
+            pass
+
+def metrics_collect():
+    """Сложить счётчики всех процессов: {(имя, метки): значение}"""
+    total = {}
+    dead = []
+    
+    def add(name, labels, value):
+        key = _metric_key(name, labels)
+        if isinstance(value, list):
+            current = total.setdefault(key, [0] * len(value))
+            for i, item in enumerate(value):
+                current[i] += item
+        else:
+            total[key] = total.get(key, 0) + value
+    
+    try:
+        names = os.listdir(METRICS_FOLDER)
+    except FileNotFoundError:
+        names = []
+    for filename in names:
+        pid = filename[:-len('.json')]
+        if not filename.endswith('.json') or pid == str(os.getpid()):
+            continue
+        alive = pid.isdigit() and _process_alive(int(pid))
+        if pid.isdigit() and not alive:
+            dead.append(os.path.join(METRICS_FOLDER, filename))
+        try:
+            with open(os.path.join(METRICS_FOLDER, filename)) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for name, labels, value in entries:
+            if alive or METRICS.get(name, ('',))[0] != 'gauge':
+                add(name, labels, value)
+    # Свои счётчики - из памяти, самые свежие
+    for name, labels, value in _metrics_snapshot():
+        add(name, labels, value)
+    if dead:
+        _metrics_archive(dead)
+    return total
+
+def _metric_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in items)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(items, escaped)) + '}'
+
+def metrics_text(values):
+    """Текстовый формат Prometheus (exposition format 0.0.4)"""
+    lines = []
+    for name, (kind, help_text) in METRICS.items():
+        series = sorted((labels, value) for (metric, labels), value in values.items() if metric == name)
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in series:
+            if kind == 'histogram':
+                cumulative = 0
+                for bound, count in zip(METRIC_LATENCY_BUCKETS, value):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_metric_labels(labels, [("le", bound)])} {cumulative}')
+                lines.append(f'{name}_bucket{_metric_labels(labels, [("le", "+Inf")])} {value[-1]}')
+                lines.append(f'{name}_sum{_metric_labels(labels)} {value[-2]}')
+                lines.append(f'{name}_count{_metric_labels(labels)} {value[-1]}')
+            else:
+                lines.append(f'{name}{_metric_labels(labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+@app.before_request
+def metrics_request_started():
+    g.metrics_started = time.perf_counter()
+    metric_inc('cloud_http_requests_in_flight')
+
+@app.after_request
+def metrics_request_finished(response):
+    endpoint = request.endpoint or 'unknown'
+    metric_inc('cloud_http_responses_total', endpoint=endpoint, code=response.status_code)
+    # Длина потоковых ответов (ZIP) заранее не известна - их байты не считаются
+    if response.content_length:
+        metric_inc('cloud_http_response_bytes_total', response.content_length, endpoint=endpoint)
+    return response
+
+@app.teardown_request
+def metrics_request_teardown(exc):
+    started = g.pop('metrics_started', None)
+    if started is None:
+        return
+    metric_inc('cloud_http_requests_in_flight', -1)
+    metric_observe('cloud_http_request_duration_seconds', time.perf_counter() - started,
+                   endpoint=request.endpoint or 'unknown')
+    if time.time() - _metrics_flushed_at > METRICS_FLUSH_INTERVAL:
+        metrics_flush()
+        profile_toggle_refresh()
+
+@app.route('/metrics')
+def metrics():
+    """Метрики всех процессов в формате Prometheus"""
+    return Response(metrics_text(metrics_collect()), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+# ==================== Профилирование ====================
+# Семплирующий профилировщик: отдельный поток раз в PROFILE_INTERVAL снимает стек
+# потока, выполняющего запрос (sys._current_frames), и считает одинаковые стеки.
+# Профилируются запрос с заголовком X-Profile: 1, все запросы, пока профилирование
+# включено через POST /profiles (во всех воркерах, на PROFILE_ALL_DURATION), и
+# запросы дольше PROFILE_SLOW_THRESHOLD - у них стеки снимаются с момента
+# превышения порога. Остальные запросы только записываются в словарь
+# выполняющихся, а поток снимков спит, пока нечего снимать; при
+# PROFILE_SLOW_THRESHOLD = None (по умолчанию) и выключенном профилировании
+# обработчики запроса сразу возвращаются.
+#
+# Включение в другом воркере процесс узнаёт из файла .profiles/enabled, который
+# перечитывается вместе с сохранением метрик (раз в METRICS_FLUSH_INTERVAL после
+# запроса), - отдельного опроса диска нет.
+#
+# Профиль сохраняется в .profiles/ в свёрнутом формате (строка "f1;f2;f3 N",
+# корень стека слева) - его понимают flamegraph.pl и https://www.speedscope.app.
+
+PROFILE_NAME = re.compile(r'^[\w.-]+$')
+
+_profile_cond = threading.Condition()
+_profile_active = {}  # id потока → профиль выполняющегося запроса
+_profile_thread_pid = None
+_profile_all_until = 0.0  # До какого времени профилировать все запросы (0 - выключено)
+
+def profile_all_enabled():
+    """Профилировать ли все запросы (без обращения к диску)"""
+    return time.time() < _profile_all_until
+
+def profile_toggle_refresh():
+    """Перечитать общий для воркеров флаг: файл со временем окончания профилирования"""
+    global _profile_all_until
+    try:
+        with open(os.path.join(PROFILE_FOLDER, 'enabled')) as f:
+            _profile_all_until = float(f.read())
+    except (OSError, ValueError):
+        _profile_all_until = 0.0
+
+def _profile_frame_name(code):
+    # ';' разделяет кадры в свёрнутом формате
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'.replace(';', ':')
+
+def _profile_stack(frame):
+    names = []
+    while frame is not None:
+        names.append(_profile_frame_name(frame.f_code))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+def _profile_due(run, now):
+    return run['reason'] != 'slow' or (PROFILE_SLOW_THRESHOLD is not None and
+                                       now - run['started'] >= PROFILE_SLOW_THRESHOLD)
+
+def _profile_loop():
+    while True:
+        with _profile_cond:
+            now = time.perf_counter()
+            due = [(ident, run) for ident, run in _profile_active.items() if _profile_due(run, now)]
+            if not due:
+                # Спим до момента, когда самый старый запрос превысит порог. Без запросов -
+                # полпорога: будить поток на каждый запрос дороже, а превышение порога
+                # так замечается не позже чем через полтора порога
+                deadlines = [run['started'] + PROFILE_SLOW_THRESHOLD for run in _profile_active.values()
+                             if PROFILE_SLOW_THRESHOLD is not None]
+                _profile_cond.wait(max(0.0, min(deadlines) - now) if deadlines else
+                                   PROFILE_SLOW_THRESHOLD / 2 if PROFILE_SLOW_THRESHOLD else None)
+                continue
+        frames = sys._current_frames()
+        stacks = [(ident, run, _profile_stack(frames[ident])) for ident, run in due if ident in frames]
+        del frames
+        with _profile_cond:
+            for ident, run, stack in stacks:
+                if _profile_active.get(ident) is run:
+                    run['stacks'][stack] = run['stacks'].get(stack, 0) + 1
+                    run['samples'] += 1
+        time.sleep(PROFILE_INTERVAL)
+
+def _start_profiler():
+    """Поток снимков стека (один на процесс, запускается при первом профилируемом запросе)"""
+    global _profile_thread_pid
+    if _profile_thread_pid == os.getpid():
+        return
+    _profile_thread_pid = os.getpid()
+    threading.Thread(target=_profile_loop, name='profiler', daemon=True).start()
+
+def profile_save(run, duration):
+    """Сохранить профиль запроса в .profiles/ и удалить самые старые сверх PROFILE_KEEP"""
+    created = time.time()
+    name = '{}-{:03d}-{}-{}-{}ms'.format(time.strftime('%Y%m%d-%H%M%S', time.localtime(created)),
+                                          int(created * 1000) % 1000, os.getpid(),
+                                          run['endpoint'], int(duration * 1000))
+    meta = {'name': name, 'created': created, 'pid': os.getpid(), 'method': run['method'],
+            'path': run['path'], 'endpoint': run['endpoint'], 'reason': run['reason'],
+            'duration': round(duration, 4), 'samples': run['samples'], 'interval': PROFILE_INTERVAL}
+    try:
+        os.makedirs(PROFILE_FOLDER, exist_ok=True)
+        path = os.path.join(PROFILE_FOLDER, name)
+        with open(path + '.folded', 'w', encoding='utf-8') as f:
+            for stack, count in sorted(run['stacks'].items()):
+                f.write(f'{stack} {count}\n')
+        with open(path + '.json', 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        print(f"🔬 Профиль {run['method']} {run['path']} ({duration:.2f} с): {PROFILE_FOLDER}/{name}.folded")
+        
+        names = sorted(n[:-len('.json')] for n in os.listdir(PROFILE_FOLDER) if n.endswith('.json'))
+        for old in names[:-PROFILE_KEEP]:
+            for ext in ('.json', '.folded'):
+                try:
+                    os.remove(os.path.join(PROFILE_FOLDER, old + ext))
+                except OSError:
+                    pass
+    except OSError as e:
+        print(f"⚠️  Не удалось сохранить профиль: {e}")
+
+@app.before_request
+def profile_request_started():
+    if PROFILE_SLOW_THRESHOLD is None and not _profile_all_until and 'X-Profile' not in request.headers:
+        return
+    if request.headers.get('X-Profile') == '1':
+        reason = 'header'
+    elif profile_all_enabled():
+        reason = 'all'
+    elif PROFILE_SLOW_THRESHOLD is not None:
+        reason = 'slow'
+    else:
+        return
+    run = {'started': time.perf_counter(), 'reason': reason, 'method': request.method,
+           'path': request.full_path.rstrip('?'), 'endpoint': request.endpoint or 'unknown',
+           'stacks': {}, 'samples': 0}
+    g.profile_ident = threading.get_ident()
+    _start_profiler()
+    with _profile_cond:
+        _profile_active[g.profile_ident] = run
+        if reason != 'slow':
+            _profile_cond.notify()
+
+@app.teardown_request
+def profile_request_teardown(exc):
+    if not _profile_active:
+        return
+    ident = g.pop('profile_ident', None)
+    if ident is None:
+        return
+    with _profile_cond:
+        run = _profile_active.pop(ident, None)
+    if run is None:
+        return
+    # Запрошенный профиль сохраняется всегда: запрос быстрее PROFILE_INTERVAL
+    # останется без снимков, но его длительность тоже ответ
+    if run['reason'] != 'slow' or run['samples']:
+        profile_save(run, time.perf_counter() - run['started'])
+
+@app.route('/profiles', methods=['GET', 'POST'])
+def profiles():
+    """Список сохранённых профилей; POST {"enabled": true|false} - профилировать все запросы"""
+    global _profile_all_until
+    if request.method == 'POST':
+        enabled = bool((request.get_json(silent=True) or {}).get('enabled', True))
+        path = os.path.join(PROFILE_FOLDER, 'enabled')
+        os.makedirs(PROFILE_FOLDER, exist_ok=True)
+        if enabled:
+            _profile_all_until = time.time() + PROFILE_ALL_DURATION
+            with open(path, 'w') as f:
+                f.write(str(_profile_all_until))
+        else:
+            _profile_all_until = 0.0
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    else:
+        profile_toggle_refresh()  # Могли включить или выключить в другом воркере
+    
+    items = []
+    try:
+        names = sorted((n for n in os.listdir(PROFILE_FOLDER) if n.endswith('.json')), reverse=True)
+    except FileNotFoundError:
+        names = []
+    for filename in names:
+        try:
+            with open(os.path.join(PROFILE_FOLDER, filename), encoding='utf-8') as f:
+                items.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return jsonify({'all_enabled': profile_all_enabled(), 'all_until': _profile_all_until or None,
+                    'slow_threshold': PROFILE_SLOW_THRESHOLD, 'profiles': items})
+
+@app.route('/profiles/<name>')
+def profile_file(name):
+    """Профиль в свёрнутом формате (для flamegraph.pl или speedscope)"""
+    path = os.path.join(PROFILE_FOLDER, name + '.folded')
+    if not PROFILE_NAME.match(name) or not os.path.isfile(path):
+        return jsonify({'error': 'Профиль не найден'}), 404
+    return send_file(os.path.abspath(path), mimetype='text/plain; charset=utf-8',
+                     as_attachment='download' in request.args, download_name=name + '.folded')
+
+# ==================== Индекс папок ====================
+# Для каждой папки в базе хранятся агрегаты по всему поддереву (размер, число
+# файлов и папок, самое новое mtime) и "собственные" значения только по файлам,
+# лежащим непосредственно в ней. Загрузка, удаление, переименование и создание
+# папок обновляют индекс дельтами вверх по предкам, а изменения, сделанные в
+# обход приложения, находятся лениво по mtime самой папки.
+#
+# Там же лежит индекс имён (таблица entries + полнотекстовый триграммный индекс
+# FTS5) для поиска. Он заполняется тем же сканированием папок, и у каждого файла
+# в нём записана категория - из него же строятся разделы фото, видео и документов.
+#
+# Кроме того, в базе ведётся учёт файлов кеша миниатюр (таблицы thumbs и
+# fingerprints), хеши содержимого для поиска дубликатов (таблица content_hashes),
+# метаданные фото и видео (таблица media) и отметки периодических задач, общие для всех процессов (таблица index_meta).
+
+INDEX_SCHEMA_VERSION = 7  # Увеличить при изменении схемы - база пересоздастся
+SEARCH_FTS_AVAILABLE = False
+
+_index_local = threading.local()
+
+def get_index_db():
+    """Соединение с базой индексов (отдельное для каждого потока и процесса)"""
+    conn = getattr(_index_local, 'conn', None)
+    if conn is None or _index_local.pid != os.getpid():
+        conn = sqlite3.connect(INDEX_DB_PATH, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        _index_local.conn = conn
+        _index_local.pid = os.getpid()
+    return conn
+
+@contextmanager
+def index_transaction():
+    """Транзакция с блокировкой на запись (вложенные вызовы используют внешнюю)"""
+    conn = get_index_db()
+    if conn.in_transaction:
+        yield conn
+        return
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+        conn.execute('COMMIT')
+    except:
+        conn.execute('ROLLBACK')
+        raise
+
+def init_index_db():
+    """Создать таблицы индексов, если их ещё нет"""
+    global SEARCH_FTS_AVAILABLE
+    conn = get_index_db()
+    
+    if conn.execute('PRAGMA user_version').fetchone()[0] != INDEX_SCHEMA_VERSION:
+        # Схема устарела - индексы строятся заново с диска
+        tables = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' "
+                              "AND name NOT LIKE 'sqlite_%' AND name NOT LIKE 'entries_fts_%'").fetchall()
+        for row in tables:
+            conn.execute(f'DROP TABLE IF EXISTS "{row[0]}"')
+        conn.execute(f'PRAGMA user_version = {INDEX_SCHEMA_VERSION}')
+    
+    conn.execute('''CREATE TABLE IF NOT EXISTS folders (
+        path TEXT PRIMARY KEY,
+        parent TEXT,
+        dir_mtime REAL,
+        own_size INTEGER NOT NULL DEFAULT 0,
+        own_files INTEGER NOT NULL DEFAULT 0,
+        own_newest REAL NOT NULL DEFAULT 0,
+        size INTEGER NOT NULL DEFAULT 0,
+        files INTEGER NOT NULL DEFAULT 0,
+        folders INTEGER NOT NULL DEFAULT 0,
+        newest REAL NOT NULL DEFAULT 0,
+        checked_at REAL NOT NULL DEFAULT 0
+    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS folders_parent ON folders(parent)')
+    
+    conn.execute('''CREATE TABLE IF NOT EXISTS entries (
+        path TEXT PRIMARY KEY,
+        parent TEXT NOT NULL,
+        name TEXT NOT NULL,
+        name_lower TEXT NOT NULL,
+        is_dir INTEGER NOT NULL,
+        size INTEGER NOT NULL DEFAULT 0,
+        mtime REAL NOT NULL DEFAULT 0,
+        category TEXT
+    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS entries_parent ON entries(parent)')
+    conn.execute('CREATE INDEX IF NOT EXISTS entries_size ON entries(size)')
+    conn.execute('CREATE INDEX IF NOT EXISTS entries_category_name ON entries(category, name_lower)')
+    conn.execute('CREATE INDEX IF NOT EXISTS entries_category_size ON entries(category, size)')
+    
+    conn.execute('''CREATE TABLE IF NOT EXISTS fingerprints (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime REAL NOT NULL,
+        fp TEXT NOT NULL
+    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS fingerprints_fp ON fingerprints(fp)')
+    
+    conn.execute('''CREATE TABLE IF NOT EXISTS thumbs (
+        file TEXT PRIMARY KEY,
+        fp TEXT NOT NULL,
+        bytes INTEGER NOT NULL DEFAULT 0,
+        atime REAL NOT NULL DEFAULT 0
+    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS thumbs_atime ON thumbs(atime)')
+    conn.execute('CREATE INDEX IF NOT EXISTS thumbs_fp ON thumbs(fp)')
+    
+    conn.execute('''CREATE TABLE IF NOT EXISTS content_hashes (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime REAL NOT NULL,
+        hash TEXT NOT NULL
+    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS content_hashes_hash ON content_hashes(hash)')
+    
+    conn.execute('''CREATE TABLE IF NOT EXISTS media (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime REAL NOT NULL,
+        taken REAL,
+        width INTEGER,
+        height INTEGER,
+        orientation INTEGER,
+        camera TEXT,
+        duration REAL,
+        codec TEXT
+    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS media_taken ON media(taken)')
+    
+    conn.execute('''CREATE TABLE IF NOT EXISTS index_meta (
+        key TEXT PRIMARY KEY,
+        value
+    )''')
+    
+    # Триграммный FTS5 (SQLite 3.34+) ищет подстроку по индексу, без него - перебор таблицы
+    try:
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5("
+                     "name_lower, content='entries', content_rowid='rowid', tokenize='trigram')")
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS entries_fts_insert AFTER INSERT ON entries BEGIN
+            INSERT INTO entries_fts(rowid, name_lower) VALUES (new.rowid, new.name_lower);
+        END''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS entries_fts_delete AFTER DELETE ON entries BEGIN
+            INSERT INTO entries_fts(entries_fts, rowid, name_lower) VALUES ('delete', old.rowid, old.name_lower);
+        END''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS entries_fts_update AFTER UPDATE OF name_lower ON entries BEGIN
+            INSERT INTO entries_fts(entries_fts, rowid, name_lower) VALUES ('delete', old.rowid, old.name_lower);
+            INSERT INTO entries_fts(rowid, name_lower) VALUES (new.rowid, new.name_lower);
+        END''')
+        SEARCH_FTS_AVAILABLE = True
+    except sqlite3.OperationalError as e:
+        print(f"⚠️  FTS5 trigram недоступен ({e}) - поиск будет перебирать индекс имён")
+
+def rel_path(full_path):
+    """Путь относительно хранилища в виде 'a/b' ('' для корня, None если вне хранилища)"""
+    rel = os.path.relpath(os.path.normpath(full_path), app.config['UPLOAD_FOLDER']).replace('\\', '/')
+    if rel == '.':
+        return ''
+    if rel == '..' or rel.startswith('../'):
+        return None
+    return rel
+
+def storage_path(rel):
+    """Полный путь на диске по относительному пути в хранилище"""
+    return os.path.join(app.config['UPLOAD_FOLDER'], rel) if rel else app.config['UPLOAD_FOLDER']
+
+def _parent_rel(rel):
+    """Родитель относительного пути ('' для верхнего уровня, None для корня)"""
+    if not rel:
+        return None
+    return rel.rpartition('/')[0]
+
+def _subtree_range(rel):
+    """Границы диапазона путей строго внутри папки (для запросов по индексу)"""
+    # '0' следует сразу за '/' в ASCII, поэтому [rel/, rel0) - ровно потомки rel
+    if not rel:
+        return '', '\U0010ffff'
+    return rel + '/', rel + '0'
+
+def _index_lineage(rel):
+    """Папка и все её предки до корня: 'a/b' → ['a/b', 'a', '']"""
+    lineage = [rel]
+    while rel:
+        rel = rel.rpartition('/')[0]
+        lineage.append(rel)
+    return lineage
+
+def _index_get(rel):
+    return get_index_db().execute('SELECT * FROM folders WHERE path = ?', (rel,)).fetchone()
+
+def _index_scan(rel):
+    """Пересчитать папку: свои файлы через scandir, подпапки из индекса
+    
+    Недостающие подпапки пересчитываются рекурсивно, исчезнувшие удаляются
+    из индекса. Изменения вверх по предкам не распространяются.
+    """
+    conn = get_index_db()
+    full_path = storage_path(rel)
+    dir_mtime = os.stat(full_path).st_mtime
+    
+    own_size = 0
+    own_files = 0
+    own_newest = 0.0
+    subdirs = []
+    listing = []
+    with os.scandir(full_path) as entries:
+        for entry in entries:
+            if not rel and entry.name == INGEST_FOLDER:
+                continue  # Недокачанные загрузки
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                    listing.append((entry.name, True, 0, entry.stat(follow_symlinks=False).st_mtime))
+                elif entry.is_file():
+                    st = entry.stat()
+                    own_size += st.st_size
+                    own_files += 1
+                    own_newest = max(own_newest, st.st_mtime)
+                    listing.append((entry.name, False, st.st_size, st.st_mtime))
+            except OSError:
+                continue
+    metric_inc('cloud_fs_entries_visited_total', len(listing), walker='index')
+    
+    # Подпапки, которых больше нет на диске, убираем вместе с потомками
+    known = {row['path'] for row in conn.execute('SELECT path FROM folders WHERE parent = ?', (rel,))}
+    for child in known - {f'{rel}/{name}' if rel else name for name in subdirs}:
+        low, high = _subtree_range(child)
+        conn.execute('DELETE FROM folders WHERE path = ? OR (path >= ? AND path < ?)', (child, low, high))
+        conn.execute('DELETE FROM entries WHERE path >= ? AND path < ?', (low, high))
+    _entries_sync(rel, listing)
+    
+    size, files, folders, newest = own_size, own_files, len(subdirs), own_newest
+    for name in subdirs:
+        child = f'{rel}/{name}' if rel else name
+        child_row = _index_get(child)
+        if child_row is None:
+            try:
+                child_row = _index_scan(child)
+            except OSError:
+                continue
+        size += child_row['size']
+        files += child_row['files']
+        folders += child_row['folders']
+        newest = max(newest, child_row['newest'])
+    
+    conn.execute('INSERT OR REPLACE INTO folders VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                 (rel, _parent_rel(rel), dir_mtime, own_size, own_files, own_newest,
+                  size, files, folders, newest, time.time()))
+    return _index_get(rel)
+
+def _entries_sync(rel, listing):
+    """Привести записи индекса имён для содержимого папки к списку с диска"""
+    conn = get_index_db()
+    names = {name for name, _, _, _ in listing}
+    for row in conn.execute('SELECT path, name FROM entries WHERE parent = ?', (rel,)).fetchall():
+        if row['name'] not in names:
+            conn.execute('DELETE FROM entries WHERE path = ?', (row['path'],))
+    for name, is_dir, size, mtime in listing:
+        _entries_upsert(f'{rel}/{name}' if rel else name, is_dir, size, mtime)
+
+def _entries_upsert(rel, is_dir, size, mtime):
+    """Добавить или обновить запись в индексе имён"""
+    name = rel.rpartition('/')[2]
+    # UPSERT, а не REPLACE: REPLACE не вызывает триггер удаления и FTS разъедется
+    get_index_db().execute(
+        'INSERT INTO entries (path, parent, name, name_lower, is_dir, size, mtime, category) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+        'ON CONFLICT(path) DO UPDATE SET is_dir = excluded.is_dir, size = excluded.size, mtime = excluded.mtime, '
+        'category = excluded.category '
+        'WHERE is_dir != excluded.is_dir OR size != excluded.size OR mtime != excluded.mtime',
+        (rel, _parent_rel(rel), name, name.lower(), int(is_dir), size, mtime,
+         None if is_dir else file_category(name)))
+
+def file_category(name):
+    """Категория файла по расширению ('image', 'video', 'document') или None"""
+    name = name.lower()
+    for category, extensions in CATEGORY_EXTENSIONS.items():
+        if name.endswith(extensions):
+            return category
+    return None
+
+def _index_apply_delta(lineage, size, files, folders, newest=0.0):
+    """Прибавить дельту к агрегатам перечисленных папок"""
+    placeholders = ','.join('?' * len(lineage))
+    get_index_db().execute(
+        f'UPDATE folders SET size = size + ?, files = files + ?, folders = folders + ?, '
+        f'newest = MAX(newest, ?) WHERE path IN ({placeholders})',
+        (size, files, folders, newest, *lineage))
+
+def _index_rescan(rel):
+    """Пересчитать папку с диска и разнести разницу по предкам"""
+    with index_transaction():
+        old = _index_get(rel)
+        new = _index_scan(rel)
+        parent = _parent_rel(rel)
+        if parent is None:
+            return new
+        if old is None:
+            # Предки ещё не знали об этой папке - учитываем её саму тоже
+            delta = (new['size'], new['files'], new['folders'] + 1)
+        else:
+            delta = (new['size'] - old['size'], new['files'] - old['files'], new['folders'] - old['folders'])
+        if any(delta) or old is None:
+            _index_apply_delta(_index_lineage(parent), *delta, new['newest'])
+        return new
+
+def _index_is_current(row, rel):
+    """Совпадает ли запись индекса с текущим mtime папки на диске"""
+    try:
+        return row is not None and row['dir_mtime'] == os.stat(storage_path(rel)).st_mtime
+    except OSError:
+        return False
+
+def _index_refresh(rel):
+    """Вернуть актуальную запись папки, пересчитав её при изменении на диске"""
+    row = _index_get(rel)
+    if _index_is_current(row, rel):
+        return row
+    if not os.path.isdir(storage_path(rel)):
+        return None
+    with index_transaction():
+        # Повторная проверка под блокировкой: другой поток мог уже пересчитать
+        row = _index_get(rel)
+        if _index_is_current(row, rel):
+            return row
+        return _index_rescan(rel)
+
+def _index_revalidate(rel):
+    """Глубокая сверка поддерева: пересчитываются только папки с изменившимся mtime"""
+    conn = get_index_db()
+    low, high = _subtree_range(rel)
+    paths = [row['path'] for row in conn.execute(
+        'SELECT path FROM folders WHERE path = ? OR (path >= ? AND path < ?)', (rel, low, high))]
+    # Сначала самые глубокие, чтобы родители суммировали уже свежих потомков
+    paths.sort(key=lambda p: p.count('/') + (1 if p else 0), reverse=True)
+    for path in paths:
+        _index_refresh(path)
+    with index_transaction():
+        conn.execute('UPDATE folders SET checked_at = ? WHERE path = ? OR (path >= ? AND path < ?)',
+                     (time.time(), rel, low, high))
+
+def folder_stats(rel):
+    """Агрегаты папки из индекса: size, files, folders, newest (None если папки нет)"""
+    if rel is None:
+        return None
+    row = _index_refresh(rel)
+    if row is not None and time.time() - row['checked_at'] > FOLDER_INDEX_TTL:
+        _index_revalidate(rel)
+        row = _index_get(rel)
+    return row
+
+def subtree_stats(rel):
+    """Как folder_stats, но сверяя с диском mtime всех папок поддерева
+    
+    Раздел категории собирает файлы всего поддерева: без сверки файл,
+    скопированный во вложенную папку в обход приложения, появился бы в нём
+    только через FOLDER_INDEX_TTL. Файлы не читаются - только stat папок.
+    """
+    if rel is None or _index_refresh(rel) is None:
+        return None
+    _index_revalidate(rel)
+    return _index_get(rel)
+
+def index_path_added(full_path):
+    """Учесть в индексе новый файл или папку (вызывать после записи на диск)"""
+    rel = rel_path(full_path)
+    if not rel:
+        return
+    try:
+        with index_transaction():
+            if _index_get('') is None:
+                return  # Индекс ещё не построен - будет построен при первом чтении
+            st = os.stat(full_path)
+            is_dir = os.path.isdir(full_path)
+            parent = _parent_rel(rel)
+            # Файл, записанный поверх прежнего, меняет только размер, а не число файлов
+            previous = get_index_db().execute('SELECT is_dir, size FROM entries WHERE path = ?', (rel,)).fetchone()
+            replaced = previous is not None and not previous['is_dir'] and not is_dir
+            _entries_upsert(rel, is_dir, 0 if is_dir else st.st_size, st.st_mtime)
+            lineage = _index_lineage(rel if is_dir else parent)
+            missing = [path for path in lineage if _index_get(path) is None]
+            if missing:
+                # Самый верхний отсутствующий предок сканируется целиком
+                top = missing[-1]
+                _index_rescan(top)
+                _entries_upsert(top, True, 0, os.stat(storage_path(top)).st_mtime)
+            elif not is_dir:
+                parent_row = _index_get(parent)
+                if _index_is_current(parent_row, parent):
+                    return  # Папка уже пересчитана после появления файла
+                size = st.st_size - previous['size'] if replaced else st.st_size
+                added = 0 if replaced else 1
+                _index_apply_delta(lineage, size, added, 0, st.st_mtime)
+                get_index_db().execute(
+                    'UPDATE folders SET own_size = own_size + ?, own_files = own_files + ?, '
+                    'own_newest = MAX(own_newest, ?) WHERE path = ?',
+                    (size, added, st.st_mtime, parent))
+    except (sqlite3.Error, OSError) as e:
+        print(f"⚠️  Ошибка обновления индекса для {full_path}: {e}")
+
+def index_path_removed(full_path, is_dir, size=0):
+    """Учесть в индексе удалённый файл (с его размером) или папку"""
+    rel = rel_path(full_path)
+    if not rel:
+        return
+    parent = _parent_rel(rel)
+    try:
+        index_forget_content(rel, is_dir)
+        with index_transaction():
+            conn = get_index_db()
+            low, high = _subtree_range(rel)
+            conn.execute('DELETE FROM entries WHERE path = ? OR (path >= ? AND path < ?)', (rel, low, high))
+            parent_row = _index_get(parent)
+            if parent_row is None or _index_is_current(parent_row, parent):
+                return
+            if is_dir:
+                row = _index_get(rel)
+                if row is None:
+                    return
+                conn.execute('DELETE FROM folders WHERE path = ? OR (path >= ? AND path < ?)', (rel, low, high))
+                _index_apply_delta(_index_lineage(parent), -row['size'], -row['files'], -row['folders'] - 1)
+            else:
+                _index_apply_delta(_index_lineage(parent), -size, -1, 0)
+                conn.execute('UPDATE folders SET own_size = own_size - ?, own_files = own_files - 1 WHERE path = ?',
+                             (size, parent))
+    except sqlite3.Error as e:
+        print(f"⚠️  Ошибка обновления индекса для {full_path}: {e}")
+
+def index_forget_content(rel, is_dir):
+    """Забыть хеши, метаданные и миниатюры удалённого файла (или всех файлов папки)"""
+    thumb_cache_forget(rel, is_dir)
+    with index_transaction() as conn:
+        low, high = _subtree_range(rel)
+        conn.execute('DELETE FROM content_hashes WHERE path = ? OR (path >= ? AND path < ?)', (rel, low, high))
+        conn.execute('DELETE FROM media WHERE path = ? OR (path >= ? AND path < ?)', (rel, low, high))
+
+def index_path_renamed(old_full_path, new_full_path):
+    """Перенести записи индекса при переименовании файла или папки (размеры не меняются)"""
+    old_rel = rel_path(old_full_path)
+    new_rel = rel_path(new_full_path)
+    if not old_rel or not new_rel:
+        return
+    new_name = new_rel.rpartition('/')[2]
+    try:
+        with index_transaction():
+            conn = get_index_db()
+            low, high = _subtree_range(old_rel)
+            cut = len(old_rel) + 1
+            conn.execute('UPDATE entries SET path = ?, parent = ?, name = ?, name_lower = ?, '
+                         'category = CASE WHEN is_dir THEN NULL ELSE ? END WHERE path = ?',
+                         (new_rel, _parent_rel(new_rel), new_name, new_name.lower(), file_category(new_name), old_rel))
+            # Отпечатки переезжают вместе с файлами - миниатюры остаются в кеше
+            conn.execute('UPDATE fingerprints SET path = ? WHERE path = ?', (new_rel, old_rel))
+            conn.execute('UPDATE content_hashes SET path = ? WHERE path = ?', (new_rel, old_rel))
+            conn.execute('UPDATE media SET path = ? WHERE path = ?', (new_rel, old_rel))
+            if not os.path.isdir(new_full_path):
+                return
+            conn.execute('UPDATE fingerprints SET path = ? || substr(path, ?) WHERE path >= ? AND path < ?',
+                         (new_rel, cut, low, high))
+            conn.execute('UPDATE content_hashes SET path = ? || substr(path, ?) WHERE path >= ? AND path < ?',
+                         (new_rel, cut, low, high))
+            conn.execute('UPDATE media SET path = ? || substr(path, ?) WHERE path >= ? AND path < ?',
+                         (new_rel, cut, low, high))
+            conn.execute('UPDATE entries SET path = ? || substr(path, ?), parent = ? || substr(parent, ?) '
+                         'WHERE path >= ? AND path < ?',
+                         (new_rel, cut, new_rel, cut, low, high))
+            conn.execute(
+                'UPDATE folders SET path = ? || substr(path, ?), '
+                'parent = CASE WHEN path = ? THEN ? ELSE ? || substr(parent, ?) END '
+                'WHERE path = ? OR (path >= ? AND path < ?)',
+                (new_rel, cut, old_rel, _parent_rel(new_rel), new_rel, cut, old_rel, low, high))
+    except sqlite3.Error as e:
+        print(f"⚠️  Ошибка обновления индекса для {new_full_path}: {e}")
+
+def search_index(query, base_rel='', limit=SEARCH_DEFAULT_LIMIT, offset=0):
+    """Найти файлы и папки, в имени которых есть подстрока query
+    
+    Ищет внутри папки base_rel. Возвращает список словарей как у get_file_info
+    (с полем 'path'): сначала папки, потом файлы, по алфавиту.
+    """
+    query = query.lower()
+    # Подтягиваем изменения на диске (ленивая починка индекса)
+    if folder_stats(base_rel) is None:
+        return []
+    
+    low, high = _subtree_range(base_rel)
+    columns = ('e.path, e.name, e.is_dir, e.mtime, '
+               'CASE WHEN e.is_dir THEN COALESCE(f.size, 0) ELSE e.size END AS size')
+    order = 'ORDER BY e.is_dir DESC, e.name_lower, e.path LIMIT ? OFFSET ?'
+    if SEARCH_FTS_AVAILABLE and len(query) >= 3:
+        # Триграммы работают только для подстрок от 3 символов
+        rows = get_index_db().execute(
+            f'SELECT {columns} FROM entries_fts JOIN entries e ON e.rowid = entries_fts.rowid '
+            f'LEFT JOIN folders f ON e.is_dir AND f.path = e.path '
+            f'WHERE entries_fts MATCH ? AND e.path >= ? AND e.path < ? {order}',
+            ('"' + query.replace('"', '""') + '"', low, high, limit, offset))
+    else:
+        rows = get_index_db().execute(
+            f'SELECT {columns} FROM entries e LEFT JOIN folders f ON e.is_dir AND f.path = e.path '
+            f'WHERE instr(e.name_lower, ?) > 0 AND e.path >= ? AND e.path < ? {order}',
+            (query, low, high, limit, offset))
+    
+    results = []
+    for row in rows:
+        info = make_file_info(row['name'], row['size'], row['mtime'], bool(row['is_dir']))
+        info['path'] = row['path']
+        results.append(info)
+    return results
+
+def _list_sort_columns():
+    """SQL-выражения ключа сортировки, повторяющие get_folder_priority в browse()
+    
+    Папки: (0, приоритет, имя для обычных папок), файлы: (1, 0, '', -дата), где
+    дата - дата съемки из таблицы media, а если она неизвестна - mtime.
+    Путь в конце делает порядок строгим для курсора.
+    """
+    priority = 'CASE ' + ' '.join('WHEN e.name = ? THEN ?' for _ in FOLDER_ORDER) + ' ELSE 999 END'
+    params = [value for item in FOLDER_ORDER.items() for value in item]
+    columns = (f'CASE WHEN e.is_dir THEN 0 ELSE 1 END AS k1, '
+               f'CASE WHEN e.is_dir THEN {priority} ELSE 0 END AS k2, '
+               f'CASE WHEN e.is_dir AND {priority} = 999 THEN e.name_lower ELSE \'\' END AS k3, '
+               f'CASE WHEN e.is_dir THEN 0 ELSE -COALESCE(m.taken, e.mtime) END AS k4')
+    return columns, params + params
+
+def encode_cursor(key):
+    """Непрозрачный курсор страницы из ключа сортировки последнего элемента"""
+    return base64.urlsafe_b64encode(json.dumps(key, ensure_ascii=False).encode()).decode()
+
+def decode_cursor(cursor, length=5):
+    """Ключ сортировки из length значений из курсора (ValueError при битом курсоре)"""
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise ValueError('Неверный курсор')
+    if (not isinstance(key, list) or len(key) != length
+            or not all(value is None or isinstance(value, (str, int, float)) for value in key)):
+        raise ValueError('Неверный курсор')
+    return key
+
+def list_directory_page(rel, cursor=None, limit=LIST_PAGE_SIZE):
+    """Страница содержимого папки из индекса в порядке browse()
+    
+    Returns:
+        (items, next_cursor) - next_cursor равен None на последней странице
+    """
+    columns, params = _list_sort_columns()
+    media_columns = ', '.join(f'm.{key}' for key in MEDIA_FIELDS)
+    sql = (f'SELECT * FROM (SELECT e.path, e.name, e.is_dir, e.size, e.mtime, {media_columns}, {columns}, '
+           f'f.fp AS version FROM entries e LEFT JOIN media m ON m.path = e.path AND m.mtime = e.mtime '
+           f'LEFT JOIN fingerprints f ON f.path = e.path AND f.size = e.size AND f.mtime = e.mtime '
+           f'WHERE e.parent = ?)')
+    params.append(rel)
+    if cursor:
+        sql += ' WHERE (k1, k2, k3, k4, path) > (?, ?, ?, ?, ?)'
+        params.extend(decode_cursor(cursor))
+    sql += ' ORDER BY k1, k2, k3, k4, path LIMIT ?'
+    params.append(limit + 1)
+    rows = get_index_db().execute(sql, params).fetchall()
+    
+    items = []
+    for row in rows[:limit]:
+        size = row['size']
+        if row['is_dir']:
+            # Заодно чиним запись подпапки, если она менялась в обход приложения
+            stats = folder_stats(row['path'])
+            size = stats['size'] if stats else 0
+        info = make_file_info(row['name'], size, row['mtime'], bool(row['is_dir']), row)
+        info['path'] = row['path']
+        if row['version']:
+            # Отпечаток содержимого для URL миниатюр: такой URL можно кешировать навсегда
+            info['version'] = row['version']
+        if not row['is_dir']:
+            info['file_version'] = file_version(row['size'], row['mtime'])
+        items.append(info)
+    
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = encode_cursor([last['k1'], last['k2'], last['k3'], last['k4'], last['path']])
+    return items, next_cursor
+
+# Ключ сортировки раздела категории: по имени - по алфавиту, по дате съемки
+# (или изменения) и по размеру - сначала новые и большие
+CATEGORY_SORTS = {
+    'name': 'e.name_lower',
+    'date': '-COALESCE(m.taken, e.mtime)',
+    'size': '-e.size',
+}
+
+def list_category_page(category, rel, sort='name', cursor=None, limit=LIST_PAGE_SIZE):
+    """Страница файлов категории во всём поддереве папки, отсортированная в индексе
+    
+    Returns:
+        (items, next_cursor) - next_cursor равен None на последней странице
+    """
+    low, high = _subtree_range(rel)
+    media_columns = ', '.join(f'm.{key}' for key in MEDIA_FIELDS)
+    sql = (f'SELECT * FROM (SELECT e.path, e.name, e.size, e.mtime, {media_columns}, f.fp AS version, '
+           f'{CATEGORY_SORTS[sort]} AS k FROM entries e LEFT JOIN media m ON m.path = e.path AND m.mtime = e.mtime '
+           f'LEFT JOIN fingerprints f ON f.path = e.path AND f.size = e.size AND f.mtime = e.mtime '
+           f'WHERE e.category = ? AND e.path >= ? AND e.path < ?)')
+    params = [category, low, high]
+    if cursor:
+        sql += ' WHERE (k, path) > (?, ?)'
+        params.extend(decode_cursor(cursor, 2))
+    sql += ' ORDER BY k, path LIMIT ?'
+    params.append(limit + 1)
+    rows = get_index_db().execute(sql, params).fetchall()
+    
+    items = []
+    for row in rows[:limit]:
+        info = make_file_info(row['name'], row['size'], row['mtime'], False, row)
+        info['path'] = row['path']
+        if row['version']:
+            info['version'] = row['version']
+        info['file_version'] = file_version(row['size'], row['mtime'])
+        items.append(info)
+    
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = encode_cursor([last['k'], last['path']])
+    return items, next_cursor
+
+def category_stats(category, rel):
+    """Число и общий размер файлов категории в поддереве папки (по индексу)"""
+    low, high = _subtree_range(rel)
+    row = get_index_db().execute(
+        'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries WHERE category = ? AND path >= ? AND path < ?',
+        (category, low, high)).fetchone()
+    return row[0], row[1]
+
+def count_subfolders(rel):
+    """Число папок непосредственно внутри папки (по индексу)"""
+    return get_index_db().execute('SELECT COUNT(*) FROM entries WHERE parent = ? AND is_dir', (rel,)).fetchone()[0]
+
+def claim_periodic_job(name, interval):
+    """Занять периодическую задачу, общую для всех процессов
+
+    Returns:
+        True если с прошлого запуска задачи (в любом процессе) прошло interval секунд
+    """
+    now = time.time()
+    with index_transaction() as conn:
+        row = conn.execute('SELECT value FROM index_meta WHERE key = ?', (name,)).fetchone()
+        if row is not None and now - float(row['value']) < interval:
+            return False
+        conn.execute('INSERT INTO index_meta (key, value) VALUES (?, ?) '
+                     'ON CONFLICT(key) DO UPDATE SET value = excluded.value', (name, now))
+    return True
+
+def claim_lease(name, ttl):
+    """Занять или продлить роль, которую выполняет только один процесс
+
+    Returns:
+        True если роль за этим процессом: он её уже держит или прежний
+        владелец не продлевал её ttl секунд
+    """
+    now = time.time()
+    owner = str(os.getpid())
+    with index_transaction() as conn:
+        row = conn.execute('SELECT value FROM index_meta WHERE key = ?', (name,)).fetchone()
+        if row is not None:
+            pid, _, renewed = str(row['value']).partition(':')
+            if pid != owner and now - float(renewed or 0) < ttl:
+                return False
+        conn.execute('INSERT INTO index_meta (key, value) VALUES (?, ?) '
+                     'ON CONFLICT(key) DO UPDATE SET value = excluded.value', (name, f'{owner}:{now}'))
+    return True
+
+init_index_db()
+
 def get_image_date(filepath):
     """Извлечь дату съемки из EXIF данных изображения"""
     try:
@@ -255,98 +1454,1355 @@ def get_image_date(filepath):
     print(f"⚠ Используется дата файла для {os.path.basename(filepath)}: {fallback_date.strftime('%Y-%m-%d %H:%M:%S')}")
     return fallback_date
 
-def get_photo_destination_path(filepath):
-    """Определить путь для сохранения фото: Фото/Год/Месяц"""
-    date_obj = get_image_date(filepath)
-    year = date_obj.strftime('%Y')
+# Русские названия месяцев
+MONTH_NAMES_RU = {
+    '01': 'Январь', '02': 'Февраль', '03': 'Март', '04': 'Апрель',
+    '05': 'Май', '06': 'Июнь', '07': 'Июль', '08': 'Август',
+    '09': 'Сентябрь', '10': 'Октябрь', '11': 'Ноябрь', '12': 'Декабрь'
+}
+
+def dated_folder(root, date_obj):
+    """Папка вида Фото/2024/Март для даты"""
+    month_name = MONTH_NAMES_RU.get(date_obj.strftime('%m'), date_obj.strftime('%B'))
+    return os.path.join(root, date_obj.strftime('%Y'), month_name)
+
+# ==================== Потоковый приём загрузок ====================
+# Загружаемый файл пишется сразу в storage/.incoming, а не во временную папку
+# системы, и первые INGEST_HEAD_BYTES байт параллельно копятся в памяти. Дата
+# съёмки читается из EXIF этого начала ещё во время приёма, поэтому имя и папка
+# Фото/Год/Месяц известны без повторного открытия файла, а на место он попадает
+# одним переименованием в пределах той же файловой системы. Там же по ходу
+# приёма считается SHA-256 содержимого для поиска дубликатов.
+
+EXIF_IFD = 0x8769
+EXIF_DATE_TAGS = (36867, 36868)  # DateTimeOriginal, DateTimeDigitized (в Exif IFD)
+EXIF_DATETIME = 306  # DateTime (в IFD0)
+INGEST_ENDPOINTS = {'upload_file', 'upload_direct'}
+
+def parse_exif_datetime(value):
+    """Дата из строки EXIF ('2024:12:06 10:30:45' и похожих форматов) или None"""
+    value = str(value).strip().strip('\x00')
+    for fmt in ['%Y:%m:%d %H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y:%m:%d', '%Y-%m-%d']:
+        try:
+            return datetime.strptime(value[:19] if '%H' in fmt else value[:10], fmt)
+        except ValueError:
+            continue
+    return None
+
+def exif_date_from_head(head):
+    """Дата съемки из EXIF-сегмента в начале JPEG (None, если её там нет)"""
+    if not head.startswith(b'\xff\xd8'):
+        return None
+    pos = 2
+    while pos + 4 <= len(head):
+        if head[pos] != 0xFF:
+            return None
+        marker = head[pos + 1]
+        if marker == 0xFF:
+            pos += 1  # Заполнитель между сегментами
+            continue
+        if marker in (0xD9, 0xDA):
+            return None  # Начались данные изображения - EXIF уже не будет
+        length = int.from_bytes(head[pos + 2:pos + 4], 'big')
+        if marker == 0xE1 and head[pos + 4:pos + 10] == b'Exif\x00\x00':
+            segment = bytes(head[pos + 10:pos + 2 + length])
+            if len(segment) < length - 8:
+                return None  # Сегмент не поместился в начало файла
+            try:
+                with metric_timer('cloud_exif_parse_seconds', source='upload'):
+                    exif = Image.Exif()
+                    exif.load(segment)
+                    sub_ifd = exif.get_ifd(EXIF_IFD)
+                    values = [sub_ifd.get(tag) for tag in EXIF_DATE_TAGS] + [exif.get(EXIF_DATETIME)]
+            except Exception:
+                return None
+            for value in values:
+                date_obj = parse_exif_datetime(value) if value else None
+                if date_obj:
+                    return date_obj
+            return None
+        pos += 2 + length
+    return None
+
+class IngestFile:
+    """Файл загрузки в storage/.incoming с копией первых INGEST_HEAD_BYTES байт
+    и хешем содержимого
     
-    # Русские названия месяцев
-    month_names_ru = {
-        '01': 'Январь', '02': 'Февраль', '03': 'Март', '04': 'Апрель',
-        '05': 'Май', '06': 'Июнь', '07': 'Июль', '08': 'Август',
-        '09': 'Сентябрь', '10': 'Октябрь', '11': 'Ноябрь', '12': 'Декабрь'
-    }
+    Если файл не забрали через claim(), при закрытии (конец запроса) он удаляется.
+    """
     
-    month_num = date_obj.strftime('%m')
-    month_name = month_names_ru.get(month_num, date_obj.strftime('%B'))
+    def __init__(self):
+        directory = os.path.join(app.config['UPLOAD_FOLDER'], INGEST_FOLDER)
+        os.makedirs(directory, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(suffix='.part', dir=directory)
+        self.file = os.fdopen(fd, 'w+b')
+        self.head = bytearray()
+        self.digest = hashlib.sha256()
+        self._date = None
+        self._date_parsed = False
     
-    result_path = os.path.join('Фото', year, month_name)
-    print(f"Путь назначения для {os.path.basename(filepath)}: {result_path}")
+    def write(self, data):
+        if len(self.head) < INGEST_HEAD_BYTES:
+            self.head += data[:INGEST_HEAD_BYTES - len(self.head)]
+            if len(self.head) >= INGEST_HEAD_BYTES:
+                self.capture_date()  # Остальное ещё принимается
+        self.digest.update(data)
+        return self.file.write(data)
     
-    return result_path
-
-def get_video_destination_path(filepath):
-    """Определить путь для сохранения видео: Видео/Год/Месяц"""
-    # Используем дату модификации файла
-    date_obj = datetime.fromtimestamp(os.path.getmtime(filepath))
-    year = date_obj.strftime('%Y')
+    def capture_date(self):
+        """Дата съемки из EXIF начала файла или None"""
+        if not self._date_parsed:
+            self._date = exif_date_from_head(self.head)
+            self._date_parsed = True
+        return self._date
     
-    # Русские названия месяцев
-    month_names_ru = {
-        '01': 'Январь', '02': 'Февраль', '03': 'Март', '04': 'Апрель',
-        '05': 'Май', '06': 'Июнь', '07': 'Июль', '08': 'Август',
-        '09': 'Сентябрь', '10': 'Октябрь', '11': 'Ноябрь', '12': 'Декабрь'
-    }
+    def claim(self, final_path):
+        """Перенести принятый файл на место одним переименованием (с дедупликацией)
+        
+        Returns:
+            (сохранён ли файл, путь уже лежащей копии или None) - см. place_upload()
+        """
+        self.file.close()
+        result = place_upload(self.path, final_path, self.digest.hexdigest())
+        self.path = None
+        return result
     
-    month_num = date_obj.strftime('%m')
-    month_name = month_names_ru.get(month_num, date_obj.strftime('%B'))
+    def close(self):
+        self.file.close()
+        if self.path:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self.path = None
     
-    result_path = os.path.join('Видео', year, month_name)
-    print(f"Путь назначения для {os.path.basename(filepath)}: {result_path}")
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+class IngestRequest(Request):
+    """Запрос, в котором файлы загрузки пишутся сразу в хранилище"""
     
-    return result_path
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if filename and self.endpoint in INGEST_ENDPOINTS:
+            return IngestFile()
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
 
-@app.route('/')
-def index():
-    return redirect(url_for('browse', path=''))
+app.request_class = IngestRequest
 
-@app.route('/browse/')
-@app.route('/browse/<path:path>')
-def browse(path=''):
-    """Просмотр файлов и папок"""
-    full_path = os.path.join(app.config['UPLOAD_FOLDER'], path)
-    
-    if not os.path.exists(full_path):
-        flash('Папка не найдена!', 'error')
-        return redirect(url_for('index'))
-    
-    if os.path.isfile(full_path):
-        return send_file(full_path, as_attachment=True)
-    
-    items = []
+def ingest_date(file, is_image=True):
+    """Дата для имени и папки загрузки: EXIF из начала файла, иначе время загрузки"""
+    if not is_image:
+        return datetime.now()
+    stream = file.stream
+    if isinstance(stream, IngestFile):
+        date_obj = stream.capture_date()
+        if date_obj is None and not stream.head.startswith(b'\xff\xd8'):
+            # Не JPEG (PNG, WebP...) - EXIF бывает в конце файла, читаем его целиком через PIL
+            stream.flush()
+            return get_image_date(stream.path)
+    else:
+        date_obj = exif_date_from_head(stream.read(INGEST_HEAD_BYTES))
+        stream.seek(0)
+    return date_obj or datetime.now()
+
+def file_capture_date(path):
+    """Дата съемки уже принятого файла: EXIF из начала, иначе через PIL, иначе сейчас"""
+    with open(path, 'rb') as f:
+        head = f.read(INGEST_HEAD_BYTES)
+    date_obj = exif_date_from_head(head)
+    if date_obj is None and not head.startswith(b'\xff\xd8'):
+        return get_image_date(path)
+    return date_obj or datetime.now()
+
+def move_into_place(source_path, final_path):
+    """Переместить принятый файл на место (в пределах storage - переименованием)"""
     try:
-        for item in os.listdir(full_path):
-            item_path = os.path.join(full_path, item)
-            info = get_file_info(item_path)
-            info['path'] = os.path.join(path, item).replace('\\', '/')
-            items.append(info)
-    except PermissionError:
-        flash('Нет доступа к этой папке!', 'error')
-        return redirect(url_for('index'))
+        os.replace(source_path, final_path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(source_path, final_path)  # Папка назначения смонтирована с другого раздела
+
+def store_upload(file, final_path):
+    """Сохранить загруженный файл по пути (принятый потоком - переименованием)
     
-    # Функция для определения приоритета папок
-    def get_folder_priority(item):
-        if not item['is_dir']:
-            return (1, -item.get('modified_timestamp', 0))  # Файлы после папок, по дате
-        
-        # Приоритет для специальных папок
-        folder_order = {'Фото': 0, 'Видео': 1, 'Документы': 2}
-        name = item['name']
-        if name in folder_order:
-            return (0, folder_order[name], '')
-        else:
-            return (0, 999, name.lower())  # Остальные папки по алфавиту
+    Returns:
+        (сохранён ли файл, путь уже лежащей копии или None) - см. place_upload()
+    """
+    if isinstance(file.stream, IngestFile):
+        return file.stream.claim(final_path)
+    file.save(final_path)
+    return True, None
+
+def auto_sort_destination(filename, date_obj, is_image):
+    """Свободный путь для нового фото или видео в Фото|Видео/Год/Месяц
     
-    # Сортировка: сначала папки в определённом порядке, потом файлы (по дате, новые первые)
-    items.sort(key=get_folder_priority)
+    Длинное имя (> 20 символов) заменяется датой съемки.
+    """
+    filename = shorten_name_by_date(filename, date_obj, max_length=20)
+    dest_path = dated_folder('Фото' if is_image else 'Видео', date_obj)
+    full_dest_path = os.path.join(app.config['UPLOAD_FOLDER'], dest_path)
+    print(f"Путь назначения для {filename}: {dest_path}")
     
-    # Путь для навигации
-    breadcrumbs = []
-    parent_path = ''
-    if path:
-        parts = path.split('/')
-        current = ''
-        for i, part in enumerate(parts):
+    # Создаем структуру папок если её нет
+    os.makedirs(full_dest_path, exist_ok=True)
+    return unique_path(full_dest_path, filename)
+
+# ==================== Метаданные медиа ====================
+# Дата съемки, размеры, ориентация и камера фото, длительность и кодек видео
+# читаются с диска один раз на версию файла и хранятся в таблице media (вместе с
+# размером и mtime, по которым проверяется, что файл не менялся). Заполняет её
+# фоновый прогрев миниатюр сразу после загрузки (или python app.py --prewarm),
+# а список папки сортирует файлы по дате съемки, не открывая их.
+#
+# Изображение открывается без декодирования (PIL читает только заголовки), дата
+# видео MP4/MOV берётся из атома mvhd контейнера, кодек и размеры кадра - через
+# OpenCV, если он установлен.
+
+MEDIA_FIELDS = ('taken', 'width', 'height', 'orientation', 'camera', 'duration', 'codec')
+MP4_EXTENSIONS = ('.mp4', '.mov', '.m4v', '.3gp')
+MP4_EPOCH_OFFSET = 2082844800  # Секунд между 1904-01-01 (эпоха MP4) и 1970-01-01
+EXIF_MAKE = 271
+EXIF_MODEL = 272
+
+def _mp4_find_box(f, start, end, box_type):
+    """Границы (начало данных, конец) атома box_type среди атомов [start, end) или None"""
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        header = f.read(16)
+        if len(header) < 8:
+            return None
+        size = int.from_bytes(header[:4], 'big')
+        body = pos + 8
+        if size == 1:
+            size = int.from_bytes(header[8:16], 'big')  # 64-битный размер
+            body += 8
+        elif size == 0:
+            size = end - pos  # Атом до конца файла
+        if size < body - pos:
+            return None
+        if header[4:8] == box_type:
+            return body, pos + size
+        pos += size
+    return None
+
+def read_mp4_header(full_path):
+    """Дата создания (timestamp) и длительность (секунды) из атома moov/mvhd
+    
+    Returns:
+        (taken, duration), неизвестные значения - None
+    """
+    with open(full_path, 'rb') as f:
+        moov = _mp4_find_box(f, 0, os.fstat(f.fileno()).st_size, b'moov')
+        mvhd = moov and _mp4_find_box(f, moov[0], moov[1], b'mvhd')
+        if not mvhd:
+            return None, None
+        f.seek(mvhd[0])
+        data = f.read(32)
+    if len(data) < 20:
+        return None, None
+    if data[0] == 1 and len(data) >= 32:
+        created = int.from_bytes(data[4:12], 'big')
+        timescale = int.from_bytes(data[20:24], 'big')
+        length = int.from_bytes(data[24:32], 'big')
+    else:
+        created = int.from_bytes(data[4:8], 'big')
+        timescale = int.from_bytes(data[12:16], 'big')
+        length = int.from_bytes(data[16:20], 'big')
+    # Камеры без часов пишут 0 - такой даты нет
+    taken = created - MP4_EPOCH_OFFSET if created > MP4_EPOCH_OFFSET else None
+    return taken, length / timescale if timescale else None
+
+def _read_image_metadata(full_path, meta):
+    with metric_timer('cloud_exif_parse_seconds', source='file'), Image.open(full_path) as img:
+        meta['width'], meta['height'] = img.size
+        exif = img.getexif()
+    meta['orientation'] = exif.get(EXIF_ORIENTATION)
+    sub_ifd = exif.get_ifd(EXIF_IFD)
+    for value in [sub_ifd.get(tag) for tag in EXIF_DATE_TAGS] + [exif.get(EXIF_DATETIME)]:
+        date_obj = parse_exif_datetime(value) if value else None
+        if date_obj:
+            meta['taken'] = date_obj.timestamp()
+            break
+    make = str(exif.get(EXIF_MAKE) or '').strip('\x00 ')
+    model = str(exif.get(EXIF_MODEL) or '').strip('\x00 ')
+    # Многие производители повторяют марку в модели ("Canon" + "Canon EOS 80D")
+    camera = model if model.lower().startswith(make.lower()) else f'{make} {model}'.strip()
+    meta['camera'] = camera or None
+
+def _read_video_metadata(full_path, meta):
+    if full_path.lower().endswith(MP4_EXTENSIONS):
+        meta['taken'], meta['duration'] = read_mp4_header(full_path)
+    if not OPENCV_AVAILABLE:
+        return
+    cap = cv2.VideoCapture(full_path)
+    try:
+        if not cap.isOpened():
+            return
+        meta['width'] = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)) or None
+        meta['height'] = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)) or None
+        fourcc = int(cap.get(cv2.CAP_PROP_FOURCC))
+        meta['codec'] = ''.join(chr((fourcc >> 8 * i) & 0xFF) for i in range(4)).strip('\x00 ') or None
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        frame_count = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+        if meta['duration'] is None and fps > 0 and frame_count > 0:
+            meta['duration'] = frame_count / fps
+    finally:
+        cap.release()
+
+def read_media_metadata(full_path):
+    """Прочитать метаданные фото или видео с диска
+    
+    Returns:
+        dict с ключами MEDIA_FIELDS (то, что прочитать не удалось, - None)
+    """
+    meta = dict.fromkeys(MEDIA_FIELDS)
+    try:
+        if thumbnail_kind(full_path) == 'image':
+            _read_image_metadata(full_path, meta)
+        else:
+            _read_video_metadata(full_path, meta)
+    except Exception as e:
+        print(f"✗ Ошибка чтения метаданных {os.path.basename(full_path)}: {e}")
+    return meta
+
+def media_metadata(full_path):
+    """Метаданные фото или видео (с диска читаются один раз на версию файла)
+    
+    Returns:
+        dict с ключами MEDIA_FIELDS или None, если это не фото и не видео
+    """
+    if thumbnail_kind(full_path) is None:
+        return None
+    st = os.stat(full_path)
+    rel = rel_path(full_path)
+    try:
+        row = get_index_db().execute('SELECT * FROM media WHERE path = ?', (rel,)).fetchone()
+        if row is not None and row['size'] == st.st_size and row['mtime'] == st.st_mtime:
+            return {key: row[key] for key in MEDIA_FIELDS}
+    except sqlite3.Error as e:
+        print(f"⚠️  Ошибка чтения метаданных {rel}: {e}")
+    
+    meta = read_media_metadata(full_path)
+    try:
+        with index_transaction() as conn:
+            conn.execute(f'INSERT OR REPLACE INTO media (path, size, mtime, {", ".join(MEDIA_FIELDS)}) '
+                         f'VALUES (?, ?, ?, {", ".join("?" * len(MEDIA_FIELDS))})',
+                         (rel, st.st_size, st.st_mtime, *(meta[key] for key in MEDIA_FIELDS)))
+    except sqlite3.Error as e:
+        print(f"⚠️  Ошибка записи метаданных {rel}: {e}")
+    return meta
+
+def capture_date(full_path):
+    """Дата съемки фото или видео из базы метаданных, иначе дата изменения файла"""
+    meta = media_metadata(full_path)
+    if meta and meta['taken']:
+        return datetime.fromtimestamp(meta['taken'])
+    return datetime.fromtimestamp(os.path.getmtime(full_path))
+
+# ==================== Генерация миниатюр ====================
+# Миниатюры рисуются в ограниченном пуле процессов (или потоков, если процессы
+# недоступны, как в Termux). Одинаковые одновременные запросы объединяются:
+# первый запрос ставит задачу, остальные ждут её результата. Между воркерами
+# gunicorn то же самое обеспечивает файл-блокировка рядом с файлом кеша.
+
+VIDEO_PLACEHOLDER_SVG = '''<svg width="200" height="200" xmlns="http://www.w3.org/2000/svg">
+    <rect width="200" height="200" fill="#2c3e50"/>
+    <polygon points="70,50 70,150 150,100" fill="#3498db"/>
+    <text x="100" y="180" font-family="Arial" font-size="14" fill="#ecf0f1" text-anchor="middle">VIDEO</text>
+</svg>'''
+
+THUMB_IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')
+THUMB_VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mkv', '.mov', '.webm', '.flv', '.wmv')
+
+_thumb_executor = None
+_thumb_lock = threading.Lock()
+_thumb_inflight = {}  # cache_path -> Future для объединения одинаковых запросов
+thumb_stats = {
+    'pending': 0,       # Задачи в пуле (в очереди и в работе)
+    'generated': 0,
+    'failed': 0,
+    'coalesced': 0,     # Запросы, дождавшиеся чужой задачи
+    'rejected': 0,      # Отказы из-за переполненной очереди
+    'wait_count': 0,
+    'wait_total': 0.0,
+    'wait_max': 0.0,
+    'hits': 0,          # Миниатюры, отданные из кеша
+    'misses': 0,        # Миниатюры, которые пришлось рисовать
+    'evicted': 0,       # Вытеснены из кеша по бюджету
+    'orphans': 0,       # Удалены вместе с оригиналом или фоновой чисткой
+}
+
+class ThumbnailQueueFull(Exception):
+    """Очередь генерации миниатюр переполнена"""
+
+def get_thumb_executor():
+    """Пул воркеров для миниатюр (создаётся при первом обращении)"""
+    global _thumb_executor
+    with _thumb_lock:
+        if _thumb_executor is None:
+            try:
+                _thumb_executor = ProcessPoolExecutor(max_workers=THUMBNAIL_WORKERS)
+                print(f"✅ Пул миниатюр: {THUMBNAIL_WORKERS} процесс(ов)")
+            except (OSError, NotImplementedError, ImportError) as e:
+                # Android/Termux без sem_open - используем потоки (PIL отпускает GIL при декодировании)
+                _thumb_executor = ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS)
+                print(f"⚠️  Пул процессов недоступен ({e}), миниатюры в {THUMBNAIL_WORKERS} поток(ах)")
+        return _thumb_executor
+
+EXIF_ORIENTATION = 0x0112
+
+# EXIF Orientation → преобразование, возвращающее картинку в нормальное положение
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+def open_reduced(img, size):
+    """Декодировать изображение сразу примерно в 2 раза крупнее нужного размера
+    
+    JPEG масштабируется прямо в декодере (draft: 1/2, 1/4, 1/8 через DCT), остальные
+    форматы уменьшаются целочисленным reduce() сразу после загрузки. Запас в 2 раза
+    оставляет LANCZOS в thumbnail() материал для качественного уменьшения.
+    """
+    target = (size[0] * 2, size[1] * 2)
+    if img.format == 'JPEG':
+        img.draft(None, target)
+    img.load()
+    
+    factor = min(img.width // target[0], img.height // target[1])
+    if factor >= 2:
+        if img.mode == 'P':
+            img = img.convert('RGBA')  # Палитру нельзя усреднять по индексам
+        if img.mode in ('L', 'LA', 'RGB', 'RGBA'):
+            img = img.reduce(factor)
+    return img
+
+def video_failed_marker(cache_path):
+    """Файл-отметка рядом с кешем: из этого видео кадры не читаются"""
+    return os.path.join(os.path.dirname(cache_path), os.path.basename(cache_path)[:32] + '.none')
+
+def _video_frame_at(cap, frame_count, position):
+    """Кадр видео (BGR) на доле длительности position или None"""
+    if frame_count > 0:
+        # OpenCV сам находит ближайший ключевой кадр и декодирует только от него
+        cap.set(cv2.CAP_PROP_POS_FRAMES, int((frame_count - 1) * position))
+    ret, frame = cap.read()
+    return frame if ret else None
+
+def _video_frame_image(frame):
+    # Конвертируем BGR (OpenCV) в RGB (PIL) и создаём PIL Image из numpy array
+    return Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+
+def read_video_poster(full_path):
+    """Кадр-постер видео (PIL RGB) или None, если кадры не читаются
+    
+    Первый кадр часто чёрный (затемнение, заставка), поэтому берётся кадр на 10%
+    длительности, а если он тёмный - следующие позиции из VIDEO_POSTER_POSITIONS.
+    Если светлого кадра нет, возвращается самый яркий из просмотренных.
+    """
+    cap = cv2.VideoCapture(full_path)
+    try:
+        if not cap.isOpened():
+            return None
+        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        best, best_brightness = None, -1.0
+        for position in VIDEO_POSTER_POSITIONS:
+            frame = _video_frame_at(cap, frame_count, position)
+            if frame is None:
+                continue
+            brightness = float(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY).mean())
+            if brightness > best_brightness:
+                best, best_brightness = frame, brightness
+            if brightness >= VIDEO_BLACK_THRESHOLD:
+                break
+        return _video_frame_image(best) if best is not None else None
+    finally:
+        cap.release()
+
+def save_thumbnail(img, cache_path, size, fmt):
+    """Сохранить готовую картинку в кеш атомарно (читатели не увидят половину файла)"""
+    temp_path = f'{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    quality = THUMBNAIL_SIZES.get(size, 60)
+    if fmt == 'webp':
+        img.save(temp_path, 'WEBP', quality=quality, method=4)
+    else:
+        img.save(temp_path, 'JPEG', quality=quality, optimize=True, progressive=size > THUMBNAIL_DEFAULT_SIZE)
+    os.replace(temp_path, cache_path)
+
+def mark_video_failed(cache_path):
+    """Запомнить, что из видео не читаются кадры - следующие запросы не будут его открывать"""
+    with open(video_failed_marker(cache_path), 'w'):
+        pass
+
+def render_thumbnail(full_path, cache_path, is_video, size=THUMBNAIL_DEFAULT_SIZE, fmt='jpeg'):
+    """Отрисовать миниатюру size x size в файл кеша в формате fmt ('jpeg' или 'webp')
+    
+    Выполняется в пуле воркеров.
+    
+    Returns:
+        True если миниатюра сохранена, False если из видео не удалось прочитать кадр
+    """
+    if is_video:
+        img = read_video_poster(full_path)
+        if img is None:
+            mark_video_failed(cache_path)
+            return False
+        img.thumbnail((size, size), Image.Resampling.LANCZOS)
+    else:
+        with Image.open(full_path) as source:
+            # Ориентацию читаем до декодирования - у уменьшенной копии EXIF уже не будет
+            try:
+                orientation = source.getexif().get(EXIF_ORIENTATION)
+            except Exception:
+                orientation = None
+            
+            img = open_reduced(source, (size, size))
+            
+            # Конвертируем в RGB если нужно (уже на маленькой картинке)
+            if img.mode in ('RGBA', 'LA', 'P'):
+                if img.mode == 'P':
+                    img = img.convert('RGBA')
+                background = Image.new('RGB', img.size, (255, 255, 255))
+                background.paste(img, mask=img.split()[-1])
+                img = background
+            elif img.mode != 'RGB':
+                img = img.convert('RGB')
+            
+            # Применяем EXIF ориентацию
+            if orientation in ORIENTATION_TRANSPOSE:
+                img = img.transpose(ORIENTATION_TRANSPOSE[orientation])
+            
+            # Создаем миниатюру нужного класса размера
+            img.thumbnail((size, size), Image.Resampling.LANCZOS)
+    
+    save_thumbnail(img, cache_path, size, fmt)
+    return True
+
+def render_video_strip(full_path, cache_path, is_video=True, size=VIDEO_STRIP_SIZE, fmt='jpeg'):
+    """Отрисовать полосу из VIDEO_STRIP_FRAMES кадров по всей длине видео
+    
+    Кадры идут слева направо одинаковой ширины - для перемотки наведением.
+    Выполняется в пуле воркеров.
+    
+    Returns:
+        True если полоса сохранена, False если кадры не читаются
+    """
+    cap = cv2.VideoCapture(full_path)
+    try:
+        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) if cap.isOpened() else 0
+        if frame_count <= 0:
+            return False
+        frames = []
+        for i in range(VIDEO_STRIP_FRAMES):
+            frame = _video_frame_at(cap, frame_count, (i + 0.5) / VIDEO_STRIP_FRAMES)
+            if frame is not None:
+                img = _video_frame_image(frame)
+                img.thumbnail((size, size), Image.Resampling.LANCZOS)
+                frames.append(img)
+    finally:
+        cap.release()
+    
+    if not frames:
+        return False
+    # Число кадров в полосе постоянное - недочитанные заменяем последним
+    frames += [frames[-1]] * (VIDEO_STRIP_FRAMES - len(frames))
+    width, height = frames[0].size
+    strip = Image.new('RGB', (width * VIDEO_STRIP_FRAMES, height))
+    for i, img in enumerate(frames):
+        strip.paste(img if img.size == (width, height) else img.resize((width, height)), (i * width, 0))
+    save_thumbnail(strip, cache_path, size, fmt)
+    return True
+
+def _thumb_job_done(_future):
+    with _thumb_lock:
+        thumb_stats['pending'] -= 1
+
+def submit_thumb_job(func, *args):
+    """Поставить задачу в пул миниатюр (ThumbnailQueueFull при переполнении очереди)"""
+    global _thumb_executor
+    with _thumb_lock:
+        if thumb_stats['pending'] >= THUMBNAIL_QUEUE_LIMIT:
+            thumb_stats['rejected'] += 1
+            raise ThumbnailQueueFull()
+        thumb_stats['pending'] += 1
+    try:
+        try:
+            future = get_thumb_executor().submit(func, *args)
+        except BrokenExecutor:
+            # Процесс пула упал (например, на битом видео) - пересоздаём пул
+            with _thumb_lock:
+                _thumb_executor = None
+            future = get_thumb_executor().submit(func, *args)
+    except:
+        _thumb_job_done(None)
+        raise
+    future.add_done_callback(_thumb_job_done)
+    return future
+
+def _thumb_render_locked(full_path, cache_path, is_video, size, fmt, renderer):
+    """Отрисовать миниатюру в пуле под межпроцессной блокировкой
+    
+    Если миниатюру уже рисует другой воркер gunicorn - ждём его результата.
+    """
+    lock_path = cache_path + '.lock'
+    deadline = time.time() + THUMBNAIL_TIMEOUT
+    while True:
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except FileExistsError:
+            if os.path.exists(cache_path):
+                return True
+            try:
+                # Блокировка упавшего воркера
+                if time.time() - os.path.getmtime(lock_path) > THUMBNAIL_TIMEOUT:
+                    os.remove(lock_path)
+                    continue
+            except OSError:
+                continue
+            if time.time() > deadline:
+                raise TimeoutError('Миниатюру рисует другой процесс слишком долго')
+            time.sleep(0.05)
+    
+    try:
+        # Другой процесс мог закончить, пока мы брали блокировку
+        if os.path.exists(cache_path):
+            return True
+        future = submit_thumb_job(renderer, full_path, cache_path, is_video, size, fmt)
+        return future.result(timeout=max(0.1, deadline - time.time()))
+    finally:
+        try:
+            os.remove(lock_path)
+        except OSError:
+            pass
+
+def generate_thumbnail(full_path, cache_path, is_video, size=THUMBNAIL_DEFAULT_SIZE, fmt='jpeg',
+                       renderer=render_thumbnail):
+    """Получить миниатюру в кеше, объединяя одинаковые одновременные запросы
+    
+    renderer рисует файл в пуле (render_thumbnail или render_video_strip).
+    
+    Returns:
+        True если миниатюра в кеше, False если из видео не удалось прочитать кадр
+    """
+    started = time.time()
+    with _thumb_lock:
+        future = _thumb_inflight.get(cache_path)
+        leader = future is None
+        if leader:
+            future = Future()
+            _thumb_inflight[cache_path] = future
+        else:
+            thumb_stats['coalesced'] += 1
+    
+    if leader:
+        try:
+            with metric_timer('cloud_thumbnail_generate_seconds', kind='video' if is_video else 'image'):
+                result = _thumb_render_locked(full_path, cache_path, is_video, size, fmt, renderer)
+            if result:
+                thumb_cache_record(cache_path)
+            elif os.path.exists(video_failed_marker(cache_path)):
+                thumb_cache_record(video_failed_marker(cache_path))
+            future.set_result(result)
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with _thumb_lock:
+                _thumb_inflight.pop(cache_path, None)
+    
+    try:
+        result = future.result(timeout=THUMBNAIL_TIMEOUT)
+        if leader:
+            with _thumb_lock:
+                thumb_stats['generated' if result else 'failed'] += 1
+        return result
+    except ThumbnailQueueFull:
+        raise
+    except Exception:
+        if leader:
+            with _thumb_lock:
+                thumb_stats['failed'] += 1
+        raise
+    finally:
+        waited = time.time() - started
+        with _thumb_lock:
+            thumb_stats['wait_count'] += 1
+            thumb_stats['wait_total'] += waited
+            thumb_stats['wait_max'] = max(thumb_stats['wait_max'], waited)
+
+# ==================== Учёт кеша миниатюр ====================
+# Миниатюры хранятся под отпечатком содержимого оригинала, а не под его путём:
+# переименованный, перенесённый авторазбором или повторно загруженный файл
+# находит уже готовую миниатюру. Отпечаток каждого пути запоминается в таблице
+# fingerprints вместе с размером и mtime и пересчитывается, только если они
+# изменились.
+#
+# Каждый файл кеша записан в таблицу thumbs: отпечаток, размер и время
+# последнего обращения. Когда кеш превышает THUMBNAIL_CACHE_MAX_BYTES, удаляются
+# давно не открывавшиеся миниатюры (до 90% бюджета, чтобы не чистить на каждом
+# промахе). Миниатюры, на отпечаток которых не ссылается ни один путь, удаляются
+# вместе с последним оригиналом или фоновой чисткой раз в THUMBNAIL_SWEEP_INTERVAL
+# (она же убирает недописанные .tmp и брошенные .lock).
+
+THUMB_TOUCH_INTERVAL = 60  # Не чаще раза в минуту обновлять время обращения к миниатюре
+# <отпечаток>_<размер>.jpg|webp, <отпечаток>_strip.jpg|webp и отметка <отпечаток>.none
+THUMB_CACHE_NAME = re.compile(r'^([0-9a-f]{32})(_\d+\.(jpg|webp)|_strip\.(jpg|webp)|\.none|_proxy\.mp4|_hls\.(m3u8|m4s))$')
+THUMB_LEGACY_NAME = re.compile(r'^[0-9a-f]{32}\.jpg$')  # Миниатюры до появления классов размеров
+# Копии видео: <отпечаток>_proxy.mp4 и HLS <отпечаток>_hls.m3u8 с сегментами в <отпечаток>_hls.m4s
+TRANSCODE_NAME = re.compile(r'^([0-9a-f]{32})_(proxy\.mp4|hls\.m3u8|hls\.m4s)$')
+TRANSCODE_FILES_SQL = "(file LIKE '%_proxy.mp4' OR file LIKE '%_hls.m3u8' OR file LIKE '%_hls.m4s')"
+FINGERPRINT_BLOCK = 64 * 1024
+
+_thumb_sweeper_pid = None
+
+def _fingerprint_read(full_path, size):
+    """Хеш размера и трёх блоков файла (начало, середина, конец)"""
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(full_path, 'rb') as f:
+        if size <= FINGERPRINT_BLOCK * 3:
+            digest.update(f.read())
+        else:
+            for offset in (0, (size - FINGERPRINT_BLOCK) // 2, size - FINGERPRINT_BLOCK):
+                f.seek(offset)
+                digest.update(f.read(FINGERPRINT_BLOCK))
+    return digest.hexdigest()
+
+def file_fingerprint(full_path):
+    """Отпечаток содержимого файла - ключ его миниатюр в кеше
+    
+    Читает не больше 192 КБ: в начале файла EXIF и заголовки, в конце - хвост
+    данных, так что разные фотографии с одинаковым размером не совпадут. mtime
+    в отпечаток не входит (у повторной загрузки он свой), а только проверяет, что
+    запомненный для пути отпечаток ещё действителен.
+    """
+    st = os.stat(full_path)
+    rel = rel_path(full_path)
+    try:
+        row = get_index_db().execute('SELECT size, mtime, fp FROM fingerprints WHERE path = ?', (rel,)).fetchone()
+        if row is not None and row['size'] == st.st_size and row['mtime'] == st.st_mtime:
+            return row['fp']
+    except sqlite3.Error as e:
+        print(f"⚠️  Ошибка чтения отпечатка {rel}: {e}")
+    
+    fp = _fingerprint_read(full_path, st.st_size)
+    try:
+        with index_transaction() as conn:
+            conn.execute('INSERT INTO fingerprints (path, size, mtime, fp) VALUES (?, ?, ?, ?) '
+                         'ON CONFLICT(path) DO UPDATE SET size = excluded.size, '
+                         'mtime = excluded.mtime, fp = excluded.fp',
+                         (rel, st.st_size, st.st_mtime, fp))
+    except sqlite3.Error as e:
+        print(f"⚠️  Ошибка записи отпечатка {rel}: {e}")
+    return fp
+
+def _thumb_cache_unlink(files):
+    """Удалить файлы кеша (уже вычеркнутые из учёта)"""
+    for name in files:
+        path = os.path.join(THUMBNAIL_CACHE_FOLDER, name)
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)  # Рабочая папка прерванного перекодирования
+            else:
+                os.remove(path)
+        except OSError:
+            pass
+
+def _thumb_cache_evict(conn, max_bytes, video=False):
+    """Вычеркнуть из учёта самые давние миниатюры сверх бюджета (внутри транзакции)
+    
+    video=True - то же для копий видео (свой бюджет): копия и HLS одного видео
+    вытесняются вместе.
+    """
+    scope = TRANSCODE_FILES_SQL if video else f'NOT {TRANSCODE_FILES_SQL}'
+    total = conn.execute(f'SELECT COALESCE(SUM(bytes), 0) FROM thumbs WHERE {scope}').fetchone()[0]
+    if total <= max_bytes:
+        return []
+
+    to_free = total - int(max_bytes * 0.9)
+    victims = []
+    if video:
+        groups = conn.execute(f'SELECT fp, SUM(bytes) AS bytes FROM thumbs WHERE {scope} '
+                              f'GROUP BY fp ORDER BY MAX(atime)').fetchall()
+        for row in groups:
+            if to_free <= 0:
+                break
+            victims.extend(r['file'] for r in conn.execute(
+                f'SELECT file FROM thumbs WHERE fp = ? AND {scope}', (row['fp'],)))
+            to_free -= row['bytes']
+    else:
+        for row in conn.execute(f'SELECT file, bytes FROM thumbs WHERE {scope} ORDER BY atime'):
+            if to_free <= 0:
+                break
+            victims.append(row['file'])
+            to_free -= row['bytes']
+    conn.executemany('DELETE FROM thumbs WHERE file = ?', [(name,) for name in victims])
+    return victims
+
+def _thumb_cache_unreferenced(conn, fps=None):
+    """Вычеркнуть из учёта миниатюры, на отпечатки которых не ссылается ни один путь
+    
+    fps ограничивает проверку этими отпечатками (None - проверить весь кеш).
+    """
+    query = ('SELECT file FROM thumbs WHERE NOT EXISTS '
+             '(SELECT 1 FROM fingerprints WHERE fingerprints.fp = thumbs.fp)')
+    if fps is None:
+        files = [row['file'] for row in conn.execute(query)]
+    else:
+        files = [row['file'] for fp in fps for row in conn.execute(query + ' AND thumbs.fp = ?', (fp,))]
+    conn.executemany('DELETE FROM thumbs WHERE file = ?', [(name,) for name in files])
+    return files
+
+def thumb_cache_record(cache_path):
+    """Учесть свежую миниатюру (или копию видео) и при переполнении кеша освободить место"""
+    fp = os.path.basename(cache_path)[:32]  # Имя файла кеша начинается с отпечатка
+    try:
+        size = os.path.getsize(cache_path)
+        with index_transaction() as conn:
+            conn.execute('INSERT INTO thumbs (file, fp, bytes, atime) VALUES (?, ?, ?, ?) '
+                         'ON CONFLICT(file) DO UPDATE SET fp = excluded.fp, '
+                         'bytes = excluded.bytes, atime = excluded.atime',
+                         (os.path.basename(cache_path), fp, size, time.time()))
+            if TRANSCODE_NAME.match(os.path.basename(cache_path)):
+                victims = _thumb_cache_evict(conn, TRANSCODE_CACHE_MAX_BYTES, video=True)
+            else:
+                victims = _thumb_cache_evict(conn, THUMBNAIL_CACHE_MAX_BYTES)
+    except (sqlite3.Error, OSError) as e:
+        print(f"⚠️  Ошибка учёта кеша миниатюр: {e}")
+        return
+
+    _thumb_cache_unlink(victims)
+    if victims:
+        with _thumb_lock:
+            thumb_stats['evicted'] += len(victims)
+        metric_inc('cloud_thumbnail_evictions_total', len(victims))
+
+def thumb_cache_hit(cache_path):
+    """Отметить обращение к миниатюре из кеша (для вытеснения давно не открытых)"""
+    name = os.path.basename(cache_path)
+    with _thumb_lock:
+        thumb_stats['hits'] += 1
+    try:
+        row = get_index_db().execute('SELECT atime FROM thumbs WHERE file = ?', (name,)).fetchone()
+        if row is None:
+            thumb_cache_record(cache_path)  # Файл из кеша, созданного до учёта
+        elif time.time() - row['atime'] > THUMB_TOUCH_INTERVAL:
+            with index_transaction() as conn:
+                conn.execute('UPDATE thumbs SET atime = ? WHERE file = ?', (time.time(), name))
+    except sqlite3.Error as e:
+        print(f"⚠️  Ошибка учёта кеша миниатюр: {e}")
+
+def thumb_cache_forget(rel, is_dir=False):
+    """Забыть отпечатки удалённого файла (или всех файлов папки)
+    
+    Миниатюры удаляются, если их содержимое больше нигде не лежит.
+    """
+    try:
+        with index_transaction() as conn:
+            if is_dir:
+                low, high = _subtree_range(rel)
+                where, args = 'path >= ? AND path < ?', (low, high)
+            else:
+                where, args = 'path = ?', (rel,)
+            fps = {row['fp'] for row in conn.execute(f'SELECT fp FROM fingerprints WHERE {where}', args)}
+            conn.execute(f'DELETE FROM fingerprints WHERE {where}', args)
+            files = _thumb_cache_unreferenced(conn, fps)
+    except sqlite3.Error as e:
+        print(f"⚠️  Ошибка учёта кеша миниатюр: {e}")
+        return
+
+    _thumb_cache_unlink(files)
+    if files:
+        with _thumb_lock:
+            thumb_stats['orphans'] += len(files)
+
+def thumb_cache_sweep():
+    """Сверить кеш миниатюр с диском и хранилищем
+    
+    Забывает отпечатки удалённых и изменённых файлов, удаляет миниатюры, на
+    которые больше никто не ссылается, старые .tmp/.lock и миниатюры в старом
+    формате имён. Файлы кеша без учёта (например, после пересоздания базы) берёт
+    на учёт - отпечаток записан в самом имени.
+    
+    Returns:
+        dict с числом удалённых сирот, мусорных файлов, вытесненных и подобранных миниатюр
+    """
+    now = time.time()
+    conn = get_index_db()
+    # Учёт читаем до листинга: запись в thumbs появляется только после файла
+    known = {row['file'] for row in conn.execute('SELECT file FROM thumbs')}
+    try:
+        names = os.listdir(THUMBNAIL_CACHE_FOLDER)
+    except FileNotFoundError:
+        names = []
+
+    junk = []
+    adopt = []
+    for name in names:
+        if name in known:
+            continue
+        try:
+            st = os.stat(os.path.join(THUMBNAIL_CACHE_FOLDER, name))
+        except OSError:
+            continue
+        match = THUMB_CACHE_NAME.match(name)
+        if match:
+            adopt.append((name, match.group(1), st.st_size, st.st_mtime))
+        elif THUMB_LEGACY_NAME.match(name) or (name.endswith(('.tmp', '.lock')) and now - st.st_mtime > (
+                TRANSCODE_TIMEOUT if '_proxy.' in name or '_hls.' in name else THUMBNAIL_TIMEOUT)):
+            junk.append(name)
+
+    present = set(names)
+    vanished = [name for name in known if name not in present]
+    stale = []
+    for row in conn.execute('SELECT path, size, mtime FROM fingerprints'):
+        try:
+            st = os.stat(storage_path(row['path']))
+            if st.st_size != row['size'] or st.st_mtime != row['mtime']:
+                stale.append(row['path'])
+        except OSError:
+            stale.append(row['path'])
+
+    with index_transaction() as conn:
+        conn.executemany('INSERT OR IGNORE INTO thumbs (file, fp, bytes, atime) VALUES (?, ?, ?, ?)', adopt)
+        conn.executemany('DELETE FROM thumbs WHERE file = ?', [(name,) for name in vanished])
+        conn.executemany('DELETE FROM fingerprints WHERE path = ?', [(path,) for path in stale])
+        orphans = _thumb_cache_unreferenced(conn)
+        # Бюджет мог уменьшиться в настройках
+        evicted = (_thumb_cache_evict(conn, THUMBNAIL_CACHE_MAX_BYTES)
+                   + _thumb_cache_evict(conn, TRANSCODE_CACHE_MAX_BYTES, video=True))
+
+    _thumb_cache_unlink(orphans + junk + evicted)
+    with _thumb_lock:
+        thumb_stats['orphans'] += len(orphans)
+        thumb_stats['evicted'] += len(evicted)
+    metric_inc('cloud_thumbnail_evictions_total', len(evicted))
+    return {'orphans': len(orphans), 'junk': len(junk), 'evicted': len(evicted), 'adopted': len(adopt)}
+
+def _thumb_sweeper_loop():
+    while True:
+        try:
+            if claim_periodic_job('thumb_sweep', THUMBNAIL_SWEEP_INTERVAL):
+                result = thumb_cache_sweep()
+                if any(result.values()):
+                    print(f"🧹 Чистка кеша миниатюр: сирот {result['orphans']}, мусора {result['junk']}, "
+                          f"вытеснено {result['evicted']}, взято на учёт {result['adopted']}")
+        except Exception as e:
+            print(f"⚠️  Ошибка чистки кеша миниатюр: {e}")
+        time.sleep(min(60, THUMBNAIL_SWEEP_INTERVAL))
+
+def start_thumb_sweeper():
+    """Запустить фоновую чистку кеша миниатюр (одну на процесс)"""
+    global _thumb_sweeper_pid
+    with _thumb_lock:
+        if _thumb_sweeper_pid == os.getpid():
+            return
+        _thumb_sweeper_pid = os.getpid()
+    threading.Thread(target=_thumb_sweeper_loop, name='thumb-sweeper', daemon=True).start()
+
+# ==================== Прогрев миниатюр ====================
+# Загруженные фото и видео ставятся в фоновую очередь, которая заранее рисует
+# миниатюры для списка и плитки, чтобы первый открывший папку не ждал. Очередь
+# разбита по папкам: папка, которую сейчас открыли (browse или /api/list),
+# прогревается первой. Задачи выполняются по одной, так что прогрев занимает
+# не больше одного места в пуле миниатюр и не отнимает его у запросов страниц.
+
+PREWARM_SIZES = (64, 200)  # Список и плитка; 1280 рисуется только при просмотре
+PREWARM_FORMAT = 'webp' if WEBP_AVAILABLE else 'jpeg'  # Формат, который запросит большинство браузеров
+
+_prewarm_cond = threading.Condition()
+_prewarm_queue = {}  # папка -> deque путей файлов (в порядке постановки)
+_prewarm_focus = None
+_prewarm_pid = None
+prewarm_stats = {
+    'queued': 0,
+    'warmed': 0,
+    'failed': 0,
+}
+
+def thumbnail_kind(path):
+    """'image' или 'video', если для файла рисуется миниатюра, иначе None"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext in THUMB_IMAGE_EXTENSIONS:
+        return 'image'
+    if ext in THUMB_VIDEO_EXTENSIONS:
+        return 'video'
+    return None
+
+def thumbnail_cache_path(full_path, size, fmt, fp=None):
+    """Путь файла миниатюры в кеше
+    
+    Имя - отпечаток содержимого: переименование и перенос не теряют миниатюру,
+    а у каждого размера и формата свой файл. fp - уже посчитанный отпечаток.
+    """
+    ext = 'webp' if fmt == 'webp' else 'jpg'
+    return os.path.join(THUMBNAIL_CACHE_FOLDER, f"{fp or file_fingerprint(full_path)}_{size}.{ext}")
+
+def warm_thumbnail(full_path, sizes=PREWARM_SIZES, fmt=PREWARM_FORMAT):
+    """Нарисовать недостающие миниатюры файла (кадр-постер для видео)
+    
+    Заодно, пока файл в кеше ОС, запоминаются его метаданные.
+    """
+    media_metadata(full_path)
+    is_video = thumbnail_kind(full_path) == 'video'
+    if is_video and not OPENCV_AVAILABLE:
+        return
+    for size in sizes:
+        cache_path = thumbnail_cache_path(full_path, size, fmt)
+        if is_video and os.path.exists(video_failed_marker(cache_path)):
+            return
+        if not os.path.exists(cache_path):
+            if not generate_thumbnail(full_path, cache_path, is_video, size, fmt):
+                return  # Из видео не читается кадр - другие размеры не получатся тоже
+
+def prewarm_thumbnails(full_path):
+    """Поставить миниатюры нового файла в фоновую очередь прогрева"""
+    rel = rel_path(full_path)
+    if not rel or thumbnail_kind(full_path) is None:
+        return
+    with _prewarm_cond:
+        _prewarm_queue.setdefault(_parent_rel(rel), deque()).append(rel)
+        prewarm_stats['queued'] += 1
+        _prewarm_cond.notify()
+    _start_prewarm_worker()
+
+def prewarm_focus(rel):
+    """Запомнить папку, которую сейчас смотрят - её миниатюры прогреваются первыми"""
+    global _prewarm_focus
+    _prewarm_focus = rel
+
+def prewarm_pending():
+    """Сколько файлов ждёт прогрева"""
+    with _prewarm_cond:
+        return sum(len(paths) for paths in _prewarm_queue.values())
+
+def _prewarm_take():
+    """Взять следующий файл: из открытой сейчас папки, иначе из самой давней"""
+    with _prewarm_cond:
+        while not _prewarm_queue:
+            _prewarm_cond.wait()
+        folder = _prewarm_focus if _prewarm_focus in _prewarm_queue else next(iter(_prewarm_queue))
+        paths = _prewarm_queue[folder]
+        rel = paths.popleft()
+        if not paths:
+            del _prewarm_queue[folder]
+        return folder, rel
+
+def _prewarm_loop():
+    while True:
+        folder, rel = _prewarm_take()
+        try:
+            warm_thumbnail(storage_path(rel))
+            prewarm_stats['warmed'] += 1
+        except ThumbnailQueueFull:
+            # Пул занят запросами страниц - возвращаем файл в начало очереди и ждём
+            with _prewarm_cond:
+                _prewarm_queue.setdefault(folder, deque()).appendleft(rel)
+            time.sleep(1)
+        except FileNotFoundError:
+            pass  # Файл успели удалить или переименовать
+        except Exception as e:
+            prewarm_stats['failed'] += 1
+            print(f"⚠️  Ошибка прогрева миниатюр {rel}: {e}")
+
+def _start_prewarm_worker():
+    """Запустить фоновый поток прогрева (один на процесс)"""
+    global _prewarm_pid
+    with _prewarm_cond:
+        if _prewarm_pid == os.getpid():
+            return
+        _prewarm_pid = os.getpid()
+    threading.Thread(target=_prewarm_loop, name='thumb-prewarm', daemon=True).start()
+
+def _prewarm_one(full_path):
+    try:
+        warm_thumbnail(full_path)
+        return True
+    except Exception as e:
+        print(f"⚠️  {rel_path(full_path)}: {e}")
+        return False
+
+def prewarm_storage():
+    """Прогреть миниатюры всего хранилища (python app.py --prewarm)"""
+    paths = []
+    for root, dirs, files in os.walk(app.config['UPLOAD_FOLDER']):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        paths.extend(os.path.join(root, name) for name in files if thumbnail_kind(name))
+    
+    print(f"🔥 Прогрев миниатюр: {len(paths)} файлов, {THUMBNAIL_WORKERS} воркер(ов)")
+    started = time.time()
+    failed = 0
+    # Каждый поток ждёт свою задачу в пуле миниатюр - очередь не переполнится
+    with ThreadPoolExecutor(max_workers=min(THUMBNAIL_WORKERS, THUMBNAIL_QUEUE_LIMIT)) as pool:
+        for done, ok in enumerate(pool.map(_prewarm_one, paths), 1):
+            failed += not ok
+            if done % 100 == 0 or done == len(paths):
+                print(f"   {done}/{len(paths)} ({time.time() - started:.0f} с)")
+    print(f"✅ Прогрев завершён за {time.time() - started:.1f} с, ошибок: {failed}")
+
+# ==================== Наблюдение за хранилищем ====================
+# Файлы, скопированные в storage/ в обход приложения (adb, Syncthing, rsync),
+# попадают в индекс без ожидания чтения папки. Поток наблюдения запускает
+# только процесс, занявший роль 'storage_watcher' в index_meta (под gunicorn -
+# один воркер; остальные раз в WATCHER_POLL секунд на запросах проверяют, не
+# освободилась ли роль). Если установлен watchdog, он получает события inotify. События копятся, пока в storage не
+# станет тихо на WATCHER_DEBOUNCE секунд (копирование тысячи фото - одна пачка),
+# и применяются разом: переносы сохраняют отпечатки, метаданные и миниатюры,
+# у удалённых файлов они забываются, затронутые папки пересчитываются через
+# scandir, новые фото и видео ставятся в прогрев миниатюр.
+#
+# Раз в WATCHER_RECONCILE_INTERVAL (и без watchdog тоже) всё хранилище
+# сверяется с диском: пересчитываются только папки с изменившимся mtime.
+
+WATCHER_LEASE_TTL = 30  # Секунд без продления, после которых роль наблюдателя занимает другой процесс
+WATCHER_POLL = 5  # Секунд между проверками роли и сверки
+
+_watch_cond = threading.Condition()
+_watch_moves = []  # (старый путь, новый путь) в порядке событий
+_watch_removed = {}  # путь -> была ли это папка
+_watch_dirty = set()  # папки, содержимое которых изменилось
+_watch_touched = set()  # созданные и изменённые файлы
+_watch_first = None  # Время первого и последнего события текущей пачки
+_watch_last = None
+_watcher_pid = None  # Процесс, в котором работает поток наблюдения
+_watcher_checked_at = 0  # Когда этот процесс последний раз пробовал занять роль
+_watcher_start_lock = threading.Lock()
+watcher_stats = {
+    'events': 0,
+    'batches': 0,
+    'reconciles': 0,
+    'active': False,
+}
+
+def _watch_rel(path):
+    """Путь события относительно хранилища (None для корня, служебных папок и путей вне storage)"""
+    rel = rel_path(path)
+    if not rel or rel == INGEST_FOLDER or rel.startswith(INGEST_FOLDER + '/'):
+        return None
+    return rel
+
+class StorageEventHandler:
+    """Обработчик watchdog: только складывает события в пачку"""
+    
+    def dispatch(self, event):
+        global _watch_first, _watch_last
+        kind = event.event_type
+        if kind not in ('created', 'modified', 'closed', 'deleted', 'moved'):
+            return
+        src = _watch_rel(event.src_path)
+        with _watch_cond:
+            if kind == 'moved':
+                dest = _watch_rel(event.dest_path)
+                if src and dest:
+                    _watch_moves.append((src, dest))
+                elif src:
+                    _watch_removed[src] = event.is_directory
+                if dest and not event.is_directory:
+                    # В том числе файл, принятый загрузкой (из .incoming)
+                    _watch_touched.add(dest)
+                _watch_dirty.update(_parent_rel(path) for path in (src, dest) if path)
+            elif event.is_directory and kind != 'deleted':
+                if kind == 'created' and src:
+                    _watch_dirty.add(_parent_rel(src))
+                elif kind == 'modified':
+                    # Изменился список папки (корень тоже считается)
+                    rel = rel_path(event.src_path)
+                    if rel is None or (rel and src is None):
+                        return
+                    _watch_dirty.add(rel)
+            elif src:
+                if kind == 'deleted':
+                    _watch_removed[src] = event.is_directory
+                else:
+                    _watch_touched.add(src)
+                _watch_dirty.add(_parent_rel(src))
+            else:
+                return
+            now = time.time()
+            _watch_first = _watch_first or now
+            _watch_last = now
+            watcher_stats['events'] += 1
+            _watch_cond.notify()
+
+def _watch_take(timeout):
+    """Дождаться пачки событий (после тишины WATCHER_DEBOUNCE) и забрать её, или None по таймауту"""
+    global _watch_moves, _watch_removed, _watch_dirty, _watch_touched, _watch_first, _watch_last
+    deadline = time.time() + timeout
+    with _watch_cond:
+        while True:
+            now = time.time()
+            if _watch_first is not None:
+                ready = min(_watch_last + WATCHER_DEBOUNCE, _watch_first + WATCHER_MAX_DELAY)
+                if now >= ready:
+                    batch = (_watch_moves, _watch_removed, _watch_dirty, _watch_touched)
+                    _watch_moves, _watch_removed, _watch_dirty, _watch_touched = [], {}, set(), set()
+                    _watch_first = _watch_last = None
+                    return batch
+                wait = ready - now
+            else:
+                wait = deadline - now
+            if now >= deadline:
+                return None
+            _watch_cond.wait(min(wait, deadline - now))
+
+def apply_storage_changes(moves, removed, dirty, touched):
+    """Применить пачку изменений в storage к индексу и кешам"""
+    if _index_get('') is None:
+        return  # Индекс ещё не построен - будет построен при первом чтении
+    for old, new in moves:
+        index_path_renamed(storage_path(old), storage_path(new))
+    for rel, is_dir in removed.items():
+        if not os.path.exists(storage_path(rel)):
+            index_forget_content(rel, is_dir)
+    
+    # Папки, которых ещё нет в индексе, посчитает пересканирование ближайшего известного предка
+    folders = set()
+    for rel in dirty:
+        while rel is not None and _index_get(rel) is None:
+            rel = _parent_rel(rel)
+        if rel is not None:
+            folders.add(rel)
+    # Сначала самые глубокие, чтобы родители суммировали уже свежих потомков
+    for rel in sorted(folders, key=lambda p: p.count('/') + (1 if p else 0), reverse=True):
+        if os.path.isdir(storage_path(rel)):
+            # Не _index_refresh: содержимое файла могло смениться без смены mtime папки
+            _index_rescan(rel)
+    
+    for rel in touched:
+        if os.path.isfile(storage_path(rel)):
+            prewarm_thumbnails(storage_path(rel))
+    watcher_stats['batches'] += 1
+
+def reconcile_storage():
+    """Сверить индекс всего хранилища с диском и убрать записи о пропавших файлах
+    
+    Читаются только папки (scandir), у которых изменился mtime; файлы,
+    изменённые на месте без смены mtime папки, подхватит наблюдатель.
+    """
+    if _index_get('') is None:
+        return
+    _index_revalidate('')
+    with index_transaction() as conn:
+        conn.execute('DELETE FROM media WHERE path NOT IN (SELECT path FROM entries)')
+        conn.execute('DELETE FROM content_hashes WHERE path NOT IN (SELECT path FROM entries)')
+    watcher_stats['reconciles'] += 1
+
+def _start_observer():
+    """Запустить наблюдение watchdog за storage (None, если inotify недоступен)"""
+    try:
+        observer = Observer()
+        observer.schedule(StorageEventHandler(), app.config['UPLOAD_FOLDER'], recursive=True)
+        observer.daemon = True
+        observer.start()
+        print("👀 Наблюдение за storage включено")
+        return observer
+    except OSError as e:
+        # Например, исчерпан fs.inotify.max_user_watches - остаётся периодическая сверка
+        print(f"⚠️  Не удалось включить наблюдение за storage: {e}")
+        return None
+
+def _storage_watcher_loop():
+    """Поток наблюдения: работает, пока процесс продлевает роль 'storage_watcher'"""
+    global _watcher_pid
+    observer = None
+    observer_failed = False
+    while True:
+        try:
+            if not claim_lease('storage_watcher', WATCHER_LEASE_TTL):
+                # Роль занял другой процесс (этот, например, надолго засыпал)
+                if observer is not None:
+                    observer.stop()
+                watcher_stats['active'] = False
+                _watcher_pid = None
+                return
+            if WATCHDOG_AVAILABLE and observer is None and not observer_failed:
+                observer = _start_observer()
+                observer_failed = observer is None
+            watcher_stats['active'] = observer is not None
+            
+            batch = _watch_take(WATCHER_POLL)
+            if batch is not None:
+                apply_storage_changes(*batch)
+            if claim_periodic_job('storage_reconcile', WATCHER_RECONCILE_INTERVAL):
+                reconcile_storage()
+        except Exception as e:
+            print(f"⚠️  Ошибка обновления индекса по изменениям в storage: {e}")
+            time.sleep(WATCHER_POLL)
+
+@app.before_request
+def start_storage_watcher():
+    """Запустить наблюдение за storage и периодическую сверку, если роль свободна
+    
+    Поток работает в одном процессе на всё хранилище; остальные процессы
+    пробуют занять роль не чаще раза в WATCHER_POLL секунд.
+    """
+    global _watcher_pid, _watcher_checked_at
+    if _watcher_pid == os.getpid() or time.time() - _watcher_checked_at < WATCHER_POLL:
+        return
+    with _watcher_start_lock:
+        if _watcher_pid == os.getpid() or time.time() - _watcher_checked_at < WATCHER_POLL:
+            return
+        _watcher_checked_at = time.time()
+        try:
+            if not claim_lease('storage_watcher', WATCHER_LEASE_TTL):
+                return
+        except sqlite3.Error:
+            return  # База занята - попробуем на одном из следующих запросов
+        _watcher_pid = os.getpid()
+    threading.Thread(target=_storage_watcher_loop, name='storage-watcher', daemon=True).start()
+
+@app.route('/sw.js')
+def service_worker():
+    """Service Worker из корня сайта: из /static/ он видел бы только запросы к /static/"""
+    response = app.send_static_file('sw.js')
+    response.headers['Cache-Control'] = REVALIDATE_CACHE_CONTROL
+    return response
+
+@app.route('/')
+def index():
+    return redirect(url_for('browse', path=''))
+
+@app.route('/browse/')
+@app.route('/browse/<path:path>')
+def browse(path=''):
+    """Просмотр файлов и папок"""
+    full_path = os.path.join(app.config['UPLOAD_FOLDER'], path)
+    
+    if not os.path.exists(full_path):
+        flash('Папка не найдена!', 'error')
+        return redirect(url_for('index'))
+    
+    if os.path.isfile(full_path):
+        return serve_file(full_path, as_attachment=True)
+    
+    rel = rel_path(full_path)
+    try:
+        stats = folder_stats(rel)
+    except PermissionError:
+        flash('Нет доступа к этой папке!', 'error')
+        return redirect(url_for('index'))
+    if stats is None:
+        flash('Папка не найдена!', 'error')
+        return redirect(url_for('index'))
+    
+    # Только первая страница: остальное шаблон подгружает через /api/list при прокрутке.
+    # Порядок: сначала папки (FOLDER_ORDER, потом по алфавиту), потом файлы (новые первые)
+    prewarm_focus(rel)
+    items, next_cursor = list_directory_page(rel, limit=LIST_PAGE_SIZE)
+    
+    # Путь для навигации
+    breadcrumbs = []
+    parent_path = ''
+    if path:
+        parts = path.split('/')
+        current = ''
+        for i, part in enumerate(parts):
             current = os.path.join(current, part).replace('\\', '/')
             breadcrumbs.append({'name': part, 'path': current})
         
@@ -355,17 +2811,46 @@ def browse(path=''):
             parent_path = '/'.join(parts[:-1])
         # Если только одна папка, то родитель - корень
     
-    # Подсчет статистики (включая размер папок)
-    total_size = sum(item['size'] for item in items)
-    
+    # Статистика по всей папке берётся из индекса, а не из первой страницы
     return render_template('index.html', 
                          items=items, 
+                         next_cursor=next_cursor,
+                         list_url=url_for('api_list', path=rel),
+                         page_size=LIST_PAGE_SIZE,
                          current_path=path,
                          parent_path=parent_path,
                          breadcrumbs=breadcrumbs,
-                         total_size=format_size(total_size),
-                         total_files=len([i for i in items if not i['is_dir']]),
-                         total_folders=len([i for i in items if i['is_dir']]))
+                         total_size=format_size(stats['size']),
+                         total_files=stats['own_files'],
+                         total_folders=count_subfolders(rel))
+
+@app.route('/api/list/')
+@app.route('/api/list/<path:path>')
+def api_list(path=''):
+    """API постраничного списка папки (JSON, курсор в параметре cursor)"""
+    rel = rel_path(os.path.join(app.config['UPLOAD_FOLDER'], path))
+    if folder_stats(rel) is None:
+        return jsonify({'error': 'Папка не найдена'}), 404
+    
+    try:
+        limit = max(1, min(int(request.args.get('limit', LIST_PAGE_SIZE)), SEARCH_MAX_LIMIT))
+    except ValueError:
+        limit = LIST_PAGE_SIZE
+    
+    try:
+        items, next_cursor = list_directory_page(rel, request.args.get('cursor'), limit)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    prewarm_focus(rel)
+    return jsonify({'path': rel, 'items': items, 'next_cursor': next_cursor})
+
+def flash_duplicates(skipped_count, linked_count):
+    """Сообщить о загруженных повторно файлах"""
+    if skipped_count:
+        flash(f'Пропущено файлов, которые уже есть в облаке: {skipped_count}', 'info')
+    if linked_count:
+        flash(f'Сохранено без лишней копии (такие файлы уже были в других папках): {linked_count}', 'info')
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
@@ -381,6 +2866,8 @@ def upload_file():
     uploaded_count = 0
     photo_count = 0
     video_count = 0
+    skipped_count = 0
+    linked_count = 0
     
     for file in files:
         if file and file.filename:
@@ -391,74 +2878,37 @@ def upload_file():
                 is_image = ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp']
                 is_video = ext in ['.mp4', '.avi', '.mkv', '.mov', '.wmv', '.flv', '.webm']
                 
-                if is_image:
-                    # Сохраняем временно для анализа EXIF
-                    temp_path = os.path.join(upload_path, filename)
-                    file.save(temp_path)
-                    
-                    # Переименовываем если имя длинное (> 20 символов)
-                    temp_path = rename_by_date_if_long(temp_path, max_length=20)
-                    filename = os.path.basename(temp_path)  # Обновляем имя файла
-                    
-                    # Определяем путь для сохранения: Фото/Год/Месяц
-                    photo_dest_path = get_photo_destination_path(temp_path)
-                    full_dest_path = os.path.join(app.config['UPLOAD_FOLDER'], photo_dest_path)
-                    
-                    # Создаем структуру папок если её нет
-                    os.makedirs(full_dest_path, exist_ok=True)
-                    
-                    # Перемещаем файл в нужную папку
-                    final_path = os.path.join(full_dest_path, filename)
-                    
-                    # Если файл уже существует, добавляем номер
-                    if os.path.exists(final_path):
-                        name, ext = os.path.splitext(filename)
-                        counter = 1
-                        while os.path.exists(final_path):
-                            final_path = os.path.join(full_dest_path, f"{name}_{counter}{ext}")
-                            counter += 1
-                    
-                    shutil.move(temp_path, final_path)
-                    photo_count += 1
-                    uploaded_count += 1
-                    
-                elif is_video:
-                    # Сохраняем временно
-                    temp_path = os.path.join(upload_path, filename)
-                    file.save(temp_path)
-                    
-                    # Переименовываем если имя длинное (> 20 символов)
-                    temp_path = rename_by_date_if_long(temp_path, max_length=20)
-                    filename = os.path.basename(temp_path)  # Обновляем имя файла
-                    
-                    # Определяем путь для сохранения: Видео/Год/Месяц
-                    video_dest_path = get_video_destination_path(temp_path)
-                    full_dest_path = os.path.join(app.config['UPLOAD_FOLDER'], video_dest_path)
+                if is_image or is_video:
+                    # Дата съемки уже прочитана из начала потока (для видео - время загрузки)
+                    date_obj = ingest_date(file, is_image)
                     
-                    # Создаем структуру папок если её нет
-                    os.makedirs(full_dest_path, exist_ok=True)
-                    
-                    # Перемещаем файл в нужную папку
-                    final_path = os.path.join(full_dest_path, filename)
-                    
-                    # Если файл уже существует, добавляем номер
-                    if os.path.exists(final_path):
-                        name, ext = os.path.splitext(filename)
-                        counter = 1
-                        while os.path.exists(final_path):
-                            final_path = os.path.join(full_dest_path, f"{name}_{counter}{ext}")
-                            counter += 1
-                    
-                    shutil.move(temp_path, final_path)
-                    video_count += 1
+                    # Путь Фото/Год/Месяц или Видео/Год/Месяц (если имя занято, добавляется номер)
+                    final_path = auto_sort_destination(filename, date_obj, is_image)
+                    stored, original = store_upload(file, final_path)
+                    if not stored:
+                        skipped_count += 1
+                        continue
+                    linked_count += original is not None
+                    index_path_added(final_path)
+                    prewarm_thumbnails(final_path)
+                    if is_image:
+                        photo_count += 1
+                    else:
+                        video_count += 1
                     uploaded_count += 1
                     
                 else:
                     # Обычные файлы сохраняем в текущую папку
                     filepath = os.path.join(upload_path, filename)
-                    file.save(filepath)
+                    stored, original = store_upload(file, filepath)
+                    if not stored:
+                        skipped_count += 1
+                        continue
+                    linked_count += original is not None
+                    index_path_added(filepath)
                     uploaded_count += 1
     
+    flash_duplicates(skipped_count, linked_count)
     if photo_count > 0 or video_count > 0:
         message_parts = []
         if photo_count > 0:
@@ -472,48 +2922,562 @@ def upload_file():
     return redirect(url_for('browse', path=current_path))
 
 
-@app.route('/upload_direct', methods=['POST'])
-def upload_direct():
-    """Загрузка файлов без автосортировки (в текущую папку)"""
-    if 'file' not in request.files:
-        flash('Файл не выбран!', 'error')
-        return redirect(request.referrer)
+@app.route('/upload_direct', methods=['POST'])
+def upload_direct():
+    """Загрузка файлов без автосортировки (в текущую папку)"""
+    if 'file' not in request.files:
+        flash('Файл не выбран!', 'error')
+        return redirect(request.referrer)
+    
+    files = request.files.getlist('file')
+    current_path = request.form.get('current_path', '')
+    upload_path = os.path.join(app.config['UPLOAD_FOLDER'], current_path)
+    
+    # Создаем папку если её нет
+    os.makedirs(upload_path, exist_ok=True)
+    
+    uploaded_count = 0
+    skipped_count = 0
+    linked_count = 0
+    
+    for file in files:
+        if file and file.filename:
+            filename = safe_filename(file.filename)
+            if filename:
+                # Переименовываем если имя длинное (для изображений и видео)
+                _, ext = os.path.splitext(filename.lower())
+                if ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp', '.mp4', '.avi', '.mkv', '.mov', '.wmv', '.flv', '.webm']:
+                    is_image = ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp']
+                    filename = shorten_name_by_date(filename, ingest_date(file, is_image), max_length=20)
+                
+                # Если файл уже существует, добавляем номер
+                filepath = unique_path(upload_path, filename)
+                stored, original = store_upload(file, filepath)
+                if not stored:
+                    skipped_count += 1
+                    continue
+                linked_count += original is not None
+                index_path_added(filepath)
+                prewarm_thumbnails(filepath)
+                uploaded_count += 1
+    
+    flash_duplicates(skipped_count, linked_count)
+    flash(f'Успешно загружено файлов: {uploaded_count}', 'success')
+    return redirect(url_for('browse', path=current_path))
+
+
+# ==================== Загрузка частями ====================
+# Протокол в духе tus для больших файлов (видео с телефона на несколько ГБ):
+#   POST   /api/uploads              {filename, size, current_path, sort} → 201 + Location
+#   HEAD   /api/uploads/<id>         → Upload-Offset, Upload-Length
+#   PATCH  /api/uploads/<id>         часть файла с позиции Upload-Offset (необязательно
+#                                    Upload-Checksum: sha256 <base64>) → 204 + Upload-Offset
+#   POST   /api/uploads/<id>/finish  файл раскладывается как в /upload (sort) или /upload_direct
+#   DELETE /api/uploads/<id>         отмена
+# Части дописываются в storage/.incoming/<id>.part, описание загрузки лежит рядом
+# в <id>.json - загрузку можно продолжить и после перезапуска сервера. Обрыв
+# связи стоит только текущей части, а воркер занят ровно на время одной части.
+
+UPLOAD_ID = re.compile(r'^[0-9a-f]{32}$')
+UPLOAD_CHECKSUMS = {'md5': hashlib.md5, 'sha1': hashlib.sha1, 'sha256': hashlib.sha256}
+UPLOAD_LOCK_TIMEOUT = 600  # Блокировка упавшего воркера считается брошенной через 10 минут
+UPLOAD_READ_BLOCK = 1024 * 1024
+
+# SHA-256 принятых частей: id → (сколько байт учтено, hashlib-объект). Состояние
+# hashlib не сохранить на диск, поэтому оно живёт в памяти процесса, который
+# принимал части подряд; завершая загрузку, дочитывается только то, что принял
+# другой воркер или процесс до перезапуска
+_upload_digests = {}
+_upload_digests_lock = threading.Lock()
+
+def _upload_paths(upload_id):
+    """Пути файла частей и описания загрузки"""
+    directory = os.path.join(app.config['UPLOAD_FOLDER'], INGEST_FOLDER)
+    return os.path.join(directory, f'{upload_id}.part'), os.path.join(directory, f'{upload_id}.json')
+
+def load_upload(upload_id):
+    """Описание загрузки частями с текущим смещением (None, если такой нет)"""
+    if not UPLOAD_ID.match(upload_id):
+        return None
+    part_path, meta_path = _upload_paths(upload_id)
+    try:
+        with open(meta_path, encoding='utf-8') as f:
+            meta = json.load(f)
+        meta['offset'] = os.path.getsize(part_path)
+    except (OSError, ValueError):
+        return None
+    return meta
+
+@contextmanager
+def upload_lock(upload_id):
+    """Межпроцессная блокировка загрузки (yield False, если она уже занята)"""
+    lock_path = _upload_paths(upload_id)[0] + '.lock'
+    try:
+        os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        try:
+            if time.time() - os.path.getmtime(lock_path) <= UPLOAD_LOCK_TIMEOUT:
+                yield False
+                return
+        except OSError:
+            pass
+        # Блокировка упавшего воркера - забираем её себе
+        with open(lock_path, 'w'):
+            pass
+    try:
+        yield True
+    finally:
+        try:
+            os.remove(lock_path)
+        except OSError:
+            pass
+
+def cleanup_stale_uploads():
+    """Удалить брошенные загрузки и обрывки в .incoming старше UPLOAD_EXPIRE"""
+    directory = os.path.join(app.config['UPLOAD_FOLDER'], INGEST_FOLDER)
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return
+    now = time.time()
+    for name in names:
+        path = os.path.join(directory, name)
+        # Описание живёт, пока в загрузку дописываются части
+        activity_path = path[:-len('.json')] + '.part' if name.endswith('.json') else path
+        try:
+            expired = now - os.path.getmtime(activity_path) > UPLOAD_EXPIRE
+        except OSError:
+            expired = True
+        if expired:
+            try:
+                os.remove(path)
+                print(f"🧹 Удалена брошенная загрузка: {name}")
+            except OSError:
+                pass
+            with _upload_digests_lock:
+                _upload_digests.pop(name.partition('.')[0], None)
+
+def upload_status_headers(meta):
+    return {'Upload-Offset': str(meta['offset']), 'Upload-Length': str(meta['size']),
+            'Cache-Control': 'no-store'}
+
+@app.route('/api/uploads', methods=['POST'])
+def create_upload():
+    """Начать загрузку частями"""
+    data = request.get_json(silent=True) or {}
+    filename = safe_filename(str(data.get('filename', '')))
+    current_path = str(data.get('current_path', ''))
+    try:
+        size = int(data.get('size'))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Не указан размер файла'}), 400
+    if size < 0 or rel_path(os.path.join(app.config['UPLOAD_FOLDER'], current_path)) is None:
+        return jsonify({'error': 'Неверные параметры загрузки'}), 400
+    if size > shutil.disk_usage(app.config['UPLOAD_FOLDER']).free:
+        return jsonify({'error': 'Недостаточно места на диске'}), 507
+    
+    cleanup_stale_uploads()
+    
+    upload_id = secrets.token_hex(16)
+    part_path, meta_path = _upload_paths(upload_id)
+    os.makedirs(os.path.dirname(part_path), exist_ok=True)
+    open(part_path, 'wb').close()
+    meta = {'filename': filename, 'size': size, 'current_path': current_path,
+            'sort': bool(data.get('sort', True)), 'created': time.time()}
+    with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(meta_path + '.tmp', meta_path)
+    
+    location = url_for('upload_status', upload_id=upload_id)
+    return jsonify({'id': upload_id, 'offset': 0, 'url': location}), 201, {'Location': location}
+
+@app.route('/api/uploads/<upload_id>', methods=['GET', 'HEAD'])
+def upload_status(upload_id):
+    """Сколько байт загрузки уже принято"""
+    meta = load_upload(upload_id)
+    if meta is None:
+        return jsonify({'error': 'Загрузка не найдена'}), 404
+    return jsonify({'offset': meta['offset'], 'size': meta['size']}), 200, upload_status_headers(meta)
+
+@app.route('/api/uploads/<upload_id>', methods=['PATCH'])
+def upload_chunk(upload_id):
+    """Дописать часть файла с позиции Upload-Offset"""
+    meta = load_upload(upload_id)
+    if meta is None:
+        return jsonify({'error': 'Загрузка не найдена'}), 404
+    try:
+        offset = int(request.headers['Upload-Offset'])
+    except (KeyError, ValueError):
+        return jsonify({'error': 'Нужен заголовок Upload-Offset'}), 400
+    
+    length = request.content_length
+    if length is None:
+        return jsonify({'error': 'Нужен заголовок Content-Length'}), 411
+    if length > UPLOAD_CHUNK_MAX or offset + length > meta['size']:
+        return jsonify({'error': 'Часть больше допустимого'}), 413
+    
+    digest = None
+    checksum = request.headers.get('Upload-Checksum')
+    if checksum:
+        algorithm, _, expected = checksum.partition(' ')
+        if algorithm not in UPLOAD_CHECKSUMS:
+            return jsonify({'error': f'Неизвестный алгоритм контрольной суммы: {algorithm}'}), 400
+        digest = UPLOAD_CHECKSUMS[algorithm]()
+    
+    part_path = _upload_paths(upload_id)[0]
+    with upload_lock(upload_id) as locked:
+        if not locked:
+            return jsonify({'error': 'Часть этой загрузки уже принимается'}), 409, upload_status_headers(meta)
+        meta['offset'] = os.path.getsize(part_path)
+        if offset != meta['offset']:
+            # Клиент и сервер разошлись (например, ответ на прошлую часть потерялся)
+            return jsonify({'error': 'Неверное смещение', 'offset': meta['offset']}), 409, upload_status_headers(meta)
+        
+        # Хеш содержимого продолжается, только если прошлую часть принял этот же процесс
+        with _upload_digests_lock:
+            hashed, content_digest = _upload_digests.get(upload_id, (0, None))
+        content_digest = content_digest.copy() if content_digest and hashed == offset else None
+        if content_digest is None and offset == 0:
+            content_digest = hashlib.sha256()
+        
+        received = 0
+        with open(part_path, 'r+b') as f:
+            f.seek(offset)
+            try:
+                while True:
+                    data = request.stream.read(UPLOAD_READ_BLOCK)
+                    if not data:
+                        break
+                    f.write(data)
+                    received += len(data)
+                    if digest:
+                        digest.update(data)
+                    if content_digest:
+                        content_digest.update(data)
+            except Exception:
+                # Связь оборвалась посреди части - часть принимается заново целиком
+                f.truncate(offset)
+                raise
+            
+            if received != length:
+                f.truncate(offset)
+                return jsonify({'error': 'Часть принята не полностью', 'offset': offset}), 400, upload_status_headers(meta)
+            if digest and base64.b64encode(digest.digest()).decode() != expected.strip():
+                f.truncate(offset)
+                return jsonify({'error': 'Контрольная сумма не совпала', 'offset': offset}), 460, upload_status_headers(meta)
+        
+        if content_digest:
+            with _upload_digests_lock:
+                _upload_digests[upload_id] = (offset + received, content_digest)
+    
+    meta['offset'] = offset + received
+    return '', 204, upload_status_headers(meta)
+
+def _upload_content_hash(upload_id, part_path):
+    """SHA-256 собранного файла: с диска читается только то, что не учтено при приёме частей"""
+    with _upload_digests_lock:
+        hashed, digest = _upload_digests.pop(upload_id, (0, None))
+    if digest is None:
+        hashed, digest = 0, hashlib.sha256()
+    with open(part_path, 'rb') as f:
+        f.seek(hashed)
+        for block in iter(lambda: f.read(HASH_READ_BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+@app.route('/api/uploads/<upload_id>/finish', methods=['POST'])
+def finish_upload(upload_id):
+    """Завершить загрузку частями: разложить файл так же, как /upload или /upload_direct"""
+    meta = load_upload(upload_id)
+    if meta is None:
+        return jsonify({'error': 'Загрузка не найдена'}), 404
+    if meta['offset'] != meta['size']:
+        return jsonify({'error': 'Файл загружен не полностью', 'offset': meta['offset']}), 409, upload_status_headers(meta)
+    
+    part_path, meta_path = _upload_paths(upload_id)
+    with upload_lock(upload_id) as locked:
+        if not locked:
+            return jsonify({'error': 'Загрузка ещё принимается'}), 409
+        
+        filename = meta['filename']
+        kind = thumbnail_kind(filename)
+        date_obj = file_capture_date(part_path) if kind == 'image' else datetime.now()
+        if meta['sort'] and kind:
+            final_path = auto_sort_destination(filename, date_obj, kind == 'image')
+        else:
+            upload_path = os.path.join(app.config['UPLOAD_FOLDER'], meta['current_path'])
+            os.makedirs(upload_path, exist_ok=True)
+            if kind:
+                filename = shorten_name_by_date(filename, date_obj, max_length=20)
+            final_path = unique_path(upload_path, filename)
+        
+        stored, original = place_upload(part_path, final_path, _upload_content_hash(upload_id, part_path))
+        os.remove(meta_path)
+    
+    if not stored:
+        return jsonify({'path': original, 'duplicate_of': original, 'stored': False})
+    index_path_added(final_path)
+    prewarm_thumbnails(final_path)
+    print(f"📦 Загрузка частями завершена: {rel_path(final_path)}")
+    return jsonify({'path': rel_path(final_path), 'duplicate_of': original, 'stored': True})
+
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+def cancel_upload(upload_id):
+    """Отменить загрузку частями"""
+    if load_upload(upload_id) is None:
+        return jsonify({'error': 'Загрузка не найдена'}), 404
+    with upload_lock(upload_id) as locked:
+        if not locked:
+            return jsonify({'error': 'Часть этой загрузки ещё принимается'}), 409
+        for path in _upload_paths(upload_id):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        with _upload_digests_lock:
+            _upload_digests.pop(upload_id, None)
+    return '', 204
+
+# ==================== Дедупликация ====================
+# Для файлов хранилища запоминается SHA-256 содержимого (таблица content_hashes
+# вместе с размером и mtime, по которым хеш перепроверяется). Загрузка считает
+# хеш по ходу приёма и ищет такой же файл среди уже известных хешей (файлы,
+# лежавшие в хранилище до появления хешей, хеширует фоновый поиск). Найденный
+# повтор по DEDUP_MODE сохраняется жёсткой ссылкой на уже лежащий файл или не
+# сохраняется вовсе. Повтор из той же папки (повторная выгрузка всей фотоплёнки)
+# не сохраняется в любом режиме, кроме 'off', - иначе рядом появились бы копии
+# с _1, _2.
+#
+# POST /api/dedup/scan в фоне ищет дубликаты среди уже лежащих файлов, хешируя
+# только те, размер которых совпал хотя бы с одним другим файлом.
+
+DEDUP_SCAN_STALE = 300  # Поиск, не отмечавший ход дольше стольких секунд, считается упавшим
+HASH_READ_BLOCK = 1024 * 1024
+
+def _hash_file(full_path):
+    digest = hashlib.sha256()
+    with open(full_path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_READ_BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def content_hash_record(full_path, content_hash):
+    """Запомнить хеш содержимого файла хранилища"""
+    st = os.stat(full_path)
+    try:
+        with index_transaction() as conn:
+            conn.execute('INSERT INTO content_hashes (path, size, mtime, hash) VALUES (?, ?, ?, ?) '
+                         'ON CONFLICT(path) DO UPDATE SET size = excluded.size, '
+                         'mtime = excluded.mtime, hash = excluded.hash',
+                         (rel_path(full_path), st.st_size, st.st_mtime, content_hash))
+    except sqlite3.Error as e:
+        print(f"⚠️  Ошибка записи хеша {full_path}: {e}")
+
+def file_content_hash(full_path):
+    """SHA-256 содержимого файла (пересчитывается, только если изменились размер или mtime)"""
+    st = os.stat(full_path)
+    row = get_index_db().execute('SELECT size, mtime, hash FROM content_hashes WHERE path = ?',
+                                 (rel_path(full_path),)).fetchone()
+    if row is not None and row['size'] == st.st_size and row['mtime'] == st.st_mtime:
+        return row['hash']
+    content_hash = _hash_file(full_path)
+    content_hash_record(full_path, content_hash)
+    return content_hash
+
+def _content_hash_current(row):
+    """Не изменился ли файл с тех пор, как запомнили его хеш"""
+    try:
+        st = os.stat(storage_path(row['path']))
+    except OSError:
+        return False
+    return st.st_size == row['size'] and st.st_mtime == row['mtime']
+
+def find_duplicates(content_hash):
+    """Файлы хранилища (пути относительно него) с таким же содержимым
+    
+    Смотрит только таблицу content_hashes: хешировать внутри запроса загрузки
+    не хешированные файлы того же размера слишком долго - их хеширует
+    фоновый поиск дубликатов (POST /api/dedup/scan).
+    """
+    conn = get_index_db()
+    rows = conn.execute('SELECT path, size, mtime FROM content_hashes WHERE hash = ?', (content_hash,)).fetchall()
+    found = [row['path'] for row in rows if _content_hash_current(row)]
+    stale = [(row['path'],) for row in rows if row['path'] not in found]
+    if stale:
+        with index_transaction() as conn:
+            conn.executemany('DELETE FROM content_hashes WHERE path = ?', stale)
+    return found
+
+def place_upload(source_path, final_path, content_hash):
+    """Перенести принятый файл на место, если такого же ещё нет в хранилище
+    
+    Returns:
+        (сохранён ли файл, путь уже лежащей копии или None). При DEDUP_MODE = 'link'
+        повтор сохраняется жёсткой ссылкой на копию, при 'skip' - не сохраняется,
+        как и повтор из той же папки.
+    """
+    size = os.path.getsize(source_path)
+    duplicates = []
+    if DEDUP_MODE != 'off' and size:
+        try:
+            duplicates = find_duplicates(content_hash)
+        except sqlite3.Error as e:
+            print(f"⚠️  Ошибка поиска дубликатов: {e}")
+    
+    original = None
+    if duplicates:
+        folder = rel_path(os.path.dirname(final_path))
+        same_folder = [path for path in duplicates if _parent_rel(path) == folder]
+        original = (same_folder or duplicates)[0]
+        if same_folder or DEDUP_MODE == 'skip':
+            os.remove(source_path)
+            print(f"♻️  {os.path.basename(final_path)} не сохранён - такой файл уже есть: {original}")
+            return False, original
+        try:
+            os.link(storage_path(original), final_path)
+            os.remove(source_path)
+            print(f"🔗 {rel_path(final_path)} сохранён ссылкой на {original}")
+        except OSError as e:
+            # Жёсткие ссылки есть не везде (карта памяти в Android) - сохраняем копию
+            print(f"⚠️  Не удалось сослаться на {original} ({e}), файл сохранён копией")
+            original = None
+    if original is None:
+        move_into_place(source_path, final_path)
+    content_hash_record(final_path, content_hash)
+    return True, original
+
+def dedup_scan_status():
+    """Состояние фонового поиска дубликатов (общее для всех процессов)"""
+    row = get_index_db().execute("SELECT value FROM index_meta WHERE key = 'dedup_scan'").fetchone()
+    return json.loads(row['value']) if row else {'state': 'idle'}
+
+def _dedup_status_save(status):
+    status['updated'] = time.time()
+    with index_transaction() as conn:
+        conn.execute('INSERT INTO index_meta (key, value) VALUES (?, ?) '
+                     'ON CONFLICT(key) DO UPDATE SET value = excluded.value', ('dedup_scan', json.dumps(status)))
+
+def dedup_groups():
+    """Группы одинаковых файлов, занимающих место несколько раз
     
-    files = request.files.getlist('file')
-    current_path = request.form.get('current_path', '')
-    upload_path = os.path.join(app.config['UPLOAD_FOLDER'], current_path)
+    Пути одного файла через жёсткие ссылки места не занимают и копиями не
+    считаются. Группы отсортированы по убыванию лишнего места.
     
-    # Создаем папку если её нет
-    os.makedirs(upload_path, exist_ok=True)
+    Returns:
+        list of dict: hash, size, paths, copies (разных файлов на диске), wasted (лишних байт)
+    """
+    groups = {}
+    rows = get_index_db().execute(
+        'SELECT hash, size, path FROM content_hashes WHERE hash IN '
+        '(SELECT hash FROM content_hashes GROUP BY hash HAVING COUNT(*) > 1) ORDER BY hash, path').fetchall()
+    for row in rows:
+        try:
+            st = os.stat(storage_path(row['path']))
+        except OSError:
+            continue
+        group = groups.setdefault(row['hash'], {'hash': row['hash'], 'size': row['size'], 'paths': [], 'files': set()})
+        group['paths'].append(row['path'])
+        group['files'].add((st.st_dev, st.st_ino))
     
-    uploaded_count = 0
+    result = []
+    for group in groups.values():
+        group['copies'] = len(group.pop('files'))
+        group['wasted'] = group['size'] * (group['copies'] - 1)
+        if group['copies'] > 1:
+            result.append(group)
+    result.sort(key=lambda group: group['wasted'], reverse=True)
+    return result
+
+def dedup_scan(status):
+    """Посчитать хеши всех файлов хранилища, у которых есть файл того же размера
     
-    for file in files:
-        if file and file.filename:
-            filename = safe_filename(file.filename)
-            if filename:
-                filepath = os.path.join(upload_path, filename)
-                
-                # Если файл уже существует, добавляем номер
-                if os.path.exists(filepath):
-                    name, ext = os.path.splitext(filename)
-                    counter = 1
-                    while os.path.exists(filepath):
-                        filepath = os.path.join(upload_path, f"{name}_{counter}{ext}")
-                        counter += 1
-                
-                file.save(filepath)
-                
-                # Переименовываем если имя длинное (для изображений и видео)
-                _, ext = os.path.splitext(filename.lower())
-                if ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp', '.mp4', '.avi', '.mkv', '.mov', '.wmv', '.flv', '.webm']:
-                    filepath = rename_by_date_if_long(filepath, max_length=20)
-                
-                uploaded_count += 1
+    Ход поиска записывается в status и раз в секунду сохраняется в базу.
+    """
+    root = app.config['UPLOAD_FOLDER']
+    saved_at = time.time()
+    by_size = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        if dirpath == root:
+            dirnames[:] = [name for name in dirnames if name != INGEST_FOLDER]
+        metric_inc('cloud_fs_entries_visited_total', len(dirnames) + len(filenames), walker='dedup')
+        for name in filenames:
+            full_path = os.path.join(dirpath, name)
+            try:
+                size = os.path.getsize(full_path)
+            except OSError:
+                continue
+            if size:
+                by_size.setdefault(size, []).append(full_path)
+            status['files'] += 1
+        if time.time() - saved_at >= 1:
+            _dedup_status_save(status)
+            saved_at = time.time()
     
-    flash(f'Успешно загружено файлов: {uploaded_count}', 'success')
-    return redirect(url_for('browse', path=current_path))
+    candidates = [path for paths in by_size.values() if len(paths) > 1 for path in paths]
+    status['candidates'] = len(candidates)
+    for full_path in candidates:
+        try:
+            file_content_hash(full_path)
+        except OSError:
+            pass
+        status['hashed'] += 1
+        if time.time() - saved_at >= 1:
+            _dedup_status_save(status)
+            saved_at = time.time()
+    
+    # Хеши удалённых и изменённых в обход приложения файлов
+    conn = get_index_db()
+    stale = [(row['path'],) for row in conn.execute('SELECT path, size, mtime FROM content_hashes').fetchall()
+             if not _content_hash_current(row)]
+    with index_transaction() as conn:
+        conn.executemany('DELETE FROM content_hashes WHERE path = ?', stale)
+
+def _dedup_scan_job(status):
+    try:
+        dedup_scan(status)
+        groups = dedup_groups()
+        status.update(state='done', finished=time.time(), groups=len(groups),
+                      wasted=sum(group['wasted'] for group in groups))
+        print(f"♻️  Поиск дубликатов завершён: групп {status['groups']}, лишних {format_size(status['wasted'])}")
+    except Exception as e:
+        print(f"⚠️  Ошибка поиска дубликатов: {e}")
+        status.update(state='failed', error=str(e))
+    _dedup_status_save(status)
+
+def start_dedup_scan():
+    """Запустить поиск дубликатов в фоне
+    
+    Returns:
+        Состояние запущенного поиска или None, если поиск уже идёт (в любом процессе)
+    """
+    with index_transaction():
+        status = dedup_scan_status()
+        if status['state'] == 'running' and time.time() - status['updated'] < DEDUP_SCAN_STALE:
+            return None
+        status = {'state': 'running', 'started': time.time(), 'files': 0, 'candidates': 0, 'hashed': 0}
+        _dedup_status_save(status)
+    threading.Thread(target=_dedup_scan_job, args=(status,), name='dedup-scan', daemon=True).start()
+    return status
+
+@app.route('/api/dedup/scan', methods=['POST'])
+def api_dedup_scan():
+    """Запустить поиск дубликатов среди файлов хранилища"""
+    status = start_dedup_scan()
+    if status is None:
+        return jsonify({'error': 'Поиск дубликатов уже идёт', 'status': dedup_scan_status()}), 409
+    return jsonify({'status': status}), 202
 
+@app.route('/api/dedup/scan', methods=['GET'])
+def api_dedup_result():
+    """Ход поиска дубликатов и найденные группы (limit/offset по группам)"""
+    limit, offset = get_limit_offset()
+    groups = dedup_groups()
+    return jsonify({
+        'status': dedup_scan_status(),
+        'groups': groups[offset:offset + limit],
+        'total_groups': len(groups),
+        'wasted': sum(group['wasted'] for group in groups)
+    })
 
 @app.route('/create_folder', methods=['POST'])
 def create_folder():
@@ -532,6 +3496,7 @@ def create_folder():
         flash('Папка с таким именем уже существует!', 'error')
     else:
         os.makedirs(new_folder_path)
+        index_path_added(new_folder_path)
         flash(f'Папка "{folder_name}" создана!', 'success')
     
     return redirect(url_for('browse', path=current_path))
@@ -548,9 +3513,12 @@ def delete_item(path):
     try:
         if os.path.isdir(full_path):
             shutil.rmtree(full_path)
+            index_path_removed(full_path, is_dir=True)
             flash('Папка удалена!', 'success')
         else:
+            size = os.path.getsize(full_path)
             os.remove(full_path)
+            index_path_removed(full_path, is_dir=False, size=size)
             flash('Файл удален!', 'success')
     except Exception as e:
         flash(f'Ошибка при удалении: {str(e)}', 'error')
@@ -561,38 +3529,315 @@ def delete_item(path):
 
 @app.route('/download/<path:path>')
 def download_file(path):
-    """Скачивание файла"""
+    """Скачивание файла (папка скачивается ZIP-архивом)"""
     full_path = os.path.join(app.config['UPLOAD_FOLDER'], path)
+    rel = rel_path(full_path)
     
-    if not os.path.exists(full_path) or os.path.isdir(full_path):
+    if rel is None or not os.path.exists(full_path):
         flash('Файл не найден!', 'error')
         return redirect(url_for('index'))
     
-    return send_file(full_path, as_attachment=True)
+    if os.path.isdir(full_path):
+        return zip_response([rel], f"{os.path.basename(os.path.normpath(full_path)) or 'Облако'}.zip")
+    
+    return serve_file(full_path, as_attachment=True)
 
-@app.route('/storage_info')
-def storage_info():
-    """Информация о хранилище"""
-    total_size = 0
-    file_count = 0
-    folder_count = 0
+# ==================== Отдача файлов фронт-сервером ====================
+# Под синхронными воркерами gunicorn каждая отдача файла через send_file держит
+# воркер, пока не уйдёт последний байт, - одно многогигабайтное видео занимает
+# его на минуты. При SENDFILE_MODE приложение только проверяет путь и отвечает
+# заголовком X-Accel-Redirect (nginx) или X-Sendfile (lighttpd, Apache), а сам
+# файл через sendfile(2) отдаёт фронт-сервер, вместе с Range-запросами.
+
+def accel_redirect_uri(full_path):
+    """Внутренний URI nginx для файла из storage или кеша миниатюр"""
+    full_path = os.path.abspath(full_path)
+    for prefix, root in ((ACCEL_STORAGE_PREFIX, app.config['UPLOAD_FOLDER']),
+                         (ACCEL_THUMBS_PREFIX, THUMBNAIL_CACHE_FOLDER)):
+        rel = os.path.relpath(full_path, os.path.abspath(root))
+        if rel != '..' and not rel.startswith('..' + os.sep):
+            # nginx ожидает в X-Accel-Redirect экранированный URI
+            return prefix + quote(rel.replace(os.sep, '/'))
+    raise ValueError(f'Файл вне storage и кеша миниатюр: {full_path}')
+
+def serve_file(full_path, mimetype=None, as_attachment=False, etag=True):
+    """Отдать файл: заголовком для фронт-сервера (SENDFILE_MODE) или через send_file
     
-    for root, dirs, files in os.walk(app.config['UPLOAD_FOLDER']):
-        folder_count += len(dirs)
-        for file in files:
-            file_count += 1
-            filepath = os.path.join(root, file)
+    etag - строка ETag (например, отпечаток содержимого) вместо ETag по mtime и
+    размеру. Все ответы с файлами поддерживают докачку: Range из одного или
+    нескольких диапазонов, If-Range и проверку ETag (If-None-Match, If-Match).
+    """
+    if not SENDFILE_MODE:
+        st = os.stat(full_path)
+        if etag is True:
+            etag = file_etag(st)
+        ranges = multipart_ranges(st, etag)
+        if ranges is not None:
+            return multipart_range_response(full_path, st, ranges, etag, mimetype, as_attachment)
+        # send_file отклонил бы слишком много диапазонов с 416 - отдаём файл целиком
+        conditional = request.range is None or len(request.range.ranges) <= RANGE_MAX_PARTS
+        response = send_file(full_path, mimetype=mimetype, as_attachment=as_attachment, etag=etag,
+                             conditional=conditional)
+        # Менеджеры загрузок делят файл на сегменты, только увидев Accept-Ranges в полном ответе
+        response.headers['Accept-Ranges'] = 'bytes'
+        return response
+    
+    response = Response(mimetype=mimetype or mimetypes.guess_type(full_path)[0] or 'application/octet-stream')
+    if isinstance(etag, str):
+        response.set_etag(etag)
+    if as_attachment:
+        response.headers['Content-Disposition'] = attachment_disposition(os.path.basename(full_path))
+    if SENDFILE_MODE == 'accel':
+        response.headers['X-Accel-Redirect'] = accel_redirect_uri(full_path)
+    else:
+        # Заголовки WSGI - latin-1: так путь в UTF-8 уходит фронт-серверу байт в байт
+        response.headers['X-Sendfile'] = os.path.abspath(full_path).encode('utf-8').decode('latin-1')
+    return response
+
+# ==================== Докачка и загрузка частями ====================
+# Одиночный Range (в том числе с If-Range) обрабатывает send_file. Запрос
+# нескольких диапазонов сразу (менеджеры загрузок качают файл сегментами,
+# просмотрщики PDF - нужные страницы) send_file отклоняет с 416, поэтому его
+# отдаём сами ответом multipart/byteranges. При SENDFILE_MODE все диапазоны
+# отдаёт фронт-сервер через sendfile(2), без копирования через Python.
+
+RANGE_MAX_PARTS = 16  # Больше диапазонов в одном запросе - отдаём файл целиком (как max_ranges в nginx)
+RANGE_READ_BLOCK = 64 * 1024
+
+def file_etag(st):
+    """ETag файла по mtime и размеру (одинаковый для полного ответа и диапазонов)"""
+    return f'{st.st_mtime_ns:x}-{st.st_size:x}'
+
+def multipart_ranges(st, etag):
+    """Диапазоны запроса из нескольких частей [(начало, конец), ...]
+    
+    Returns:
+        None, если это не такой запрос или его нужно отдать как обычно: один
+        диапазон, If-Range не совпал (файл изменился - отдаём целиком) или
+        диапазонов больше RANGE_MAX_PARTS. Пустой список - ни один диапазон
+        не попадает в файл (416).
+    """
+    byte_range = request.range
+    if (request.method not in ('GET', 'HEAD') or byte_range is None or byte_range.units != 'bytes'
+            or not 1 < len(byte_range.ranges) <= RANGE_MAX_PARTS):
+        return None
+    if_range = request.if_range
+    if if_range.etag is not None and if_range.etag != etag:
+        return None
+    if if_range.date is not None and if_range.date != http_date_of(st.st_mtime):
+        return None
+    # Совпавший If-None-Match важнее Range - ответим 304 через send_file
+    if request.if_none_match.contains(etag):
+        return None
+    
+    ranges = []
+    for start, stop in byte_range.ranges:
+        if start < 0:
+            # Последние -start байт
+            start, stop = max(0, st.st_size + start), st.st_size
+        else:
+            stop = st.st_size if stop is None else min(stop, st.st_size)
+        if start < stop:
+            ranges.append((start, stop))
+    return ranges
+
+def http_date_of(timestamp):
+    """Время в виде, в котором его вернёт разбор заголовка (секунды, UTC)"""
+    return datetime.fromtimestamp(int(timestamp), timezone.utc)
+
+def multipart_range_response(full_path, st, ranges, etag, mimetype, as_attachment):
+    """Ответ 206 multipart/byteranges с несколькими диапазонами файла"""
+    if not ranges:
+        response = Response(status=416)
+        response.headers['Content-Range'] = f'bytes */{st.st_size}'
+        return response
+    
+    mimetype = mimetype or mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+    boundary = secrets.token_hex(16)
+    heads = [(f'--{boundary}\r\nContent-Type: {mimetype}\r\n'
+              f'Content-Range: bytes {start}-{stop - 1}/{st.st_size}\r\n\r\n').encode('ascii')
+             for start, stop in ranges]
+    tail = f'--{boundary}--\r\n'.encode('ascii')
+    
+    def generate():
+        with open(full_path, 'rb') as f:
+            for head, (start, stop) in zip(heads, ranges):
+                yield head
+                f.seek(start)
+                remaining = stop - start
+                while remaining > 0:
+                    block = f.read(min(RANGE_READ_BLOCK, remaining))
+                    if not block:
+                        return  # Файл укоротили во время отдачи - клиент увидит короткий ответ
+                    remaining -= len(block)
+                    yield block
+                yield b'\r\n'
+        yield tail
+    
+    response = Response(generate(), status=206, mimetype=f'multipart/byteranges; boundary={boundary}',
+                        direct_passthrough=True)
+    response.content_length = (sum(len(head) + stop - start + 2 for head, (start, stop) in zip(heads, ranges))
+                               + len(tail))
+    response.set_etag(etag)
+    response.last_modified = st.st_mtime
+    response.headers['Accept-Ranges'] = 'bytes'
+    if as_attachment:
+        response.headers['Content-Disposition'] = attachment_disposition(os.path.basename(full_path))
+    return response
+
+# ==================== Скачивание архивом ====================
+# Папка или несколько выбранных файлов отдаются одним ZIP, который пишется прямо
+# в ответ по мере чтения файлов: архив целиком не собирается ни в памяти, ни на
+# диске, а в памяти запроса лежит только текущий блок (ZIP_READ_BLOCK) и
+# состояние сжатия. Фото, видео и архивы уже сжаты - они кладутся как есть
+# (ZIP_STORED), не нагружая процессор телефона. Файлы и архивы больше 4 ГБ
+# пишутся в формате ZIP64.
+
+ZIP_READ_BLOCK = 64 * 1024
+ZIP_STORED_EXTENSIONS = THUMB_IMAGE_EXTENSIONS + THUMB_VIDEO_EXTENSIONS + (
+    '.heic', '.mp3', '.m4a', '.aac', '.ogg', '.flac', '.zip', '.rar', '.7z', '.gz', '.docx', '.xlsx', '.pptx')
+
+class ZipStream:
+    """Приёмник для zipfile без seek и tell: записанное забирается через drain()
+    
+    Без tell() zipfile пишет размеры и CRC после данных каждого файла
+    (data descriptor), поэтому возвращаться назад в ответе не нужно.
+    """
+    
+    def __init__(self):
+        self.buffer = bytearray()
+    
+    def write(self, data):
+        self.buffer += data
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def drain(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+def zip_entries(rels):
+    """Пары (полный путь, имя в архиве) для файлов и папок хранилища
+    
+    Имена в архиве - пути относительно общей родительской папки выбранного, так
+    что папка попадает в архив со своим именем, а файлы из одной папки - без пути.
+    Пустые папки тоже попадают в архив. Выбранное внутри другой выбранной папки
+    уже есть в ней, поэтому каждое имя встречается в архиве один раз.
+    """
+    folders = [rel for rel in rels if os.path.isdir(storage_path(rel))]
+    rels = [rel for rel in rels
+            if not any(rel != folder and (not folder or rel.startswith(folder + '/')) for folder in folders)]
+    parents = [_parent_rel(rel) or '' for rel in rels if rel]
+    base = os.path.commonpath(parents) if len(parents) == len(rels) else ''
+    cut = len(base) + 1 if base else 0
+    seen = set()
+    for full_path, arcname in _zip_walk(rels, cut):
+        if arcname not in seen:
+            seen.add(arcname)
+            yield full_path, arcname
+
+def _zip_walk(rels, cut):
+    """Пары (полный путь, имя в архиве) без проверки повторов - см. zip_entries()"""
+    for rel in rels:
+        full_path = storage_path(rel)
+        if not os.path.isdir(full_path):
+            yield full_path, rel[cut:]
+            continue
+        for dirpath, dirnames, filenames in os.walk(full_path):
+            if os.path.normpath(dirpath) == os.path.normpath(app.config['UPLOAD_FOLDER']):
+                dirnames[:] = [name for name in dirnames if name != INGEST_FOLDER]
+            dirnames.sort()
+            metric_inc('cloud_fs_entries_visited_total', len(dirnames) + len(filenames), walker='zip')
+            dir_rel = rel_path(dirpath)
+            if not dirnames and not filenames and dir_rel:
+                yield dirpath, dir_rel[cut:] + '/'
+            for name in sorted(filenames):
+                file_rel = f'{dir_rel}/{name}' if dir_rel else name
+                yield os.path.join(dirpath, name), file_rel[cut:]
+
+def stream_zip(entries):
+    """Генератор частей ZIP-архива из пар (полный путь, имя в архиве)"""
+    sink = ZipStream()
+    # strict_timestamps=False: файлы с датой до 1980 года (битые mtime) не ломают архив
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED, allowZip64=True, strict_timestamps=False) as archive:
+        for full_path, arcname in entries:
             try:
-                total_size += os.path.getsize(filepath)
-            except:
-                pass
+                zinfo = zipfile.ZipInfo.from_file(full_path, arcname, strict_timestamps=False)
+                if zinfo.is_dir():
+                    archive.writestr(zinfo, b'')
+                    continue
+                source = open(full_path, 'rb')
+            except OSError as e:
+                print(f"⚠️  Пропущен в архиве {arcname}: {e}")  # Удалили, пока архив отдавался
+                continue
+            is_stored = full_path.lower().endswith(ZIP_STORED_EXTENSIONS)
+            zinfo.compress_type = zipfile.ZIP_STORED if is_stored else zipfile.ZIP_DEFLATED
+            with source, archive.open(zinfo, 'w') as dest:
+                for block in iter(lambda: source.read(ZIP_READ_BLOCK), b''):
+                    dest.write(block)
+                    if sink.buffer:
+                        yield sink.drain()
+            yield sink.drain()
+    yield sink.drain()
+
+def attachment_disposition(filename):
+    """Content-Disposition для скачивания файла с русским именем"""
+    stem, ext = os.path.splitext(filename)
+    fallback = (secure_filename(stem) or 'archive') + ext
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename)}"
+
+def zip_response(rels, filename):
+    """Потоковый ответ с ZIP-архивом файлов и папок хранилища"""
+    response = Response(stream_with_context(stream_zip(zip_entries(rels))), mimetype='application/zip')
+    response.headers['Content-Disposition'] = attachment_disposition(filename)
+    # Размер заранее неизвестен; прокси не должен копить ответ целиком
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/download_zip', methods=['GET', 'POST'])
+def download_zip():
+    """Скачать несколько файлов и папок одним ZIP-архивом (параметры path)"""
+    rels = []
+    for path in request.values.getlist('path'):
+        rel = rel_path(os.path.join(app.config['UPLOAD_FOLDER'], path))
+        if rel is None or not os.path.exists(storage_path(rel)):
+            return jsonify({'error': f'Файл не найден: {path}'}), 404
+        if rel not in rels:
+            rels.append(rel)
+    if not rels:
+        return jsonify({'error': 'Не выбраны файлы'}), 400
+    
+    if len(rels) == 1:
+        name = os.path.splitext(os.path.basename(rels[0]) or 'Облако')[0]
+    else:
+        name = os.path.basename(request.values.get('current_path', '').rstrip('/')) or 'Облако'
+    return zip_response(rels, f'{name}.zip')
+
+@app.route('/storage_info')
+def storage_info():
+    """Информация о хранилище (из индекса папок)"""
+    stats = folder_stats('')
     
     return jsonify({
-        'total_size': format_size(total_size),
-        'file_count': file_count,
-        'folder_count': folder_count
+        'total_size': format_size(stats['size'] if stats else 0),
+        'file_count': stats['files'] if stats else 0,
+        'folder_count': stats['folders'] if stats else 0
     })
 
+def get_limit_offset():
+    """Параметры limit/offset из запроса (limit ограничен SEARCH_MAX_LIMIT)
+    
+    Нечисловые, нулевые и отрицательные значения заменяются значениями по умолчанию.
+    """
+    limit = request.args.get('limit', SEARCH_DEFAULT_LIMIT, type=int)
+    if limit < 1:
+        limit = SEARCH_DEFAULT_LIMIT
+    offset = max(0, request.args.get('offset', 0, type=int))
+    return min(limit, SEARCH_MAX_LIMIT), offset
+
 @app.route('/search')
 def search():
     """Поиск файлов по имени"""
@@ -602,20 +3847,11 @@ def search():
     if not query:
         return redirect(url_for('browse', path=current_path))
     
-    results = []
-    search_path = os.path.join(app.config['UPLOAD_FOLDER'], current_path)
-    
-    for root, dirs, files in os.walk(search_path):
-        for item in dirs + files:
-            if query in item.lower():
-                item_path = os.path.join(root, item)
-                relative_path = os.path.relpath(item_path, app.config['UPLOAD_FOLDER'])
-                info = get_file_info(item_path)
-                info['path'] = relative_path.replace('\\', '/')
-                results.append(info)
+    limit, offset = get_limit_offset()
+    search_rel = rel_path(os.path.join(app.config['UPLOAD_FOLDER'], current_path))
     
-    # Сортировка: сначала папки, потом файлы
-    results.sort(key=lambda x: (not x['is_dir'], x['name'].lower()))
+    # Поиск по индексу имён (сначала папки, потом файлы)
+    results = search_index(query, search_rel, limit, offset)
     
     return render_template('search_results.html', 
                          items=results, 
@@ -631,22 +3867,15 @@ def api_search():
     if not query:
         return jsonify([])
     
-    results = []
-    search_path = os.path.join(app.config['UPLOAD_FOLDER'], current_path)
-    
-    for root, dirs, files in os.walk(search_path):
-        for item in dirs + files:
-            if query in item.lower():
-                item_path = os.path.join(root, item)
-                relative_path = os.path.relpath(item_path, app.config['UPLOAD_FOLDER'])
-                info = get_file_info(item_path)
-                info['path'] = relative_path.replace('\\', '/')
-                results.append(info)
-    
-    # Сортировка: сначала папки, потом файлы
-    results.sort(key=lambda x: (not x['is_dir'], x['name'].lower()))
+    limit, offset = get_limit_offset()
+    search_rel = rel_path(os.path.join(app.config['UPLOAD_FOLDER'], current_path))
     
-    return jsonify(results)
+    # Берём на одну запись больше, чтобы понять, есть ли следующая страница
+    results = search_index(query, search_rel, limit + 1, offset)
+    response = jsonify(results[:limit])
+    if len(results) > limit:
+        response.headers['X-Next-Offset'] = str(offset + limit)
+    return response
 
 @app.route('/rename', methods=['POST'])
 def rename_item():
@@ -685,6 +3914,7 @@ def rename_item():
     else:
         try:
             os.rename(old_full_path, new_full_path)
+            index_path_renamed(old_full_path, new_full_path)
             flash(f'Успешно переименовано в "{new_name}"!', 'success')
         except Exception as e:
             flash(f'Ошибка при переименовании: {str(e)}', 'error')
@@ -692,203 +3922,450 @@ def rename_item():
     parent_path = os.path.dirname(old_path).replace('\\', '/')
     return redirect(url_for('browse', path=parent_path))
 
+# MIME типы просмотра изображений и видео (остальные - по расширению)
+PREVIEW_MIMETYPES = {
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.gif': 'image/gif',
+    '.bmp': 'image/bmp',
+    '.webp': 'image/webp',
+    '.mp4': 'video/mp4',
+    '.mov': 'video/mp4',  # Пробуем как MP4
+    '.avi': 'video/x-msvideo',
+    '.mkv': 'video/x-matroska',
+    '.webm': 'video/webm',
+}
+
+def file_version(size, mtime):
+    """Версия оригинала для URL /preview/ (?v=): размер и mtime до миллисекунд
+    
+    Список папки считает её по размеру и mtime из индекса, просмотр - по stat.
+    Отпечаток (file_fingerprint) для этого не годится: он читает только часть
+    файла, и изменённый на месте файл того же размера сохранил бы старый URL.
+    """
+    return f'{int(mtime * 1000):x}-{size:x}'
+
+def cache_control(version):
+    """Cache-Control для ответа версии version (отпечаток миниатюры или file_version)
+    
+    Если в URL передана та же версия (?v=), содержимое по этому URL уже не
+    изменится - браузер может не перепроверять его год.
+    """
+    return IMMUTABLE_CACHE_CONTROL if request.args.get('v') == version else REVALIDATE_CACHE_CONTROL
+
+def not_modified_response(etag, version, vary_accept=False):
+    """Ответ 304, если у браузера уже есть эта версия (If-None-Match), иначе None"""
+    if not request.if_none_match.contains(etag):
+        return None
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control(version)
+    if vary_accept:
+        response.vary.add('Accept')
+    return response
+
 @app.route('/preview/<path:path>')
 def preview_file(path):
-    """Предварительный просмотр файла (для изображений)"""
+    """Предварительный просмотр файла (для изображений)
+    
+    ETag - по mtime и размеру (file_etag), он же проверяется в If-Range при
+    докачке, так что изменённый файл не склеится из двух версий.
+    """
     full_path = os.path.join(app.config['UPLOAD_FOLDER'], path)
     
-    if not os.path.exists(full_path) or os.path.isdir(full_path):
+    if not os.path.exists(full_path) or os.path.isdir(full_path) or rel_path(full_path) is None:
         flash('Файл не найден!', 'error')
         return redirect(url_for('index'))
     
+    st = os.stat(full_path)
+    etag, version = file_etag(st), file_version(st.st_size, st.st_mtime)
+    not_modified = not_modified_response(etag, version)
+    if not_modified is not None:
+        return not_modified
+    
     # Определяем MIME тип для изображений и видео
     file_ext = os.path.splitext(path)[1].lower()
-    if file_ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp']:
-        mimetype = 'image/jpeg' if file_ext in ['.jpg', '.jpeg'] else f'image/{file_ext[1:]}'
-        return send_file(full_path, mimetype=mimetype)
-    elif file_ext == '.mp4':
-        return send_file(full_path, mimetype='video/mp4', conditional=True)
-    elif file_ext == '.mov':
-        return send_file(full_path, mimetype='video/mp4', conditional=True)  # Пробуем как MP4
-    elif file_ext == '.avi':
-        return send_file(full_path, mimetype='video/x-msvideo', conditional=True)
-    elif file_ext == '.mkv':
-        return send_file(full_path, mimetype='video/x-matroska', conditional=True)
-    elif file_ext == '.webm':
-        return send_file(full_path, mimetype='video/webm', conditional=True)
-    
-    # Для остальных файлов
-    return send_file(full_path)
+    response = serve_file(full_path, mimetype=PREVIEW_MIMETYPES.get(file_ext), etag=etag)
+    response.headers['Cache-Control'] = cache_control(version)
+    return response
 
 @app.route('/thumb/<path:path>')
 def get_thumbnail(path):
-    """Получить миниатюру изображения (200x200px) или первый кадр видео с кешированием на диск"""
+    """Получить миниатюру изображения или кадр видео с кешированием на диск
+    
+    Размер задаётся параметром s (64 - список, 200 - плитка, 1280 - просмотр),
+    формат WebP отдаётся браузерам, которые явно указали его в Accept. Для видео
+    с параметром strip=1 отдаётся полоса из VIDEO_STRIP_FRAMES кадров.
+    
+    ETag - имя файла в кеше (отпечаток, размер, формат): на If-None-Match с ним
+    отвечаем 304, не проверяя кеш и не открывая оригинал. С параметром v, равным
+    отпечатку, миниатюра кешируется браузером как неизменяемая.
+    """
     full_path = os.path.join(app.config['UPLOAD_FOLDER'], path)
     
     if not os.path.exists(full_path) or os.path.isdir(full_path):
         return '', 404
     
-    file_ext = os.path.splitext(path)[1].lower()
+    kind = thumbnail_kind(path)
+    if kind is None:
+        return '', 404
+    is_video = kind == 'video'
+    
+    strip = request.args.get('strip', 0, type=int) == 1
+    if strip and not (is_video and OPENCV_AVAILABLE):
+        return '', 404
+    
+    size = request.args.get('s', THUMBNAIL_DEFAULT_SIZE, type=int)
+    if size not in THUMBNAIL_SIZES:
+        return 'Неизвестный размер миниатюры', 400
+    
+    # Только явное image/webp: */* присылают и браузеры без поддержки WebP
+    fmt = 'webp' if WEBP_AVAILABLE and 'image/webp' in request.headers.get('Accept', '') else 'jpeg'
+    mimetype = f'image/{fmt}'
+    
+    fp = file_fingerprint(full_path)
+    if strip:
+        cache_path = thumbnail_cache_path(full_path, 'strip', fmt, fp)
+        size, renderer = VIDEO_STRIP_SIZE, render_video_strip
+    else:
+        cache_path = thumbnail_cache_path(full_path, size, fmt, fp)
+        renderer = render_thumbnail
+    
+    start_thumb_sweeper()
     
-    # Создаем хеш для имени кеша
-    cache_hash = hashlib.md5(full_path.encode()).hexdigest()
-    cache_filename = f"{cache_hash}.jpg"
-    cache_path = os.path.join(THUMBNAIL_CACHE_FOLDER, cache_filename)
+    # ETag выдаётся только с готовой миниатюрой, так что она уже есть в кеше
+    # (или была вытеснена - тогда браузерная копия всё равно верна)
+    etag = os.path.basename(cache_path)
+    not_modified = not_modified_response(etag, fp, vary_accept=True)
+    if not_modified is not None:
+        metric_inc('cloud_thumbnail_requests_total', result='not_modified')
+        return not_modified
     
-    # Если кеш существует и оригинал не изменился - возвращаем кеш
+    # Изменённый оригинал получит другой отпечаток, так что готовый файл всегда актуален
     if os.path.exists(cache_path):
-        file_mtime = os.path.getmtime(full_path)
-        cache_mtime = os.path.getmtime(cache_path)
-        if cache_mtime >= file_mtime:
-            return send_file(cache_path, mimetype='image/jpeg')
-    
-    # Для видео - извлекаем первый кадр (если OpenCV доступен)
-    if file_ext in ['.mp4', '.avi', '.mkv', '.mov', '.webm', '.flv', '.wmv']:
-        if not OPENCV_AVAILABLE:
-            # Если OpenCV нет - возвращаем SVG иконку видео
-            svg_icon = '''<svg width="200" height="200" xmlns="http://www.w3.org/2000/svg">
-                <rect width="200" height="200" fill="#2c3e50"/>
-                <polygon points="70,50 70,150 150,100" fill="#3498db"/>
-                <text x="100" y="180" font-family="Arial" font-size="14" fill="#ecf0f1" text-anchor="middle">VIDEO</text>
-            </svg>'''
-            return svg_icon, 200, {'Content-Type': 'image/svg+xml'}
-        
-        try:
-            # Открываем видео
-            cap = cv2.VideoCapture(full_path)
-            
-            # Читаем первый кадр
-            ret, frame = cap.read()
-            cap.release()
-            
-            if ret:
-                # Конвертируем BGR (OpenCV) в RGB (PIL)
-                frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                
-                # Создаем PIL Image из numpy array
-                img = Image.fromarray(frame_rgb)
-                
-                # Создаем миниатюру
-                img.thumbnail((200, 200), Image.Resampling.LANCZOS)
-                
-                # Сохраняем в кеш
-                img.save(cache_path, 'JPEG', quality=60, optimize=True)
-                
-                return send_file(cache_path, mimetype='image/jpeg')
-            else:
-                print(f"Не удалось прочитать кадр из видео: {path}")
-                # Возвращаем SVG иконку при ошибке
-                svg_icon = '''<svg width="200" height="200" xmlns="http://www.w3.org/2000/svg">
-                    <rect width="200" height="200" fill="#2c3e50"/>
-                    <polygon points="70,50 70,150 150,100" fill="#3498db"/>
-                    <text x="100" y="180" font-family="Arial" font-size="14" fill="#ecf0f1" text-anchor="middle">VIDEO</text>
-                </svg>'''
-                return svg_icon, 200, {'Content-Type': 'image/svg+xml'}
-        except Exception as e:
-            print(f"Ошибка извлечения кадра из видео {path}: {e}")
-            # Возвращаем SVG иконку при ошибке
-            svg_icon = '''<svg width="200" height="200" xmlns="http://www.w3.org/2000/svg">
-                <rect width="200" height="200" fill="#2c3e50"/>
-                <polygon points="70,50 70,150 150,100" fill="#3498db"/>
-                <text x="100" y="180" font-family="Arial" font-size="14" fill="#ecf0f1" text-anchor="middle">VIDEO</text>
-            </svg>'''
-            return svg_icon, 200, {'Content-Type': 'image/svg+xml'}
-    
-    # Для изображений - обычная миниатюра
-    if file_ext not in ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp']:
-        return '', 404
+        thumb_cache_hit(cache_path)
+        metric_inc('cloud_thumbnail_requests_total', result='hit')
+        return thumbnail_response(cache_path, mimetype, fp)
+    
+    # Для видео без OpenCV и видео, из которого кадры уже не читались, - SVG иконка
+    if is_video and (not OPENCV_AVAILABLE or os.path.exists(video_failed_marker(cache_path))):
+        return video_placeholder_response(strip)
+    
+    with _thumb_lock:
+        thumb_stats['misses'] += 1
+    metric_inc('cloud_thumbnail_requests_total', result='miss')
+    # Файл всё равно будет прочитан - заодно запоминаем его метаданные
+    media_metadata(full_path)
     
     try:
-        # Генерируем миниатюру
-        with Image.open(full_path) as img:
-            # Конвертируем в RGB если нужно
-            if img.mode in ('RGBA', 'LA', 'P'):
-                background = Image.new('RGB', img.size, (255, 255, 255))
-                if img.mode == 'P':
-                    img = img.convert('RGBA')
-                background.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
-                img = background
-            elif img.mode != 'RGB':
-                img = img.convert('RGB')
-            
-            # Применяем EXIF ориентацию
-            try:
-                for orientation in TAGS.keys():
-                    if TAGS[orientation] == 'Orientation':
-                        break
-                exif = img._getexif()
-                if exif is not None:
-                    orientation_value = exif.get(orientation)
-                    if orientation_value == 3:
-                        img = img.rotate(180, expand=True)
-                    elif orientation_value == 6:
-                        img = img.rotate(270, expand=True)
-                    elif orientation_value == 8:
-                        img = img.rotate(90, expand=True)
-            except:
-                pass
-            
-            # Создаем миниатюру (200x200px для экономии места)
-            img.thumbnail((200, 200), Image.Resampling.LANCZOS)
-            
-            # Сохраняем в кеш с низким качеством (меньше размер)
-            img.save(cache_path, 'JPEG', quality=60, optimize=True)
-            
-            return send_file(cache_path, mimetype='image/jpeg')
+        if generate_thumbnail(full_path, cache_path, is_video, size, fmt, renderer):
+            return thumbnail_response(cache_path, mimetype, fp)
+        print(f"Не удалось прочитать кадр из видео: {path}")
+    except ThumbnailQueueFull:
+        return 'Сервер занят генерацией миниатюр', 503, {'Retry-After': '2'}
     except Exception as e:
         print(f"Ошибка при генерации миниатюры {path}: {e}")
-        return '', 500
+        if not is_video:
+            return '', 500
+    
+    # Возвращаем SVG иконку при ошибке видео
+    return video_placeholder_response(strip)
+
+def video_placeholder_response(strip=False):
+    """SVG-заглушка вместо кадра видео (полосы кадров без кадров не бывает - 404)"""
+    if strip:
+        return '', 404
+    # Браузер может не перезапрашивать заглушку несколько минут
+    return VIDEO_PLACEHOLDER_SVG, 200, {'Content-Type': 'image/svg+xml', 'Cache-Control': 'max-age=300'}
+
+def thumbnail_response(cache_path, mimetype, fp):
+    """Ответ с файлом миниатюры (формат зависит от Accept - сообщаем это кешам)"""
+    response = serve_file(cache_path, mimetype=mimetype, etag=os.path.basename(cache_path))
+    response.headers['Cache-Control'] = cache_control(fp)
+    response.vary.add('Accept')
+    return response
+
+@app.route('/thumb_stats')
+def thumbnail_stats():
+    """Состояние очереди генерации и кеша миниатюр"""
+    with _thumb_lock:
+        stats = dict(thumb_stats)
+        stats['inflight'] = len(_thumb_inflight)
+    stats['workers'] = THUMBNAIL_WORKERS
+    row = get_index_db().execute(f'SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM thumbs '
+                                 f'WHERE NOT {TRANSCODE_FILES_SQL}').fetchone()
+    stats['cache_files'], stats['cache_bytes'] = row[0], row[1]
+    stats['cache_limit'] = THUMBNAIL_CACHE_MAX_BYTES
+    stats['prewarm_pending'] = prewarm_pending()
+    stats.update({f'prewarm_{key}': value for key, value in prewarm_stats.items()})
+    stats['wait_avg'] = stats['wait_total'] / stats['wait_count'] if stats['wait_count'] else 0.0
+    return jsonify(stats)
+
+# ==================== Облегчённые копии видео ====================
+# MOV, AVI и MKV телефон часто не проигрывает вовсе, а 4K-оригинал по Wi-Fi
+# то и дело останавливается. Если есть ffmpeg, такие видео по запросу
+# просмотрщика ставятся в фоновую очередь (одно перекодирование за раз, с
+# пониженным приоритетом): получается копия в H.264 высотой TRANSCODE_HEIGHT с
+# ограниченным битрейтом и HLS из неё (сегменты - байтовые диапазоны одного
+# файла). Копии лежат в .thumbcache под отпечатком оригинала, учитываются
+# вместе с миниатюрами (переименование их не теряет, удаление оригинала
+# удаляет), но вытесняются по своему бюджету TRANSCODE_CACHE_MAX_BYTES.
+# Пока копии нет, просмотрщик играет оригинал.
+
+TRANSCODE_WEB_EXTENSIONS = ('.mp4', '.m4v', '.webm')  # Контейнеры, которые браузеры открывают сами
+TRANSCODE_WEB_CODECS = ('avc1', 'h264', 'vp08', 'vp80', 'vp09', 'vp90', 'av01')  # FourCC из OpenCV
+HLS_SEGMENT_SECONDS = 6
+
+_transcode_cond = threading.Condition()
+_transcode_queue = deque()  # (отпечаток, полный путь) в порядке запросов
+_transcode_pending = set()  # отпечатки в очереди и текущий
+_transcode_failed = {}  # отпечаток → когда его не удалось перекодировать (на TRANSCODE_RETRY_AFTER)
+_transcode_pid = None
+transcode_stats = {
+    'queued': 0,
+    'done': 0,
+    'failed': 0,
+    'seconds': 0.0,
+}
+
+def transcode_paths(fp):
+    """Файлы копии в кеше: (копия MP4, плейлист HLS, сегменты HLS)"""
+    return tuple(os.path.join(THUMBNAIL_CACHE_FOLDER, f'{fp}_{name}')
+                 for name in ('proxy.mp4', 'hls.m3u8', 'hls.m4s'))
+
+def video_needs_proxy(full_path):
+    """Нужна ли копия: контейнер не для браузера, кодек не H.264/VP8/VP9/AV1,
+    кадр выше 1080 строк или битрейт выше TRANSCODE_MAX_SOURCE_BITRATE"""
+    if not full_path.lower().endswith(TRANSCODE_WEB_EXTENSIONS):
+        return True
+    meta = media_metadata(full_path) or {}
+    if meta.get('codec') and meta['codec'].lower() not in TRANSCODE_WEB_CODECS:
+        return True
+    if (meta.get('height') or 0) > 1080 or (meta.get('width') or 0) > 1920:
+        return True
+    duration = meta.get('duration')
+    return bool(duration) and os.path.getsize(full_path) * 8 / duration > TRANSCODE_MAX_SOURCE_BITRATE
+
+def transcode_status(full_path, fp):
+    """Состояние копии видео для просмотрщика (словарь для JSON)"""
+    proxy, playlist, _ = transcode_paths(fp)
+    if os.path.exists(proxy) and os.path.exists(playlist):
+        return {
+            'status': 'ready',
+            'proxy': url_for('transcode_file', name=os.path.basename(proxy)),
+            'hls': url_for('transcode_file', name=os.path.basename(playlist)),
+        }
+    with _transcode_cond:
+        if fp in _transcode_pending:
+            return {'status': 'queued'}
+        failed_at = _transcode_failed.get(fp)
+        if failed_at is not None:
+            if time.time() - failed_at < TRANSCODE_RETRY_AFTER:
+                return {'status': 'failed'}
+            del _transcode_failed[fp]  # Сбой мог быть временным - пробуем снова
+    if os.path.exists(proxy + '.lock'):
+        return {'status': 'queued'}  # Перекодирует другой воркер gunicorn
+    if not FFMPEG_AVAILABLE:
+        return {'status': 'unavailable'}
+    if not video_needs_proxy(full_path):
+        return {'status': 'original'}
+    return {'status': 'none'}
+
+def enqueue_transcode(full_path, fp):
+    """Поставить видео в очередь перекодирования (повторная постановка ничего не делает)"""
+    with _transcode_cond:
+        if fp in _transcode_pending:
+            return
+        _transcode_pending.add(fp)
+        _transcode_queue.append((fp, full_path))
+        transcode_stats['queued'] += 1
+        _transcode_cond.notify()
+    _start_transcode_worker()
+
+def _ffmpeg(args):
+    """Запустить ffmpeg с пониженным приоритетом (True при успехе)"""
+    command = [FFMPEG_PATH, '-nostdin', '-hide_banner', '-loglevel', 'error', '-y'] + args
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=TRANSCODE_TIMEOUT,
+                            preexec_fn=(lambda: os.nice(10)) if hasattr(os, 'nice') else None)
+    if result.returncode != 0:
+        print(f"⚠️  ffmpeg: {result.stderr.decode('utf-8', 'replace').strip()[-500:]}")
+    return result.returncode == 0
+
+def transcode_video(full_path, fp):
+    """Сделать копию видео в H.264 и HLS из неё (в .thumbcache, под отпечатком)
+    
+    Returns:
+        True если копия готова (в том числе сделана другим процессом)
+    """
+    proxy, playlist, segments = transcode_paths(fp)
+    lock_path = proxy + '.lock'
+    # Вторая попытка - после снятия брошенной блокировки (или если её только что снял владелец)
+    for _ in range(2):
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) < TRANSCODE_TIMEOUT:
+                    return os.path.exists(playlist)  # Перекодирует другой процесс
+                os.remove(lock_path)  # Блокировка упавшего процесса
+            except FileNotFoundError:
+                pass  # Другой процесс как раз закончил и снял блокировку
+    else:
+        return os.path.exists(playlist)  # Блокировку успел занять другой процесс
+    
+    work_dir = os.path.join(THUMBNAIL_CACHE_FOLDER, f'{fp}_hls.tmp')
+    try:
+        if os.path.exists(playlist):
+            return True
+        os.makedirs(work_dir, exist_ok=True)
+        if not os.path.exists(proxy):
+            tmp_proxy = proxy + '.tmp'
+            ok = _ffmpeg(['-i', full_path, '-map', '0:v:0', '-map', '0:a:0?',
+                          '-vf', f"scale=-2:'min({TRANSCODE_HEIGHT},ih)'",
+                          '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '26', '-profile:v', 'main',
+                          '-pix_fmt', 'yuv420p', '-maxrate', TRANSCODE_VIDEO_BITRATE,
+                          '-bufsize', TRANSCODE_VIDEO_BITRATE,
+                          '-g', '48', '-c:a', 'aac', '-b:a', '96k', '-ac', '2',
+                          '-movflags', '+faststart', '-threads', '2', '-f', 'mp4', tmp_proxy])
+            if not ok:
+                _remove_quietly(tmp_proxy)
+                return False
+            os.replace(tmp_proxy, proxy)
+            thumb_cache_record(proxy)
+        
+        # HLS без перекодирования: те же кадры, нарезанные на сегменты в одном файле.
+        # Имена внутри плейлиста - окончательные, поэтому пишем в отдельную папку
+        ok = _ffmpeg(['-i', proxy, '-c', 'copy', '-f', 'hls', '-hls_time', str(HLS_SEGMENT_SECONDS),
+                      '-hls_playlist_type', 'vod', '-hls_segment_type', 'fmp4', '-hls_flags', 'single_file',
+                      os.path.join(work_dir, os.path.basename(playlist))])
+        if not ok:
+            return False
+        # Плейлист переносится последним - по нему видно, что копия готова
+        os.replace(os.path.join(work_dir, os.path.basename(segments)), segments)
+        thumb_cache_record(segments)
+        os.replace(os.path.join(work_dir, os.path.basename(playlist)), playlist)
+        thumb_cache_record(playlist)
+        return True
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        _remove_quietly(lock_path)
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def _transcode_loop():
+    while True:
+        with _transcode_cond:
+            while not _transcode_queue:
+                _transcode_cond.wait()
+            fp, full_path = _transcode_queue.popleft()
+        transcode_job(full_path, fp)
+
+def transcode_job(full_path, fp):
+    """Перекодировать видео из очереди и учесть результат"""
+    started = time.time()
+    try:
+        ok = transcode_video(full_path, fp)
+    except Exception as e:
+        print(f"⚠️  Ошибка перекодирования {rel_path(full_path)}: {e}")
+        ok = False
+    with _transcode_cond:
+        _transcode_pending.discard(fp)
+        if ok:
+            transcode_stats['done'] += 1
+            transcode_stats['seconds'] += time.time() - started
+        else:
+            _transcode_failed[fp] = time.time()
+            transcode_stats['failed'] += 1
+
+def _start_transcode_worker():
+    """Запустить фоновый поток перекодирования (один на процесс)"""
+    global _transcode_pid
+    with _transcode_cond:
+        if _transcode_pid == os.getpid():
+            return
+        _transcode_pid = os.getpid()
+    threading.Thread(target=_transcode_loop, name='video-transcode', daemon=True).start()
+
+@app.route('/api/transcode/<path:path>', methods=['GET', 'POST'])
+def api_transcode(path):
+    """Состояние облегчённой копии видео; POST ставит видео в очередь, если копия нужна
+    
+    status: ready (есть proxy и hls), queued, none (не делалась), original
+    (оригинал и так проигрывается), unavailable (нет ffmpeg), failed.
+    """
+    full_path = os.path.join(app.config['UPLOAD_FOLDER'], path)
+    if rel_path(full_path) is None or not os.path.isfile(full_path) or thumbnail_kind(path) != 'video':
+        return jsonify({'error': 'Видео не найдено'}), 404
+    
+    fp = file_fingerprint(full_path)
+    status = transcode_status(full_path, fp)
+    if request.method == 'POST' and status['status'] == 'none':
+        enqueue_transcode(full_path, fp)
+        status = {'status': 'queued'}
+    return jsonify(status)
+
+@app.route('/video_cache/<name>')
+def transcode_file(name):
+    """Файл копии видео из кеша (имя - отпечаток, содержимое по нему не меняется)"""
+    if not TRANSCODE_NAME.match(name):
+        return '', 404
+    cache_path = os.path.join(THUMBNAIL_CACHE_FOLDER, name)
+    if not os.path.exists(cache_path):
+        return '', 404
+    thumb_cache_hit(cache_path)
+    mimetype = 'application/vnd.apple.mpegurl' if name.endswith('.m3u8') else 'video/mp4'
+    response = serve_file(cache_path, mimetype=mimetype, etag=name)
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
+
+@app.route('/transcode_stats')
+def transcode_stats_view():
+    """Очередь перекодирования и занятое копиями видео место"""
+    with _transcode_cond:
+        stats = dict(transcode_stats)
+        stats['pending'] = len(_transcode_pending)
+    row = get_index_db().execute(f'SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM thumbs '
+                                 f'WHERE {TRANSCODE_FILES_SQL}').fetchone()
+    stats['cache_files'], stats['cache_bytes'] = row[0], row[1]
+    stats['cache_limit'] = TRANSCODE_CACHE_MAX_BYTES
+    stats['ffmpeg'] = FFMPEG_AVAILABLE
+    return jsonify(stats)
 
 @app.route('/category/<category>/<path:path>')
 @app.route('/category/<category>')
 @app.route('/category/<category>/')
 def browse_by_category(category, path=''):
-    """Просмотр файлов по категориям (фото, видео, документы)"""
+    """Просмотр файлов по категориям (фото, видео, документы)
+    
+    Файлы всего поддерева берутся из индекса постранично, сортировка (параметр
+    sort: name, date или size) тоже выполняется в индексе.
+    """
     full_path = os.path.join(app.config['UPLOAD_FOLDER'], path)
     
-    if not os.path.exists(full_path):
+    if not os.path.isdir(full_path):
         flash('Папка не найдена!', 'error')
         return redirect(url_for('index'))
     
-    # Определяем расширения для категорий
-    category_extensions = {
-        'image': ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp'],
-        'video': ['.mp4', '.avi', '.mkv', '.mov', '.wmv', '.flv'],
-        'document': ['.doc', '.docx', '.pdf', '.txt', '.xls', '.xlsx', '.ppt', '.pptx']
-    }
-    
-    if category not in category_extensions:
+    if category not in CATEGORY_EXTENSIONS:
         flash('Неизвестная категория!', 'error')
         return redirect(url_for('browse', path=path))
     
-    extensions = category_extensions[category]
-    items = []
-    
-    # Рекурсивный поиск файлов по категории
-    def collect_files(directory, relative_path=''):
-        try:
-            for item in os.listdir(directory):
-                item_path = os.path.join(directory, item)
-                
-                if os.path.isdir(item_path):
-                    # Рекурсивно обходим вложенные папки
-                    new_relative = os.path.join(relative_path, item).replace('\\', '/')
-                    collect_files(item_path, new_relative)
-                else:
-                    # Проверяем расширение файла
-                    _, ext = os.path.splitext(item.lower())
-                    if ext in extensions:
-                        info = get_file_info(item_path)
-                        file_relative_path = os.path.join(relative_path, item).replace('\\', '/')
-                        info['path'] = file_relative_path
-                        items.append(info)
-        except PermissionError:
-            pass
-    
-    collect_files(full_path, path)
+    sort = request.args.get('sort', 'name')
+    if sort not in CATEGORY_SORTS:
+        sort = 'name'
     
-    # Сортировка по имени
-    items.sort(key=lambda x: x['name'].lower())
+    rel = rel_path(full_path)
+    if subtree_stats(rel) is None:
+        flash('Папка не найдена!', 'error')
+        return redirect(url_for('index'))
+    items, next_cursor = list_category_page(category, rel, sort, limit=LIST_PAGE_SIZE)
+    total_files, total_size = category_stats(category, rel)
     
     # Путь для навигации
     breadcrumbs = []
@@ -899,25 +4376,48 @@ def browse_by_category(category, path=''):
             current = os.path.join(current, part).replace('\\', '/')
             breadcrumbs.append({'name': part, 'path': current})
     
-    # Подсчет статистики
-    total_size = sum(item['size'] for item in items)
-    
-    # Названия категорий
-    category_names = {
-        'image': 'Фото',
-        'video': 'Видео',
-        'document': 'Документы'
-    }
-    
     return render_template('index.html', 
                          items=items, 
+                         next_cursor=next_cursor,
+                         list_url=url_for('api_category', category=category, path=rel, sort=sort),
+                         page_size=LIST_PAGE_SIZE,
                          current_path=path,
                          breadcrumbs=breadcrumbs,
                          total_size=format_size(total_size),
-                         total_files=len(items),
+                         total_files=total_files,
                          total_folders=0,
                          category=category,
-                         category_name=category_names.get(category, category))
+                         category_name=CATEGORY_NAMES[category],
+                         sort=sort)
+
+@app.route('/api/category/<category>/')
+@app.route('/api/category/<category>/<path:path>')
+def api_category(category, path=''):
+    """API постраничного списка файлов категории (JSON, курсор в параметре cursor)"""
+    if category not in CATEGORY_EXTENSIONS:
+        return jsonify({'error': 'Неизвестная категория'}), 404
+    sort = request.args.get('sort', 'name')
+    if sort not in CATEGORY_SORTS:
+        return jsonify({'error': 'Неизвестная сортировка'}), 400
+    
+    full_path = os.path.join(app.config['UPLOAD_FOLDER'], path)
+    rel = rel_path(full_path)
+    cursor = request.args.get('cursor')
+    # Поддерево сверяется с диском для первой страницы, следующие его не перепроверяют
+    stats = folder_stats(rel) if cursor else subtree_stats(rel)
+    if not os.path.isdir(full_path) or stats is None:
+        return jsonify({'error': 'Папка не найдена'}), 404
+    
+    try:
+        limit = max(1, min(int(request.args.get('limit', LIST_PAGE_SIZE)), SEARCH_MAX_LIMIT))
+    except ValueError:
+        limit = LIST_PAGE_SIZE
+    
+    try:
+        items, next_cursor = list_category_page(category, rel, sort, cursor, limit)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'path': rel, 'items': items, 'next_cursor': next_cursor})
 
 # Создание PNG иконок из SVG при первом запуске
 def create_pwa_icons():
@@ -962,12 +4462,208 @@ def create_pwa_icons():
     except Exception as e:
         print(f"⚠ Ошибка создания иконок: {e}")
 
+# ==================== Асинхронный режим (ASGI) ====================
+# Синхронный воркер занят, пока медленный клиент не скачает видео целиком, и
+# четыре телефона, смотрящие фильмы, останавливают весь сервер. asgi_app - то же
+# приложение для ASGI-сервера (uvicorn app:asgi_app или python app.py --async):
+# обработчики Flask (и всё блокирующее в них - PIL, OpenCV, обход папок, SQLite)
+# выполняются в пуле из ASGI_THREADS потоков, а ответы отправляются в цикле
+# событий. Файлы из send_file (скачивание, просмотр с перемоткой через Range,
+# миниатюры) поток не держат вовсе: обработчик возвращает открытый файл, и
+# цикл событий сам читает его блоками по ASGI_FILE_BLOCK, пока клиент принимает.
+# Так один процесс держит сотни одновременных потоков видео.
+
+ASGI_THREADS = 32  # Потоков для обработчиков Flask (одновременно выполняемых запросов, не соединений)
+ASGI_FILE_BLOCK = 256 * 1024  # Блок чтения файла при отдаче
+
+class ReceiveStream(RawIOBase):
+    """wsgi.input поверх receive() ASGI: тело запроса читается по мере прихода
+    
+    Загрузка не копируется во временный файл целиком до вызова обработчика -
+    обработчик пишет её на место сам, как и под gunicorn.
+    """
+    
+    def __init__(self, receive, loop):
+        self.receive = receive
+        self.loop = loop
+        self.lock = asyncio.Lock()
+        self.chunk = memoryview(b'')
+        self.more_body = True
+    
+    async def next_message(self):
+        """Следующее сообщение клиента: receive() не вызывается из двух мест сразу"""
+        async with self.lock:
+            return await self.receive()
+    
+    def readable(self):
+        return True
+    
+    def readinto(self, buffer):
+        while not self.chunk and self.more_body:
+            message = asyncio.run_coroutine_threadsafe(self.next_message(), self.loop).result()
+            if message['type'] == 'http.disconnect':
+                raise ClientDisconnected()
+            self.chunk = memoryview(message.get('body', b''))
+            self.more_body = message.get('more_body', False)
+        n = min(len(buffer), len(self.chunk))
+        buffer[:n] = self.chunk[:n]
+        self.chunk = self.chunk[n:]
+        return n
+
+class AsgiAdapter:
+    """ASGI-приложение поверх WSGI-приложения Flask (см. описание раздела)"""
+    
+    def __init__(self, wsgi_app, threads=ASGI_THREADS):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='asgi')
+    
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.handle(scope, receive, send)
+    
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    
+    def environ(self, scope, stream, file_wrapper):
+        """WSGI environ из scope (строки WSGI - latin-1 поверх байт UTF-8)"""
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': str(server[0]),
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': stream,
+            'wsgi.input_terminated': True,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            'wsgi.file_wrapper': file_wrapper,
+        }
+        for name, value in scope['headers']:
+            key = name.decode('latin-1').upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = 'HTTP_' + key
+            value = value.decode('latin-1')
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+        return environ
+    
+    async def handle(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+        receiver = ReceiveStream(receive, loop)
+        # Файлы, которые send_file обернул через wsgi.file_wrapper: ответ с таким
+        # файлом адаптер отправляет сам, не разбирая обёртки Werkzeug (Range и т.п.)
+        files = []
+        
+        def file_wrapper(file, buffer_size=8192):
+            wrapper = FileWrapper(file, buffer_size)
+            files.append(wrapper)
+            return wrapper
+        
+        environ = self.environ(scope, BufferedReader(receiver, ASGI_FILE_BLOCK), file_wrapper)
+        started = {}
+        
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+            return None
+        
+        # Все вызовы кода Flask одного запроса - в одном контексте: потоковые
+        # ответы (stream_with_context) продолжаются в других потоках пула
+        context = contextvars.copy_context()
+        
+        def run(func, *args):
+            return loop.run_in_executor(self.executor, context.run, func, *args)
+        
+        app_iter = await run(self.wsgi_app, environ, start_response)
+        disconnected = asyncio.Event()
+        watcher = loop.create_task(self.watch_disconnect(receiver, disconnected))
+        try:
+            await send({'type': 'http.response.start', 'status': started['status'],
+                        'headers': started['headers']})
+            # На HEAD и 304 send_file тоже открывает файл, но тела у ответа нет
+            if len(files) == 1 and scope['method'] != 'HEAD' and started['status'] in (200, 206):
+                await self.send_file(send, files[0].file, dict(started['headers']), disconnected)
+            else:
+                iterator = iter(app_iter)
+                while not disconnected.is_set():
+                    chunk = await run(next, iterator, None)
+                    if chunk is None:
+                        break
+                    if chunk:
+                        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            watcher.cancel()
+            if hasattr(app_iter, 'close'):
+                await run(app_iter.close)
+            for wrapper in files:
+                wrapper.close()
+    
+    async def watch_disconnect(self, receiver, disconnected):
+        """Дождаться обрыва соединения
+        
+        Тело, не прочитанное обработчиком до начала ответа, отбрасывается: поток
+        запроса дальше видит его конец, а receive() по-прежнему вызывается только
+        под блокировкой receiver.
+        """
+        receiver.more_body = False
+        while True:
+            message = await receiver.next_message()
+            if message['type'] == 'http.disconnect':
+                disconnected.set()
+                return
+    
+    async def send_file(self, send, file, headers, disconnected):
+        """Отправить файл из send_file, не занимая поток на время передачи
+        
+        Ответ на Range (206) начинается с позиции из Content-Range. Файл читается
+        в пуле цикла событий - медленный диск тоже не останавливает цикл.
+        """
+        loop = asyncio.get_running_loop()
+        content_range = headers.get(b'content-range')
+        if content_range:
+            start = int(content_range.split(b' ', 1)[1].split(b'-', 1)[0])
+            await loop.run_in_executor(None, file.seek, start)
+        remaining = int(headers[b'content-length']) if b'content-length' in headers else None
+        while remaining != 0 and not disconnected.is_set():
+            block = ASGI_FILE_BLOCK if remaining is None else min(ASGI_FILE_BLOCK, remaining)
+            chunk = await loop.run_in_executor(None, file.read, block)
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+asgi_app = AsgiAdapter(app)
+
 if __name__ == '__main__':
+    # Прогреть миниатюры всего хранилища и выйти: python app.py --prewarm
+    if '--prewarm' in sys.argv:
+        prewarm_storage()
+        sys.exit(0)
+    
     # Создать иконки для PWA
     create_pwa_icons()
     
     # Определить режим работы (production на мобильных для скорости)
-    import sys
     debug_mode = '--debug' in sys.argv
     
     print(f"🚀 Запуск сервера в режиме: {'DEBUG' if debug_mode else 'PRODUCTION'}")
@@ -990,5 +4686,12 @@ if __name__ == '__main__':
     print(f"🌐 Откройте в браузере: http://localhost:3000")
     print(f"🌐 Или с другого устройства: http://{local_ip}:3000")
 
+    # Асинхронный режим: сотни одновременных скачиваний в одном процессе
+    if '--async' in sys.argv:
+        if UVICORN_AVAILABLE:
+            uvicorn.run(asgi_app, host='0.0.0.0', port=3000)
+            sys.exit(0)
+        print("⚠️  Для --async установите uvicorn: pip install uvicorn")
+
     # Запуск сервера (доступен в локальной сети)
     app.run(host='0.0.0.0', port=3000, debug=debug_mode, threaded=True)
@@ -0,0 +1,426 @@
+"""Замеры производительности облака на синтетическом хранилище
+
+Скрипт создаёт во временной папке дерево storage/ (фото с настоящим EXIF по
+годам и месяцам, видео, глубоко вложенные документы, много мелких папок),
+запускает приложение в этом же процессе (Flask test client, без сети) и
+прогоняет типичные сценарии: открыть корень, открыть большой месяц, миниатюры
+с холодным и тёплым кешем, поиск по мере набора, раздел "Фото", загрузку пачки.
+
+Результат пишется в JSON, который можно сравнить с прошлым запуском:
+
+    python benchmark.py -o before.json
+    git checkout my-branch
+    python benchmark.py -o after.json --compare before.json
+
+С --compare скрипт завершается с кодом 1, если медиана какого-то сценария
+выросла больше допустимого (REGRESSION_THRESHOLDS). Сравнивать имеет смысл
+только запуски на одной машине с одинаковыми параметрами дерева.
+"""
+
+import argparse
+import atexit
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from PIL import Image
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Допустимый рост медианы сценария относительно прошлого запуска (доля)
+REGRESSION_THRESHOLDS = {
+    'index_build': 0.5,  # Один замер - шумит сильнее остальных
+    'thumb_cold': 0.4,
+    'upload_batch': 0.4,
+}
+DEFAULT_THRESHOLD = 0.25
+REGRESSION_MIN_DELTA = 0.002  # Секунд: разница меньше считается шумом
+
+PHOTO_YEARS = range(2019, 2025)
+LARGE_MONTH = (2024, 5)  # Папка Фото/2024/Май получает --month-photos фото
+CAMERAS = (('samsung', 'SM-A546E'), ('Xiaomi', 'Redmi 14C'), ('Apple', 'iPhone 13'))
+SEARCH_QUERY = 'IMG_2024'  # Набирается по одной букве, каждая буква - запрос /api/search
+
+
+# ==================== Генерация хранилища ====================
+
+def make_photo(rng, base, taken, size):
+    """JPEG с EXIF (дата съемки, камера) и уникальным содержимым"""
+    image = base.resize(size) if base.size != size else base.copy()
+    # Цветной прямоугольник в случайном месте - у каждого фото свои байты
+    w, h = size
+    box = (rng.randrange(w // 2), rng.randrange(h // 2))
+    patch = Image.new('RGB', (w // 3, h // 3), tuple(rng.randrange(256) for _ in range(3)))
+    image.paste(patch, box)
+
+    make, model = rng.choice(CAMERAS)
+    stamp = taken.strftime('%Y:%m:%d %H:%M:%S')
+    exif = Image.Exif()
+    exif[271] = make  # Make
+    exif[272] = model  # Model
+    exif[306] = stamp  # DateTime
+    sub_ifd = exif.get_ifd(0x8769)
+    sub_ifd[36867] = stamp  # DateTimeOriginal
+    sub_ifd[36868] = stamp  # DateTimeDigitized
+
+    buf = io.BytesIO()
+    image.save(buf, 'JPEG', quality=85, exif=exif)
+    return buf.getvalue()
+
+def noise_base(size):
+    """Шумное изображение - сжимается и декодируется как настоящая фотография"""
+    channels = [Image.effect_noise(size, 60 + 20 * i) for i in range(3)]
+    return Image.merge('RGB', channels)
+
+def random_moment(rng, year, month):
+    start = datetime(year, month, 1)
+    return start + timedelta(seconds=rng.randrange(28 * 24 * 3600))
+
+def write_file(path, data, taken=None):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    if taken is not None:
+        stamp = taken.timestamp()
+        os.utime(path, (stamp, stamp))
+
+def make_video_sample(work_dir):
+    """Короткий настоящий ролик через ffmpeg (если есть), иначе None"""
+    ffmpeg = shutil.which('ffmpeg')
+    if not ffmpeg:
+        return None
+    path = os.path.join(work_dir, 'sample.mp4')
+    result = subprocess.run(
+        [ffmpeg, '-v', 'error', '-y', '-f', 'lavfi', '-i', 'testsrc=duration=2:size=640x360:rate=25',
+         '-c:v', 'libx264', '-pix_fmt', 'yuv420p', path],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if result.returncode != 0 or not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return f.read()
+
+def generate_storage(app_module, args):
+    """Создать хранилище приложения (папки Фото|Видео/Год/Месяц - как при загрузке)
+
+    Returns:
+        dict с путями, нужными сценариям (относительно storage)
+    """
+    rng = random.Random(args.seed)
+    storage = app_module.app.config['UPLOAD_FOLDER']
+    size = tuple(int(x) for x in args.photo_size.split('x'))
+    base = noise_base(size)
+
+    def media_path(root, prefix, taken, ext):
+        # Имена как у камеры телефона: IMG_20240512_101500.jpg
+        folder = app_module.dated_folder(root, taken).replace(os.sep, '/')
+        name = f'{prefix}_{taken:%Y%m%d_%H%M%S}'
+        rel = f'{folder}/{name}{ext}'
+        while os.path.exists(os.path.join(storage, rel)):
+            taken += timedelta(seconds=1)
+            name = f'{prefix}_{taken:%Y%m%d_%H%M%S}'
+            rel = f'{folder}/{name}{ext}'
+        return rel, taken
+
+    # Фото по разным месяцам, большой месяц заполняется отдельно
+    months = [(y, m) for y in PHOTO_YEARS for m in range(1, 13) if (y, m) != LARGE_MONTH]
+    plan = [rng.choice(months) for _ in range(args.photos)] + [LARGE_MONTH] * args.month_photos
+    photos = []
+    for year, month in plan:
+        rel, taken = media_path('Фото', 'IMG', random_moment(rng, year, month), '.jpg')
+        write_file(os.path.join(storage, rel), make_photo(rng, base, taken, size), taken)
+        photos.append(rel)
+
+    # Видео: настоящий ролик, если есть ffmpeg; иначе заглушки нужного размера -
+    # для списков и разделов этого хватает, постеры видео здесь не замеряются
+    video_data = make_video_sample(os.path.dirname(storage))
+    for _ in range(args.videos):
+        rel, taken = media_path('Видео', 'VID', random_moment(rng, *rng.choice(months)), '.mp4')
+        write_file(os.path.join(storage, rel), video_data or rng.randbytes(256 * 1024), taken)
+
+    # Документы: цепочка вложенных папок глубиной --depth
+    folder = 'Документы/Проекты'
+    for level in range(args.depth):
+        folder = f'{folder}/Уровень {level + 1}'
+        for i in range(3):
+            write_file(os.path.join(storage, folder, f'Отчёт {level + 1}-{i + 1}.txt'),
+                       f'Отчёт {level} {i}\n'.encode() * rng.randrange(10, 200))
+
+    # Много небольших папок с разными файлами
+    for i in range(args.folders):
+        folder = os.path.join(storage, 'Разное', f'Папка {i:04d}')
+        for j in range(rng.randrange(1, 6)):
+            ext = rng.choice(('txt', 'pdf', 'json', 'zip'))
+            write_file(os.path.join(folder, f'файл_{j}.{ext}'), rng.randbytes(rng.randrange(100, 20000)))
+
+    large_month = app_module.dated_folder('Фото', datetime(*LARGE_MONTH, 1)).replace(os.sep, '/')
+    # Для холодных миниатюр - фото вне большого месяца (его миниатюры не трогают другие сценарии)
+    others = [rel for rel in photos if not rel.startswith(large_month + '/')]
+    return {
+        'large_month': large_month,
+        'thumb_sample': rng.sample(others, min(args.thumbs, len(others))),
+        'photo_size': size,
+        'base': base,
+        'rng': rng,
+    }
+
+
+# ==================== Сценарии ====================
+
+def fetch(client, url, expected=200, **kwargs):
+    """Выполнить запрос и дочитать ответ (для файлов - весь поток)"""
+    method = kwargs.pop('method', 'GET')
+    response = client.open(url, method=method, **kwargs)
+    response.get_data()
+    response.close()
+    if response.status_code != expected:
+        raise RuntimeError(f'{method} {url}: {response.status_code}, ожидался {expected}')
+    return response
+
+def timed(samples, func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    samples.append(time.perf_counter() - start)
+    return result
+
+def repeat(client, url, args):
+    for _ in range(args.warmup):
+        fetch(client, url)
+    samples = []
+    for _ in range(args.repeat):
+        timed(samples, fetch, client, url)
+    return samples
+
+def scenario_list_pages(client, url, args):
+    """Пролистать весь месяц через /api/list (один замер - все страницы подряд)"""
+    def walk():
+        cursor = None
+        while True:
+            query = {'cursor': cursor} if cursor else {}
+            data = client.get(url, query_string=query).get_json()
+            cursor = data['next_cursor']
+            if not cursor:
+                return
+    walk()
+    samples = []
+    for _ in range(args.repeat):
+        timed(samples, walk)
+    return samples
+
+def scenario_thumbs(client, paths):
+    """Каждая миниатюра - отдельный замер"""
+    samples = []
+    for rel in paths:
+        timed(samples, fetch, client, f'/thumb/{rel}')
+    return samples
+
+def scenario_search(client, args):
+    """Поиск по мере набора: запросы 'I', 'IM', 'IMG', ... - каждый отдельный замер"""
+    prefixes = [SEARCH_QUERY[:n] for n in range(1, len(SEARCH_QUERY) + 1)]
+    for query in prefixes[:args.warmup]:
+        fetch(client, '/api/search', query_string={'q': query})
+    samples = []
+    for _ in range(max(1, args.repeat // len(prefixes))):
+        for query in prefixes:
+            timed(samples, fetch, client, '/api/search', query_string={'q': query})
+    return samples
+
+def scenario_upload(app_module, client, tree, args):
+    """Загрузка пачки фото через /upload (одна пачка - один замер)
+
+    Байты готовятся заранее и у каждого файла свои, иначе сработает
+    защита от повторной загрузки (DEDUP_MODE) и файлы не будут записаны.
+    """
+    rng = tree['rng']
+    batches = []
+    for b in range(args.upload_rounds):
+        batch = []
+        for i in range(args.upload_batch):
+            taken = random_moment(rng, 2025, 1 + b % 12)
+            batch.append((make_photo(rng, tree['base'], taken, tree['photo_size']),
+                          f'upload_{b:03d}_{i:03d}.jpg'))
+        batches.append(batch)
+
+    samples = []
+    for batch in batches:
+        files = [(io.BytesIO(data), name) for data, name in batch]
+        timed(samples, fetch, client, '/upload', expected=302, method='POST',
+              data={'file': files, 'current_path': ''}, content_type='multipart/form-data')
+        # Фоновый прогрев миниатюр новых фото не должен попадать в следующий замер
+        wait_idle(app_module)
+    return samples
+
+def wait_idle(app_module, timeout=120):
+    deadline = time.time() + timeout
+    while app_module.prewarm_pending() and time.time() < deadline:
+        time.sleep(0.05)
+
+def summarize(samples):
+    ordered = sorted(samples)
+    return {
+        'samples': len(ordered),
+        'min': ordered[0],
+        'median': statistics.median(ordered),
+        'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        'mean': statistics.fmean(ordered),
+        'total': sum(ordered),
+    }
+
+def load_app(work_dir):
+    """Импортировать приложение так, чтобы storage, индекс и кеш миниатюр были в work_dir"""
+    os.chdir(work_dir)
+    sys.path.insert(0, REPO_DIR)
+    import app as app_module
+    # send_file считает относительные пути от папки app.py, а не от текущей
+    app_module.app.config['UPLOAD_FOLDER'] = os.path.join(work_dir, app_module.UPLOAD_FOLDER)
+    app_module.THUMBNAIL_CACHE_FOLDER = os.path.join(work_dir, app_module.THUMBNAIL_CACHE_FOLDER)
+    app_module.METRICS_FOLDER = os.path.join(work_dir, app_module.METRICS_FOLDER)
+
+    # Периодические сверка хранилища и чистка кеша не должны запускаться посреди замеров
+    app_module.claim_periodic_job('storage_reconcile', app_module.WATCHER_RECONCILE_INTERVAL)
+    app_module.claim_periodic_job('thumb_sweep', app_module.THUMBNAIL_SWEEP_INTERVAL)
+    return app_module
+
+def run_scenarios(app_module, tree, args):
+    client = app_module.app.test_client()
+    month = tree['large_month']
+    results = {}
+
+    def record(name, samples):
+        results[name] = summarize(samples)
+        stats = results[name]
+        print(f"⏱️  {name:<18} медиана {stats['median'] * 1000:8.1f} мс   "
+              f"p95 {stats['p95'] * 1000:8.1f} мс   ({stats['samples']} замеров)")
+
+    # Первое открытие: индекс папок строится с нуля
+    samples = []
+    timed(samples, fetch, client, '/browse/')
+    record('index_build', samples)
+    record('browse_root', repeat(client, '/browse/', args))
+    record('browse_month', repeat(client, f'/browse/{month}', args))
+    record('list_month_pages', scenario_list_pages(client, f'/api/list/{month}', args))
+    record('thumb_cold', scenario_thumbs(client, tree['thumb_sample']))
+    record('thumb_warm', scenario_thumbs(client, tree['thumb_sample']))
+    record('search_keystroke', scenario_search(client, args))
+    record('category_image', repeat(client, '/category/image', args))
+    record('upload_batch', scenario_upload(app_module, client, tree, args))
+    return results
+
+
+# ==================== Сравнение запусков ====================
+
+def git_revision():
+    """Коммит, на котором сделан замер (с пометкой о незакоммиченных изменениях)"""
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                                  capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_DIR,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return revision + ('-dirty' if dirty else '')
+
+def compare(baseline, current):
+    """Сравнить медианы сценариев с прошлым запуском
+
+    Returns:
+        список сценариев, ставших медленнее допустимого
+    """
+    if baseline.get('params') != current['params']:
+        print("⚠️  Параметры хранилища отличаются от прошлого запуска - сравнение неточное")
+    print(f"\n📊 Сравнение с {baseline.get('revision') or 'прошлым запуском'}:")
+    regressions = []
+    for name, stats in current['results'].items():
+        old = baseline.get('results', {}).get(name)
+        if old is None:
+            print(f"   {name:<18} новый сценарий")
+            continue
+        delta = stats['median'] - old['median']
+        change = delta / old['median'] if old['median'] else 0.0
+        threshold = REGRESSION_THRESHOLDS.get(name, DEFAULT_THRESHOLD)
+        regressed = change > threshold and delta > REGRESSION_MIN_DELTA
+        mark = '❌' if regressed else ('✅' if change < -threshold and -delta > REGRESSION_MIN_DELTA else '  ')
+        print(f"{mark} {name:<18} {old['median'] * 1000:8.1f} → {stats['median'] * 1000:8.1f} мс "
+              f"({change:+.0%}, допустимо +{threshold:.0%})")
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Замеры производительности облака на синтетическом хранилище')
+    parser.add_argument('-o', '--output', default='benchmark.json', help='куда записать результаты (JSON)')
+    parser.add_argument('--compare', metavar='JSON', help='прошлый результат: код 1 при замедлении')
+    parser.add_argument('--dir', help='рабочая папка (по умолчанию временная, удаляется после замеров)')
+    parser.add_argument('--seed', type=int, default=1, help='зерно генератора дерева')
+    parser.add_argument('--photos', type=int, default=1500, help='фото по разным месяцам')
+    parser.add_argument('--month-photos', type=int, default=600, help='фото в большом месяце Фото/2024/05')
+    parser.add_argument('--photo-size', default='1600x1200', help='размер фото, ШxВ')
+    parser.add_argument('--videos', type=int, default=60)
+    parser.add_argument('--folders', type=int, default=300, help='папок в Разное')
+    parser.add_argument('--depth', type=int, default=20, help='глубина вложенности Документы')
+    parser.add_argument('--thumbs', type=int, default=40, help='миниатюр в сценариях thumb_cold и thumb_warm')
+    parser.add_argument('--upload-batch', type=int, default=10, help='фото в одной пачке загрузки')
+    parser.add_argument('--upload-rounds', type=int, default=5, help='сколько пачек загрузить')
+    parser.add_argument('--repeat', type=int, default=20, help='замеров в повторяемых сценариях')
+    parser.add_argument('--warmup', type=int, default=2, help='прогревочных запросов перед замерами')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    output = os.path.abspath(args.output)
+    baseline_path = os.path.abspath(args.compare) if args.compare else None
+    work_dir = os.path.abspath(args.dir) if args.dir else tempfile.mkdtemp(prefix='cloud-bench-')
+    if args.dir and os.path.exists(work_dir) and os.listdir(work_dir):
+        sys.exit(f"❌ Папка {work_dir} не пуста - укажите пустую или новую папку")
+    os.makedirs(work_dir, exist_ok=True)
+
+    app_module = None
+    try:
+        print(f"📁 Создаю хранилище в {work_dir}...")
+        start = time.perf_counter()
+        app_module = load_app(work_dir)
+        tree = generate_storage(app_module, args)
+        print(f"✅ Хранилище готово за {time.perf_counter() - start:.1f} с")
+        results = run_scenarios(app_module, tree, args)
+    finally:
+        if not args.dir:
+            # Иначе при выходе приложение снова создаст в удалённой папке .metrics
+            if app_module is not None:
+                atexit.unregister(app_module.metrics_flush)
+            os.chdir(REPO_DIR)
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    params = {key: value for key, value in vars(args).items()
+              if key not in ('output', 'compare', 'dir', 'repeat', 'warmup')}
+    report = {
+        'revision': git_revision(),
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'params': params,
+        'results': results,
+    }
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"💾 Результаты: {output}")
+
+    if baseline_path:
+        with open(baseline_path, encoding='utf-8') as f:
+            regressions = compare(json.load(f), report)
+        if regressions:
+            print(f"❌ Замедлились: {', '.join(regressions)}")
+            sys.exit(1)
+        print("✅ Замедлений нет")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,16 @@
-const CACHE_NAME = 'home-cloud-v1';
+const CACHE_NAME = 'home-cloud-v2';
+const THUMB_CACHE_NAME = 'home-cloud-thumbs-v1';
+// Сколько миниатюр хранить (≈ 20 КБ каждая); сверх этого удаляются самые старые
+const THUMB_CACHE_MAX_ENTRIES = 2000;
+// Проверять размер кеша раз в столько новых миниатюр, а не на каждую
+const THUMB_CACHE_TRIM_EVERY = 50;
 const urlsToCache = [
   '/',
   '/static/manifest.json'
 ];
 
+let thumbsAdded = 0;
+
 // Установка Service Worker
 self.addEventListener('install', event => {
   event.waitUntil(
@@ -18,7 +25,7 @@ self.addEventListener('activate', event => {
     caches.keys().then(cacheNames => {
       return Promise.all(
         cacheNames.map(cacheName => {
-          if (cacheName !== CACHE_NAME) {
+          if (cacheName !== CACHE_NAME && cacheName !== THUMB_CACHE_NAME) {
             return caches.delete(cacheName);
           }
         })
@@ -27,13 +34,44 @@ self.addEventListener('activate', event => {
   );
 });
 
+// Удалить самые старые миниатюры сверх лимита (keys() - в порядке добавления)
+async function trimThumbCache(cache) {
+  const keys = await cache.keys();
+  const excess = keys.length - THUMB_CACHE_MAX_ENTRIES;
+  for (let i = 0; i < excess; i++) {
+    await cache.delete(keys[i]);
+  }
+}
+
+// Миниатюра с отпечатком в URL (?v=) не меняется - берём из кеша без сети
+async function thumbnailFromCache(event) {
+  const cache = await caches.open(THUMB_CACHE_NAME);
+  const cached = await cache.match(event.request);
+  if (cached) {
+    return cached;
+  }
+  const response = await fetch(event.request);
+  if (response.ok) {
+    await cache.put(event.request, response.clone());
+    if (++thumbsAdded % THUMB_CACHE_TRIM_EVERY === 0) {
+      event.waitUntil(trimThumbCache(cache));
+    }
+  }
+  return response;
+}
+
 // Обработка запросов
 self.addEventListener('fetch', event => {
+  const url = new URL(event.request.url);
+  if (event.request.method !== 'GET' || url.origin !== self.location.origin) {
+    return;
+  }
+  if (url.pathname.startsWith('/thumb/') && url.searchParams.has('v')) {
+    event.respondWith(thumbnailFromCache(event));
+    return;
+  }
+  // Остальное - из сети (списки папок меняются), кеш - только без сети
   event.respondWith(
-    caches.match(event.request)
-      .then(response => {
-        // Возвращаем кеш или делаем запрос
-        return response || fetch(event.request);
-      })
+    fetch(event.request).catch(() => caches.match(event.request))
   );
 });
@@ -0,0 +1,78 @@
+"""Общие фикстуры: приложение с хранилищем, индексом и кешами во временной папке"""
+
+import io
+import os
+import sys
+import tempfile
+import threading
+
+import pytest
+from PIL import Image
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+# При импорте app создаёт storage, .thumbcache и базу индекса в текущей папке -
+# пусть это будет не папка проекта
+_cwd = os.getcwd()
+_import_dir = tempfile.mkdtemp(prefix='cloud-tests-')
+os.chdir(_import_dir)
+try:
+    import app as cloud_app
+finally:
+    os.chdir(_cwd)
+# Метрики сохраняются и при выходе из процесса, уже после тестов
+cloud_app.METRICS_FOLDER = os.path.join(_import_dir, cloud_app.METRICS_FOLDER)
+
+
+@pytest.fixture
+def cloud(tmp_path, monkeypatch):
+    """Модуль app, настроенный на пустое хранилище в tmp_path"""
+    storage = tmp_path / 'storage'
+    storage.mkdir()
+    (tmp_path / 'thumbcache').mkdir()
+    monkeypatch.setitem(cloud_app.app.config, 'UPLOAD_FOLDER', str(storage))
+    monkeypatch.setattr(cloud_app, 'THUMBNAIL_CACHE_FOLDER', str(tmp_path / 'thumbcache'))
+    monkeypatch.setattr(cloud_app, 'INDEX_DB_PATH', str(tmp_path / 'index.db'))
+    monkeypatch.setattr(cloud_app, 'METRICS_FOLDER', str(tmp_path / 'metrics'))
+    monkeypatch.setattr(cloud_app, 'PROFILE_FOLDER', str(tmp_path / 'profiles'))
+    monkeypatch.setattr(cloud_app, '_index_local', threading.local())
+    monkeypatch.setattr(cloud_app, '_metric_values', {})
+    monkeypatch.setattr(cloud_app, '_upload_digests', {})
+    monkeypatch.setattr(cloud_app, '_prewarm_queue', {})
+    # Фоновые потоки (наблюдение, чистка кеша, прогрев, перекодирование) в тестах
+    # не запускаются: они держали бы соединение с базой прошлого теста
+    for name in ('_watcher_pid', '_thumb_sweeper_pid', '_prewarm_pid', '_transcode_pid'):
+        monkeypatch.setattr(cloud_app, name, os.getpid())
+    cloud_app.init_index_db()
+    yield cloud_app
+    conn = getattr(cloud_app._index_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+
+
+@pytest.fixture
+def client(cloud):
+    return cloud.app.test_client()
+
+
+@pytest.fixture
+def storage(cloud):
+    """Функция: записать файл в хранилище и вернуть его полный путь"""
+    def write(rel, data):
+        path = os.path.join(cloud.app.config['UPLOAD_FOLDER'], rel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+    return write
+
+
+@pytest.fixture
+def jpeg_bytes():
+    """Функция: JPEG из шума заданного размера (не сжимается в пару сотен байт)"""
+    def make(size=(640, 480)):
+        buffer = io.BytesIO()
+        Image.effect_noise(size, 64).convert('RGB').save(buffer, 'JPEG')
+        return buffer.getvalue()
+    return make
@@ -0,0 +1,102 @@
+"""Асинхронный режим: AsgiAdapter поверх Flask без uvicorn (scope, receive и send - свои)"""
+
+import asyncio
+import io
+import json
+import os
+
+import pytest
+from werkzeug.datastructures import FileStorage
+from werkzeug.test import encode_multipart
+
+
+@pytest.fixture
+def adapter(cloud):
+    adapter = cloud.AsgiAdapter(cloud.app, threads=4)
+    yield adapter
+    adapter.executor.shutdown(wait=True)
+
+
+def http_scope(method, path, query=b'', headers=()):
+    return {
+        'type': 'http', 'method': method, 'path': path, 'query_string': query,
+        'http_version': '1.1', 'scheme': 'http', 'root_path': '',
+        'server': ('testserver', 80), 'client': ('127.0.0.1', 50000),
+        'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers],
+    }
+
+
+def call(adapter, scope, body_parts=(b'',), disconnect_after=None):
+    """Выполнить запрос: (статус, заголовки, тело). disconnect_after - обрыв после стольких частей ответа"""
+    messages = []
+
+    async def run():
+        sent_body = asyncio.Event()
+        pending = [{'type': 'http.request', 'body': part, 'more_body': i < len(body_parts) - 1}
+                   for i, part in enumerate(body_parts)]
+
+        async def receive():
+            if pending:
+                return pending.pop(0)
+            if disconnect_after is not None:
+                await sent_body.wait()
+                return {'type': 'http.disconnect'}
+            await asyncio.Event().wait()  # Клиент на связи, пока ответ не отправлен
+
+        async def send(message):
+            messages.append(message)
+            body_count = sum(1 for m in messages if m['type'] == 'http.response.body' and m['body'])
+            if disconnect_after is not None and body_count >= disconnect_after:
+                sent_body.set()
+                await asyncio.sleep(0.01)  # Дать обрыву дойти до адаптера
+
+        await asyncio.wait_for(adapter(scope, receive, send), timeout=10)
+
+    asyncio.run(run())
+    start = messages[0]
+    assert start['type'] == 'http.response.start'
+    assert messages[-1] == {'type': 'http.response.body', 'body': b'', 'more_body': False}
+    headers = {k.decode('latin-1'): v.decode('latin-1') for k, v in start['headers']}
+    return start['status'], headers, b''.join(m.get('body', b'') for m in messages[1:])
+
+
+def test_plain_get(adapter, storage):
+    storage('Документы/отчёт.txt', b'hello')
+    status, headers, body = call(adapter, http_scope('GET', '/api/list/Документы'))
+    assert status == 200 and headers['content-type'].startswith('application/json')
+    assert [item['name'] for item in json.loads(body)['items']] == ['отчёт.txt']
+
+
+def test_range_on_preview(adapter, storage):
+    data = os.urandom(100_000)
+    storage('Видео/клип.mp4', data)
+    status, headers, body = call(adapter, http_scope('GET', '/preview/Видео/клип.mp4',
+                                                     headers=[('Range', 'bytes=10-19')]))
+    assert status == 206
+    assert headers['content-range'] == f'bytes 10-19/{len(data)}'
+    assert body == data[10:20]
+
+    status, _, body = call(adapter, http_scope('HEAD', '/preview/Видео/клип.mp4'))
+    assert status == 200 and body == b''
+
+
+def test_streamed_upload(cloud, adapter):
+    data = os.urandom(300_000)
+    boundary, payload = encode_multipart({'current_path': 'Архив',
+                                          'file': FileStorage(io.BytesIO(data), 'данные.bin')})
+    parts = [payload[i:i + 65536] for i in range(0, len(payload), 65536)]
+    headers = [('Content-Type', f'multipart/form-data; boundary={boundary}'),
+               ('Content-Length', str(len(payload)))]
+    status, _, _ = call(adapter, http_scope('POST', '/upload_direct', headers=headers), body_parts=parts)
+    assert status == 302
+    with open(cloud.storage_path('Архив/данные.bin'), 'rb') as f:
+        assert f.read() == data
+
+
+def test_client_disconnect_stops_file_stream(cloud, adapter, storage):
+    size = cloud.ASGI_FILE_BLOCK * 8
+    storage('Видео/большое.mp4', os.urandom(size))
+    status, headers, body = call(adapter, http_scope('GET', '/download/Видео/большое.mp4'),
+                                 disconnect_after=1)
+    assert status == 200 and int(headers['content-length']) == size
+    assert 0 < len(body) < size
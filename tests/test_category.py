@@ -0,0 +1,58 @@
+"""Разделы категорий: файлы всего поддерева из индекса, постранично и с сортировкой"""
+
+import os
+
+import pytest
+
+
+@pytest.fixture
+def photos(cloud, storage, monkeypatch):
+    monkeypatch.setattr(cloud, 'LIST_PAGE_SIZE', 4)
+    for i, rel in enumerate(['Фото/2024/01/a.jpg', 'Фото/2024/02/b.jpg', 'Фото/2023/12/c.png',
+                             'Фото/d.jpg', 'Фото/2024/01/заметка.txt', 'Видео/e.mp4']):
+        path = storage(rel, b'x' * (i + 1))
+        os.utime(path, (1_700_000_000 + i, 1_700_000_000 + i))
+    return cloud
+
+
+def category(client, name='image', path='', **params):
+    response = client.get(f'/api/category/{name}/{path}', query_string=params)
+    assert response.status_code == 200
+    data = response.get_json()
+    return [item['path'] for item in data['items']], data['next_cursor']
+
+
+def test_category_lists_whole_subtree(client, photos):
+    paths, cursor = category(client, path='Фото', limit=10)
+    assert paths == ['Фото/2024/01/a.jpg', 'Фото/2024/02/b.jpg', 'Фото/2023/12/c.png', 'Фото/d.jpg']
+    assert cursor is None
+    assert category(client, 'document')[0] == ['Фото/2024/01/заметка.txt']
+
+    paths, _ = category(client, path='Фото', sort='date', limit=10)
+    assert paths == ['Фото/d.jpg', 'Фото/2023/12/c.png', 'Фото/2024/02/b.jpg', 'Фото/2024/01/a.jpg']
+    paths, _ = category(client, path='Фото', sort='size', limit=10)
+    assert paths[0] == 'Фото/d.jpg'
+
+
+def test_category_pages(client, photos):
+    first, cursor = category(client, limit=3)
+    rest, end = category(client, limit=3, cursor=cursor)
+    assert first + rest == category(client, limit=10)[0] and end is None
+
+
+def test_category_sees_files_added_outside_app(cloud, client, storage, photos):
+    assert len(category(client, path='Фото')[0]) == 4
+    # Скопировано в глубокую папку в обход приложения, до истечения FOLDER_INDEX_TTL
+    storage('Фото/2024/02/f.jpg', b'new')
+    os.remove(cloud.storage_path('Фото/2023/12/c.png'))
+    paths, _ = category(client, path='Фото', limit=10)
+    assert 'Фото/2024/02/f.jpg' in paths and 'Фото/2023/12/c.png' not in paths
+    html = client.get('/category/image/Фото').get_data(as_text=True)
+    assert 'const PAGE_SIZE = 4;' in html and 'f.jpg' in html
+
+
+def test_category_errors(client, photos):
+    assert client.get('/api/category/music/').status_code == 404
+    assert client.get('/api/category/image/', query_string={'sort': 'random'}).status_code == 400
+    assert client.get('/api/category/image/Нет').status_code == 404
+    assert client.get('/api/category/image/', query_string={'cursor': 'битый'}).status_code == 400
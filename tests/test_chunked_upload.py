@@ -0,0 +1,90 @@
+"""Загрузка частями (/api/uploads): смещения, контрольные суммы, докачка и отмена"""
+
+import base64
+import hashlib
+import os
+
+
+def create(client, size, filename='video.bin', current_path='Видео'):
+    response = client.post('/api/uploads', json={'filename': filename, 'size': size,
+                                                 'current_path': current_path, 'sort': False})
+    assert response.status_code == 201
+    assert response.headers['Location'] == response.get_json()['url']
+    return response.get_json()['id']
+
+
+def send(client, upload_id, offset, data, **headers):
+    return client.patch(f'/api/uploads/{upload_id}', data=data,
+                        headers={'Upload-Offset': str(offset), **headers})
+
+
+def test_resume_after_interruption(cloud, client):
+    data = os.urandom(5000)
+    upload_id = create(client, len(data))
+    status = client.head(f'/api/uploads/{upload_id}')
+    assert (status.headers['Upload-Offset'], status.headers['Upload-Length']) == ('0', '5000')
+
+    assert send(client, upload_id, 0, data[:2000]).status_code == 204
+    # Ответ на часть потерялся - клиент спрашивает, сколько принято, и продолжает
+    assert client.get(f'/api/uploads/{upload_id}').get_json() == {'offset': 2000, 'size': 5000}
+    response = send(client, upload_id, 2000, data[2000:])
+    assert response.status_code == 204 and response.headers['Upload-Offset'] == '5000'
+
+    result = client.post(f'/api/uploads/{upload_id}/finish').get_json()
+    assert result == {'path': 'Видео/video.bin', 'duplicate_of': None, 'stored': True}
+    with open(cloud.storage_path('Видео/video.bin'), 'rb') as f:
+        assert f.read() == data
+    assert client.get(f'/api/uploads/{upload_id}').status_code == 404
+
+
+def test_wrong_offset_is_rejected(client):
+    upload_id = create(client, 3000)
+    assert send(client, upload_id, 0, b'a' * 1000).status_code == 204
+    for offset in (0, 1500):
+        response = send(client, upload_id, offset, b'b' * 1000)
+        assert response.status_code == 409
+        assert response.get_json()['offset'] == 1000
+    assert send(client, upload_id, 0, b'x').status_code == 409
+    assert client.patch(f'/api/uploads/{upload_id}', data=b'x').status_code == 400
+
+
+def test_checksum(client):
+    data = os.urandom(1000)
+    upload_id = create(client, 2000)
+    response = send(client, upload_id, 0, data, **{'Upload-Checksum': 'sha256 ' + base64.b64encode(b'0' * 32).decode()})
+    assert response.status_code == 460
+    assert client.get(f'/api/uploads/{upload_id}').get_json()['offset'] == 0
+
+    checksum = 'sha256 ' + base64.b64encode(hashlib.sha256(data).digest()).decode()
+    assert send(client, upload_id, 0, data, **{'Upload-Checksum': checksum}).status_code == 204
+    assert send(client, upload_id, 1000, b'y', **{'Upload-Checksum': 'crc32 AAAA'}).status_code == 400
+
+
+def test_limits(cloud, client, monkeypatch):
+    upload_id = create(client, 1000)
+    assert send(client, upload_id, 0, b'x' * 1001).status_code == 413
+    monkeypatch.setattr(cloud, 'UPLOAD_CHUNK_MAX', 100)
+    assert send(client, upload_id, 0, b'x' * 101).status_code == 413
+
+    assert send(client, upload_id, 0, b'x' * 100).status_code == 204
+    response = client.post(f'/api/uploads/{upload_id}/finish')
+    assert response.status_code == 409 and response.get_json()['offset'] == 100
+
+
+def test_bad_requests(client):
+    assert client.post('/api/uploads', json={'filename': 'a.bin'}).status_code == 400
+    assert client.post('/api/uploads', json={'filename': 'a.bin', 'size': -1}).status_code == 400
+    assert client.post('/api/uploads', json={'filename': 'a.bin', 'size': 1,
+                                             'current_path': '../..'}).status_code == 400
+    assert client.get('/api/uploads/' + 'f' * 32).status_code == 404
+    assert client.get('/api/uploads/../../etc').status_code == 404
+
+
+def test_cancel(cloud, client):
+    upload_id = create(client, 2000)
+    assert send(client, upload_id, 0, b'x' * 500).status_code == 204
+    assert client.delete(f'/api/uploads/{upload_id}').status_code == 204
+    assert client.get(f'/api/uploads/{upload_id}').status_code == 404
+    assert client.delete(f'/api/uploads/{upload_id}').status_code == 404
+    incoming = cloud.storage_path(cloud.INGEST_FOLDER)
+    assert not [name for name in os.listdir(incoming) if name.startswith(upload_id)]
@@ -0,0 +1,62 @@
+"""Повторы при загрузке частями: хеш содержимого считается по ходу приёма частей"""
+
+import hashlib
+import os
+
+import pytest
+
+
+def upload_in_chunks(client, data, filename='report.bin', chunk=1000, current_path='Документы'):
+    created = client.post('/api/uploads', json={'filename': filename, 'size': len(data),
+                                                'current_path': current_path, 'sort': False})
+    assert created.status_code == 201
+    upload_id = created.get_json()['id']
+    for offset in range(0, len(data), chunk):
+        response = client.patch(f'/api/uploads/{upload_id}', data=data[offset:offset + chunk],
+                                headers={'Upload-Offset': str(offset)})
+        assert response.status_code == 204
+    return upload_id
+
+
+def content_hash_of(cloud, rel):
+    row = cloud.get_index_db().execute('SELECT hash FROM content_hashes WHERE path = ?', (rel,)).fetchone()
+    return row['hash'] if row else None
+
+
+def test_chunked_upload_hash_is_kept_while_receiving(cloud, client, monkeypatch):
+    data = os.urandom(3500)
+    upload_id = upload_in_chunks(client, data)
+    assert cloud._upload_digests[upload_id][0] == len(data)
+
+    # Собранный файл не перечитывается целиком
+    monkeypatch.setattr(cloud, '_hash_file', lambda path: pytest.fail('файл перечитан'))
+    result = client.post(f'/api/uploads/{upload_id}/finish').get_json()
+    assert result['stored'] and result['path'] == 'Документы/report.bin'
+    assert content_hash_of(cloud, result['path']) == hashlib.sha256(data).hexdigest()
+    assert upload_id not in cloud._upload_digests
+
+
+def test_chunks_received_by_another_process_are_read_from_disk(cloud, client):
+    data = os.urandom(3500)
+    upload_id = upload_in_chunks(client, data)
+    # Как если бы части принимал другой воркер
+    cloud._upload_digests.clear()
+    result = client.post(f'/api/uploads/{upload_id}/finish').get_json()
+    assert content_hash_of(cloud, result['path']) == hashlib.sha256(data).hexdigest()
+
+
+def test_repeated_upload_is_linked_to_known_copy(cloud, client):
+    data = os.urandom(2500)
+    first = client.post(f'/api/uploads/{upload_in_chunks(client, data)}/finish').get_json()
+    second = client.post(f'/api/uploads/{upload_in_chunks(client, data, current_path="Архив")}/finish').get_json()
+    assert second == {'path': 'Архив/report.bin', 'duplicate_of': first['path'], 'stored': True}
+    assert os.path.samefile(cloud.storage_path(first['path']), cloud.storage_path(second['path']))
+
+
+def test_unhashed_files_are_not_hashed_during_upload(cloud, client, storage):
+    data = os.urandom(2500)
+    storage('Старое/copy.bin', data)
+    client.get('/browse/')  # Файл попадает в индекс, но не в content_hashes
+    result = client.post(f'/api/uploads/{upload_in_chunks(client, data)}/finish').get_json()
+    assert result['stored'] and result['duplicate_of'] is None
+    assert content_hash_of(cloud, 'Старое/copy.bin') is None
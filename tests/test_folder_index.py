@@ -0,0 +1,58 @@
+"""Индекс папок: дельты при добавлении, удалении и перезаписи файла"""
+
+import io
+import os
+
+import pytest
+
+
+def aggregates(cloud, rel):
+    """(size, files, own_size, own_files) папки прямо из индекса, без пересчёта с диска"""
+    row = cloud._index_get(rel)
+    return row['size'], row['files'], row['own_size'], row['own_files']
+
+
+@pytest.fixture
+def indexed(cloud, client, storage):
+    storage('Документы/a.txt', b'a' * 100)
+    storage('Документы/Отчёты/b.txt', b'b' * 40)
+    assert client.get('/browse/').status_code == 200
+    assert aggregates(cloud, 'Документы') == (140, 2, 100, 1)
+    return cloud
+
+
+def test_added_file(indexed, storage):
+    cloud = indexed
+    cloud.index_path_added(storage('Документы/Отчёты/c.txt', b'c' * 10))
+    assert aggregates(cloud, 'Документы/Отчёты') == (50, 2, 50, 2)
+    assert aggregates(cloud, 'Документы') == (150, 3, 100, 1)
+    assert cloud._index_get('')['files'] == 3
+
+
+def test_removed_file(indexed):
+    cloud = indexed
+    path = cloud.storage_path('Документы/Отчёты/b.txt')
+    os.remove(path)
+    cloud.index_path_removed(path, is_dir=False, size=40)
+    assert aggregates(cloud, 'Документы/Отчёты') == (0, 0, 0, 0)
+    assert aggregates(cloud, 'Документы') == (100, 1, 100, 1)
+    assert cloud._index_get('')['size'] == 100
+
+
+def test_removed_folder(indexed, client):
+    cloud = indexed
+    client.get('/delete/Документы/Отчёты')
+    assert cloud._index_get('Документы/Отчёты') is None
+    assert aggregates(cloud, 'Документы') == (100, 1, 100, 1)
+    assert cloud._index_get('Документы')['folders'] == 0
+
+
+def test_upload_over_existing_file(indexed, client):
+    cloud = indexed
+    response = client.post('/upload', data={'current_path': 'Документы',
+                                            'file': (io.BytesIO(os.urandom(250)), 'a.txt')})
+    assert response.status_code == 302
+    assert os.path.getsize(cloud.storage_path('Документы/a.txt')) == 250
+    # Файл заменён, а не добавлен: число файлов прежнее, размер - новый
+    assert aggregates(cloud, 'Документы') == (290, 2, 250, 1)
+    assert cloud._index_get('')['size'] == 290 and cloud._index_get('')['files'] == 2
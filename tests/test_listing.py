@@ -0,0 +1,77 @@
+"""Постраничный список папки: /api/list с курсором и первая страница в browse"""
+
+import base64
+import json
+import os
+
+import pytest
+
+
+@pytest.fixture
+def folder(cloud, storage, monkeypatch):
+    """Папка с 3 подпапками и 20 файлами; страница по умолчанию - 8 элементов"""
+    monkeypatch.setattr(cloud, 'LIST_PAGE_SIZE', 8)
+    for name in ('в', 'а', 'б'):
+        storage(f'Документы/{name}/readme.md', b'x')
+    for i in range(20):
+        path = storage(f'Документы/файл-{i:02d}.txt', b'x' * (i + 1))
+        os.utime(path, (1_700_000_000 - i, 1_700_000_000 - i))  # Сначала новые: файл-00 первый
+    return 'Документы'
+
+
+def page(client, folder, **params):
+    response = client.get(f'/api/list/{folder}', query_string=params)
+    assert response.status_code == 200
+    data = response.get_json()
+    return [item['name'] for item in data['items']], data['next_cursor']
+
+
+def test_page_size(cloud, client, folder):
+    names, cursor = page(client, folder, limit=5)
+    assert names == ['а', 'б', 'в', 'файл-00.txt', 'файл-01.txt'] and cursor
+    assert len(page(client, folder, limit=1000)[0]) == 23
+    # Неверный limit - страница по умолчанию
+    assert len(page(client, folder, limit='много')[0]) == 8
+
+
+def test_cursor_walks_whole_folder_once(client, folder):
+    seen, cursor = [], None
+    pages = 0
+    while True:
+        params = {'limit': 7, **({'cursor': cursor} if cursor else {})}
+        names, cursor = page(client, folder, **params)
+        seen += names
+        pages += 1
+        if cursor is None:
+            break
+    assert pages == 4
+    assert seen == ['а', 'б', 'в'] + [f'файл-{i:02d}.txt' for i in range(20)]
+
+
+def test_last_page_has_no_cursor(client, folder):
+    names, cursor = page(client, folder, limit=23)
+    assert len(names) == 23 and cursor is None
+    assert page(client, 'Документы/а') == (['readme.md'], None)
+
+
+@pytest.mark.parametrize('cursor', [
+    'не-base64!',
+    base64.urlsafe_b64encode(b'{"a": 1}').decode(),
+    base64.urlsafe_b64encode(json.dumps([1, 2, 3]).encode()).decode(),
+    base64.urlsafe_b64encode(json.dumps([{}, [], 0, 0, 'x']).encode()).decode(),
+])
+def test_invalid_cursor(client, folder, cursor):
+    response = client.get(f'/api/list/{folder}', query_string={'cursor': cursor})
+    assert response.status_code == 400
+    assert response.get_json()['error'] == 'Неверный курсор'
+
+
+def test_missing_folder(client, folder):
+    assert client.get('/api/list/Нет такой').status_code == 404
+
+
+def test_browse_renders_first_page(client, folder):
+    html = client.get(f'/browse/{folder}').get_data(as_text=True)
+    assert 'const PAGE_SIZE = 8;' in html
+    _, cursor = page(client, folder)
+    assert f'let nextCursor = {json.dumps(cursor)};' in html
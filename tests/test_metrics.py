@@ -0,0 +1,54 @@
+"""/metrics: формат Prometheus и гистограммы времени ответа по обработчикам"""
+
+import re
+
+SAMPLE = re.compile(r'^([a-z_]+)(?:\{(.*)\})? (\S+)$')
+
+
+def scrape(client):
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+    return response.get_data(as_text=True)
+
+
+def samples(text, name):
+    """{метки: значение} для строк метрики name"""
+    result = {}
+    for line in text.splitlines():
+        match = SAMPLE.match(line)
+        if match and match.group(1) == name:
+            labels = tuple(re.findall(r'(\w+)="((?:[^"\\]|\\.)*)"', match.group(2) or ''))
+            result[labels] = float(match.group(3))
+    return result
+
+
+def test_exposition_format(cloud, client):
+    text = scrape(client)
+    assert text.endswith('\n')
+    for name, (kind, help_text) in cloud.METRICS.items():
+        assert f'# HELP {name} {help_text}\n# TYPE {name} {kind}\n' in text
+    for line in text.splitlines():
+        assert line.startswith('# ') or SAMPLE.match(line), line
+
+
+def test_histogram_counts_requests_per_endpoint(cloud, client, storage):
+    storage('Документы/a.txt', b'a')
+    for _ in range(3):
+        assert client.get('/api/list/Документы').status_code == 200
+    client.get('/storage_info')
+    text = scrape(client)
+
+    buckets = samples(text, 'cloud_http_request_duration_seconds_bucket')
+    api_list = [(dict(labels)['le'], value) for labels, value in buckets.items()
+                if dict(labels)['endpoint'] == 'api_list']
+    bounds = [str(bound) for bound in cloud.METRIC_LATENCY_BUCKETS] + ['+Inf']
+    assert sorted(le for le, _ in api_list) == sorted(bounds)
+    counts = [dict(api_list)[le] for le in bounds]
+    assert counts == sorted(counts) and counts[-1] == 3
+
+    totals = samples(text, 'cloud_http_request_duration_seconds_count')
+    assert totals[(('endpoint', 'api_list'),)] == 3
+    assert totals[(('endpoint', 'storage_info'),)] == 1
+    assert samples(text, 'cloud_http_request_duration_seconds_sum')[(('endpoint', 'api_list'),)] > 0
+    assert samples(text, 'cloud_http_responses_total')[(('code', '200'), ('endpoint', 'api_list'))] == 3
@@ -0,0 +1,50 @@
+"""Версии и валидаторы /preview/: изменённый на месте файл получает новый ETag и URL"""
+
+import os
+
+
+def edit_in_place(path, offset, data):
+    """Изменить байты внутри файла, не меняя размер (и сдвинуть mtime)"""
+    st = os.stat(path)
+    with open(path, 'r+b') as f:
+        f.seek(offset)
+        f.write(data)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 5_000_000_000))
+
+
+def test_listing_version_matches_preview(client, storage):
+    storage('Видео/клип.mp4', os.urandom(1000))
+    item = client.get('/api/list/Видео').get_json()['items'][0]
+    response = client.get(f"/preview/Видео/клип.mp4?v={item['file_version']}")
+    assert response.status_code == 200
+    assert 'immutable' in response.headers['Cache-Control']
+    assert client.get('/preview/Видео/клип.mp4?v=старое').headers['Cache-Control'] == 'no-cache'
+
+
+def test_edit_outside_sampled_blocks_changes_validators(cloud, client, storage):
+    # Отпечаток читает начало, середину и конец - правка между ними его не меняет
+    path = storage('Видео/клип.mp4', os.urandom(1024 * 1024))
+    fp_before = cloud.file_fingerprint(path)
+    item = client.get('/api/list/Видео').get_json()['items'][0]
+    first = client.get('/preview/Видео/клип.mp4')
+    etag = first.headers['ETag']
+
+    edit_in_place(path, 200 * 1024, b'changed')
+    assert cloud.file_fingerprint(path) == fp_before
+
+    response = client.get('/preview/Видео/клип.mp4', headers={'If-None-Match': etag})
+    assert response.status_code == 200 and response.headers['ETag'] != etag
+    response = client.get(f"/preview/Видео/клип.mp4?v={item['file_version']}")
+    assert response.headers['Cache-Control'] == 'no-cache'
+
+    # Докачка по старому ETag получает файл целиком, а не диапазон новой версии
+    response = client.get('/preview/Видео/клип.mp4', headers={'Range': 'bytes=100-', 'If-Range': etag})
+    assert response.status_code == 200
+    with open(path, 'rb') as f:
+        assert response.data == f.read()
+
+
+def test_unchanged_preview_is_not_modified(client, storage):
+    storage('Документы/a.pdf', b'%PDF-1.4 test')
+    etag = client.get('/preview/Документы/a.pdf').headers['ETag']
+    assert client.get('/preview/Документы/a.pdf', headers={'If-None-Match': etag}).status_code == 304
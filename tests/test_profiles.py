@@ -0,0 +1,43 @@
+"""Профилирование: без порога и флага запросы не трогают профилировщик"""
+
+import os
+
+import pytest
+
+
+@pytest.fixture
+def profiling(cloud, monkeypatch):
+    monkeypatch.setattr(cloud, '_profile_all_until', 0.0)
+    monkeypatch.setattr(cloud, '_profile_active', {})
+    return cloud
+
+
+def test_disabled_by_default(profiling, client, monkeypatch):
+    assert profiling.PROFILE_SLOW_THRESHOLD is None
+    monkeypatch.setattr(profiling, '_start_profiler', lambda: pytest.fail('запущен профилировщик'))
+    monkeypatch.setattr(profiling, 'METRICS_FLUSH_INTERVAL', 3600)
+    monkeypatch.setattr(profiling, '_metrics_flushed_at', profiling.time.time())
+    monkeypatch.setattr(profiling, 'profile_toggle_refresh', lambda: pytest.fail('прочитан файл флага'))
+    for _ in range(3):
+        assert client.get('/storage_info').status_code == 200
+
+
+def test_header_saves_profile(profiling, client):
+    client.get('/storage_info', headers={'X-Profile': '1'})
+    saved = client.get('/profiles').get_json()['profiles']
+    assert [(p['endpoint'], p['reason']) for p in saved] == [('storage_info', 'header')]
+    assert client.get(f"/profiles/{saved[0]['name']}").status_code == 200
+
+
+def test_toggle_is_shared_through_file(profiling, client):
+    assert client.post('/profiles', json={'enabled': True}).get_json()['all_enabled']
+    assert os.path.exists(os.path.join(profiling.PROFILE_FOLDER, 'enabled'))
+
+    # Другой воркер узнаёт о флаге, перечитав файл при сохранении метрик
+    profiling._profile_all_until = 0.0
+    profiling.profile_toggle_refresh()
+    assert profiling.profile_all_enabled()
+
+    assert not client.post('/profiles', json={'enabled': False}).get_json()['all_enabled']
+    profiling.profile_toggle_refresh()
+    assert not profiling.profile_all_enabled()
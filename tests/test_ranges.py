@@ -0,0 +1,94 @@
+"""Докачка: Range, If-Range и multipart/byteranges у /download, /preview и /thumb"""
+
+import os
+import re
+
+import pytest
+
+
+@pytest.fixture(params=['download', 'preview', 'thumb'])
+def target(request, client, storage, jpeg_bytes):
+    """(URL, ожидаемое содержимое) для каждого способа отдачи файла"""
+    if request.param == 'thumb':
+        storage('Фото/img.jpg', jpeg_bytes())
+        url = '/thumb/Фото/img.jpg'
+        data = client.get(url).data  # Первый запрос рисует миниатюру
+    else:
+        data = os.urandom(50_000)
+        storage('Видео/клип.mp4', data)
+        url = f'/{request.param}/Видео/клип.mp4'
+    assert len(data) > 1000
+    return url, data
+
+
+def byteranges(response):
+    """Части ответа multipart/byteranges: [(Content-Range, тело), ...]"""
+    boundary = re.search(r'boundary=(\S+)', response.headers['Content-Type']).group(1).encode()
+    body = response.data
+    assert body.endswith(b'--' + boundary + b'--\r\n')
+    parts = []
+    for chunk in body.split(b'--' + boundary)[1:-1]:
+        head, _, payload = chunk.partition(b'\r\n\r\n')
+        content_range = re.search(rb'Content-Range: (.+)', head).group(1).decode().strip()
+        assert payload.endswith(b'\r\n')
+        parts.append((content_range, payload[:-2]))
+    return parts
+
+
+def test_single_range(client, target):
+    url, data = target
+    response = client.get(url, headers={'Range': 'bytes=100-199'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes 100-199/{len(data)}'
+    assert response.data == data[100:200]
+
+
+def test_resume_from_offset(client, target):
+    url, data = target
+    full = client.get(url)
+    assert full.headers['Accept-Ranges'] == 'bytes'
+    response = client.get(url, headers={'Range': 'bytes=700-', 'If-Range': full.headers['ETag']})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes 700-{len(data) - 1}/{len(data)}'
+    assert response.data == data[700:]
+
+
+def test_multiple_ranges(client, target):
+    url, data = target
+    size = len(data)
+    response = client.get(url, headers={'Range': 'bytes=0-9,500-599,-20'})
+    assert response.status_code == 206
+    assert response.headers['Content-Type'].startswith('multipart/byteranges; boundary=')
+    assert int(response.headers['Content-Length']) == len(response.data)
+    assert byteranges(response) == [
+        (f'bytes 0-9/{size}', data[:10]),
+        (f'bytes 500-599/{size}', data[500:600]),
+        (f'bytes {size - 20}-{size - 1}/{size}', data[-20:]),
+    ]
+
+
+@pytest.mark.parametrize('ranges', ['bytes=0-9', 'bytes=0-9,500-599'])
+def test_if_range_mismatch_returns_whole_file(client, target, ranges):
+    url, data = target
+    response = client.get(url, headers={'Range': ranges, 'If-Range': '"old-version"'})
+    assert response.status_code == 200
+    assert response.data == data
+
+
+@pytest.mark.parametrize('ranges', ['bytes={size}-', 'bytes={size}-,{over}-'])
+def test_unsatisfiable_range(client, target, ranges):
+    url, data = target
+    response = client.get(url, headers={'Range': ranges.format(size=len(data), over=len(data) + 10)})
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == f'bytes */{len(data)}'
+
+
+def test_too_many_ranges_return_whole_file(cloud, client, target):
+    url, data = target
+    parts = [f'{i * 10}-{i * 10 + 4}' for i in range(cloud.RANGE_MAX_PARTS + 1)]
+    response = client.get(url, headers={'Range': 'bytes=' + ','.join(parts[:-1])})
+    assert response.status_code == 206 and len(byteranges(response)) == cloud.RANGE_MAX_PARTS
+
+    response = client.get(url, headers={'Range': 'bytes=' + ','.join(parts)})
+    assert response.status_code == 200
+    assert response.data == data
@@ -0,0 +1,49 @@
+"""Поиск по индексу имён: limit и offset у /api/search"""
+
+import pytest
+
+
+@pytest.fixture
+def reports(cloud, storage, monkeypatch):
+    """25 файлов и 3 папки с «отчёт» в имени"""
+    monkeypatch.setattr(cloud, 'SEARCH_DEFAULT_LIMIT', 10)
+    monkeypatch.setattr(cloud, 'SEARCH_MAX_LIMIT', 20)
+    for i in range(25):
+        storage(f'Документы/{i // 10}/отчёт-{i:02d}.txt', b'x')
+    for name in ('отчёты-2023', 'отчёты-2024', 'старые отчёты'):
+        storage(f'Архив/{name}/readme.md', b'x')
+    return [f'отчёт-{i:02d}.txt' for i in range(25)]
+
+
+def search(client, **params):
+    response = client.get('/api/search', query_string={'q': 'отчёт', **params})
+    assert response.status_code == 200
+    return [item['name'] for item in response.get_json()], response.headers.get('X-Next-Offset')
+
+
+def test_default_and_max_limit(client, reports):
+    names, next_offset = search(client)
+    assert len(names) == 10 and next_offset == '10'
+    names, next_offset = search(client, limit=1000)
+    assert len(names) == 20 and next_offset == '20'
+
+
+def test_offset_pages_without_gaps_or_duplicates(client, reports):
+    seen, offset = [], '0'
+    while offset is not None:
+        names, offset = search(client, limit=7, offset=offset)
+        seen += names
+    # Сначала папки, потом файлы - каждая ровно один раз
+    assert seen[:3] == ['отчёты-2023', 'отчёты-2024', 'старые отчёты']
+    assert seen[3:] == reports
+
+
+@pytest.mark.parametrize('params', [{'limit': 'abc'}, {'limit': '-5'}, {'limit': '0'},
+                                    {'offset': 'xyz'}, {'offset': '-3'}, {'limit': '1.5', 'offset': ''}])
+def test_invalid_params_fall_back_to_defaults(client, reports, params):
+    assert search(client, **params) == search(client)
+
+
+def test_search_within_folder(client, reports):
+    names, _ = search(client, path='Документы/1', limit=20)
+    assert names == reports[10:20]
@@ -0,0 +1,143 @@
+"""Отдача файлов фронт-сервером (SENDFILE_MODE) и nginx.conf.example"""
+
+import os
+import re
+import shutil
+import socket
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.request
+from urllib.parse import quote
+
+import pytest
+from werkzeug.serving import make_server
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_accel_redirect_for_storage_file(cloud, client, storage, monkeypatch):
+    monkeypatch.setattr(cloud, 'SENDFILE_MODE', 'accel')
+    storage('Документы/отчёт 1.txt', b'hello')
+    response = client.get('/download/Документы/отчёт 1.txt')
+    assert response.status_code == 200
+    assert response.headers['X-Accel-Redirect'] == '/_storage/' + quote('Документы/отчёт 1.txt')
+    assert 'attachment' in response.headers['Content-Disposition']
+    assert response.data == b''
+
+
+def test_accel_redirect_for_thumbnail(cloud, client, storage, jpeg_bytes, monkeypatch):
+    monkeypatch.setattr(cloud, 'SENDFILE_MODE', 'accel')
+    storage('Фото/a.jpg', jpeg_bytes())
+    response = client.get('/thumb/Фото/a.jpg')
+    assert response.status_code == 200
+    name = os.path.basename(cloud.thumbnail_cache_path(cloud.storage_path('Фото/a.jpg'), 200, 'jpeg'))
+    assert response.headers['X-Accel-Redirect'] == '/_thumbs/' + name
+    assert response.headers['ETag'] == f'"{name}"'
+    assert response.data == b''
+
+
+def test_x_sendfile_is_absolute_path(cloud, client, storage, monkeypatch):
+    monkeypatch.setattr(cloud, 'SENDFILE_MODE', 'sendfile')
+    path = storage('Видео/клип.mp4', b'\0' * 100)
+    response = client.get('/preview/Видео/клип.mp4')
+    assert response.status_code == 200
+    # Заголовок передаётся байтами UTF-8 в latin-1
+    sent = response.headers['X-Sendfile'].encode('latin-1').decode('utf-8')
+    assert os.path.isabs(sent) and sent == os.path.abspath(path)
+    assert response.data == b''
+
+
+def test_accel_rejects_paths_outside_storage(cloud, tmp_path):
+    with pytest.raises(ValueError):
+        cloud.accel_redirect_uri(str(tmp_path / 'elsewhere.txt'))
+
+
+# ==================== Интеграция с nginx ====================
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def nginx_config(tmp_path, port, app_port, storage, thumbs):
+    """nginx.conf.example с путями и портами теста"""
+    with open(os.path.join(REPO_DIR, 'nginx.conf.example'), encoding='utf-8') as f:
+        config = f.read()
+    config = config.replace('include mime.types;', '')
+    config = config.replace('listen 8080;', f'listen 127.0.0.1:{port};')
+    config = config.replace('127.0.0.1:3000', f'127.0.0.1:{app_port}')
+    config = re.sub(r'(location /_storage/ \{\s*internal;\s*alias )[^;]+;', rf'\g<1>{storage}/;', config)
+    config = re.sub(r'(location /_thumbs/ \{\s*internal;\s*alias )[^;]+;', rf'\g<1>{thumbs}/;', config)
+    temp = ''.join(f'    {name}_temp_path {tmp_path}/{name};\n'
+                   for name in ('client_body', 'proxy', 'fastcgi', 'uwsgi', 'scgi'))
+    config = config.replace('http {\n', f'http {{\n    access_log off;\n{temp}', 1)
+    head = f'daemon off;\npid {tmp_path}/nginx.pid;\nerror_log {tmp_path}/error.log;\n'
+    if os.geteuid() == 0:
+        head += 'user root root;\n'  # Иначе воркер nobody не прочитает tmp_path
+    return head + config
+
+
+@pytest.fixture
+def nginx(cloud, tmp_path, monkeypatch):
+    binary = shutil.which('nginx')
+    if binary is None:
+        pytest.skip('nginx не установлен')
+    monkeypatch.setattr(cloud, 'SENDFILE_MODE', 'accel')
+    server = make_server('127.0.0.1', 0, cloud.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    port = free_port()
+    conf = tmp_path / 'nginx.conf'
+    conf.write_text(nginx_config(tmp_path, port, server.server_port, cloud.app.config['UPLOAD_FOLDER'],
+                                 cloud.THUMBNAIL_CACHE_FOLDER), encoding='utf-8')
+    process = subprocess.Popen([binary, '-p', str(tmp_path), '-c', str(conf)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    try:
+        deadline = time.time() + 10
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+                break
+            except OSError:
+                if process.poll() is not None or time.time() > deadline:
+                    pytest.fail(f'nginx не запустился: {process.stderr.read().decode(errors="replace")}')
+                time.sleep(0.05)
+        yield f'http://127.0.0.1:{port}'
+    finally:
+        process.terminate()
+        process.wait(10)
+        server.shutdown()
+
+
+def get(url, headers=None):
+    request = urllib.request.Request(url, headers=headers or {})
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return response.status, response.headers, response.read()
+
+
+def test_nginx_serves_accel_redirect(nginx, storage):
+    data = os.urandom(200_000)
+    storage('Видео/клип 1.mp4', data)
+    url = f"{nginx}/download/{quote('Видео/клип 1.mp4')}"
+
+    status, headers, body = get(url)
+    assert status == 200 and body == data
+    assert 'X-Accel-Redirect' not in headers
+
+    status, headers, body = get(url, {'Range': 'bytes=1000-1999'})
+    assert status == 206 and body == data[1000:2000]
+    assert headers['Content-Range'] == f'bytes 1000-1999/{len(data)}'
+
+
+def test_nginx_serves_thumbnail_and_hides_internal_locations(nginx, storage, jpeg_bytes):
+    storage('Фото/a.jpg', jpeg_bytes())
+    status, headers, body = get(f"{nginx}/thumb/{quote('Фото/a.jpg')}")
+    assert status == 200 and body[:2] == b'\xff\xd8'
+
+    # Внутренние локации по прямой ссылке недоступны
+    with pytest.raises(urllib.error.HTTPError) as error:
+        get(f"{nginx}/_storage/{quote('Фото/a.jpg')}")
+    assert error.value.code == 404
@@ -0,0 +1,119 @@
+"""Облегчённые копии видео: ffmpeg заменён заглушкой, проверяются блокировки и неудачи"""
+
+import os
+from collections import deque
+
+import pytest
+
+
+@pytest.fixture
+def ffmpeg(cloud, monkeypatch):
+    """Заглушка _ffmpeg: пишет выходные файлы; calls - вызовы, fail - чем ответить"""
+    monkeypatch.setattr(cloud, 'FFMPEG_AVAILABLE', True)
+    monkeypatch.setattr(cloud, '_transcode_queue', deque())
+    monkeypatch.setattr(cloud, '_transcode_pending', set())
+    monkeypatch.setattr(cloud, '_transcode_failed', {})
+    state = {'calls': [], 'fail': False}
+
+    def fake(args):
+        state['calls'].append(args)
+        if state['fail']:
+            return False
+        output = args[-1]
+        with open(output, 'wb') as f:
+            f.write(b'video')
+        if output.endswith('.m3u8'):
+            with open(os.path.join(os.path.dirname(output), output.rpartition('_')[0] + '_hls.m4s'), 'wb') as f:
+                f.write(b'segments')
+        return True
+    monkeypatch.setattr(cloud, '_ffmpeg', fake)
+    return state
+
+
+@pytest.fixture
+def video(cloud, storage):
+    path = storage('Видео/clip.mov', os.urandom(2000))
+    return path, cloud.file_fingerprint(path)
+
+
+def run_queue(cloud):
+    while cloud._transcode_queue:
+        fp, full_path = cloud._transcode_queue.popleft()
+        cloud.transcode_job(full_path, fp)
+
+
+def test_success(cloud, client, ffmpeg, video):
+    full_path, fp = video
+    assert client.get('/api/transcode/Видео/clip.mov').get_json() == {'status': 'none'}
+    assert client.post('/api/transcode/Видео/clip.mov').get_json() == {'status': 'queued'}
+    run_queue(cloud)
+    assert len(ffmpeg['calls']) == 2  # Копия MP4 и HLS из неё
+    status = client.get('/api/transcode/Видео/clip.mov').get_json()
+    assert status['status'] == 'ready'
+    assert client.get(status['hls']).data == b'video'
+    proxy = cloud.transcode_paths(fp)[0]
+    assert not os.path.exists(proxy + '.lock') and not os.path.exists(proxy + '.tmp')
+    assert not [name for name in os.listdir(cloud.THUMBNAIL_CACHE_FOLDER) if name.endswith('.tmp')]
+
+
+def test_failure_is_retried_after_ttl(cloud, client, ffmpeg, video, monkeypatch):
+    full_path, fp = video
+    ffmpeg['fail'] = True
+    client.post('/api/transcode/Видео/clip.mov')
+    run_queue(cloud)
+    assert client.get('/api/transcode/Видео/clip.mov').get_json() == {'status': 'failed'}
+    assert client.post('/api/transcode/Видео/clip.mov').get_json() == {'status': 'failed'}
+    assert not os.path.exists(cloud.transcode_paths(fp)[0] + '.lock')
+
+    # Через TRANSCODE_RETRY_AFTER видео снова можно поставить в очередь
+    cloud._transcode_failed[fp] -= cloud.TRANSCODE_RETRY_AFTER + 1
+    ffmpeg['fail'] = False
+    assert client.post('/api/transcode/Видео/clip.mov').get_json() == {'status': 'queued'}
+    run_queue(cloud)
+    assert client.get('/api/transcode/Видео/clip.mov').get_json()['status'] == 'ready'
+
+
+def test_stale_lock_is_taken_over(cloud, ffmpeg, video):
+    full_path, fp = video
+    lock_path = cloud.transcode_paths(fp)[0] + '.lock'
+    open(lock_path, 'w').close()
+    # Живая блокировка другого процесса - ничего не делаем
+    assert cloud.transcode_video(full_path, fp) is False and ffmpeg['calls'] == []
+
+    old = os.path.getmtime(lock_path) - cloud.TRANSCODE_TIMEOUT - 1
+    os.utime(lock_path, (old, old))
+    assert cloud.transcode_video(full_path, fp) is True
+    assert len(ffmpeg['calls']) == 2 and not os.path.exists(lock_path)
+
+
+def test_lock_released_between_checks(cloud, ffmpeg, video, monkeypatch):
+    full_path, fp = video
+    lock_path = cloud.transcode_paths(fp)[0] + '.lock'
+    open(lock_path, 'w').close()
+    real_getmtime = os.path.getmtime
+
+    def released(path):
+        # Владелец закончил и снял блокировку сразу после нашей неудачной попытки
+        if path == lock_path:
+            os.remove(lock_path)
+        return real_getmtime(path)
+    monkeypatch.setattr(cloud.os.path, 'getmtime', released)
+    assert cloud.transcode_video(full_path, fp) is True
+    assert len(ffmpeg['calls']) == 2
+
+
+def test_lock_taken_again_by_another_process(cloud, ffmpeg, video, monkeypatch):
+    full_path, fp = video
+    lock_path = cloud.transcode_paths(fp)[0] + '.lock'
+    open(lock_path, 'w').close()
+    stale = os.path.getmtime(lock_path) - cloud.TRANSCODE_TIMEOUT - 1
+    real_remove = os.remove
+
+    def remove_and_relock(path):
+        real_remove(path)
+        if path == lock_path:
+            open(lock_path, 'w').close()  # Другой процесс успел занять блокировку
+    monkeypatch.setattr(cloud.os.path, 'getmtime', lambda path: stale)
+    monkeypatch.setattr(cloud.os, 'remove', remove_and_relock)
+    # Ни бесконечной рекурсии, ни перекодирования параллельно с владельцем
+    assert cloud.transcode_video(full_path, fp) is False and ffmpeg['calls'] == []
@@ -0,0 +1,101 @@
+"""Наблюдение за storage: события watchdog → пачка → индекс, миниатюры и метаданные"""
+
+import os
+from types import SimpleNamespace
+
+import pytest
+
+
+def event(kind, src, dest='', is_directory=False):
+    return SimpleNamespace(event_type=kind, src_path=src, dest_path=dest, is_directory=is_directory)
+
+
+def index_rows(cloud, table, column='path'):
+    return {row[0] for row in cloud.get_index_db().execute(f'SELECT {column} FROM {table}')}
+
+
+@pytest.fixture
+def batches(cloud, monkeypatch):
+    """Функция: отдать события обработчику и применить получившуюся пачку"""
+    monkeypatch.setattr(cloud, 'WATCHER_DEBOUNCE', 0)
+    monkeypatch.setattr(cloud, 'WATCHER_MAX_DELAY', 0)
+    prewarmed = []
+    monkeypatch.setattr(cloud, 'prewarm_thumbnails', prewarmed.append)
+    handler = cloud.StorageEventHandler()
+
+    def apply(*events):
+        for e in events:
+            handler.dispatch(e)
+        batch = cloud._watch_take(0)
+        assert batch is not None
+        cloud.apply_storage_changes(*batch)
+        return prewarmed
+    return apply
+
+
+def test_created_moved_deleted(cloud, client, storage, jpeg_bytes, batches, monkeypatch):
+    photo = storage('Фото/img.jpg', jpeg_bytes())
+    old_note = storage('Фото/old.txt', b'old')
+    assert client.get('/browse/').status_code == 200
+    assert client.get('/thumb/Фото/img.jpg').status_code == 200
+    cloud.media_metadata(photo)
+    thumbs = index_rows(cloud, 'thumbs', 'file')
+    assert thumbs and index_rows(cloud, 'media') == {'Фото/img.jpg'}
+
+    # Изменения в обход приложения
+    os.makedirs(cloud.storage_path('Архив'))
+    moved = cloud.storage_path('Архив/img.jpg')
+    os.rename(photo, moved)
+    new_note = storage('Фото/new.txt', b'new')
+    os.remove(old_note)
+    prewarmed = batches(
+        event('created', cloud.storage_path('Архив'), is_directory=True),
+        event('moved', photo, moved),
+        event('created', new_note),
+        event('modified', new_note),
+        event('deleted', old_note),
+    )
+
+    entries = index_rows(cloud, 'entries')
+    assert {'Архив', 'Архив/img.jpg', 'Фото/new.txt'} <= entries
+    assert not {'Фото/img.jpg', 'Фото/old.txt'} & entries
+    assert index_rows(cloud, 'fingerprints') == {'Архив/img.jpg'}
+    assert index_rows(cloud, 'media') == {'Архив/img.jpg'}
+    assert set(prewarmed) == {moved, new_note}
+
+    # Миниатюра перенесённого файла берётся из кеша, а не рисуется заново
+    assert index_rows(cloud, 'thumbs', 'file') == thumbs
+    monkeypatch.setattr(cloud, 'generate_thumbnail', lambda *args, **kwargs: pytest.fail('миниатюра перерисована'))
+    assert client.get('/thumb/Архив/img.jpg').status_code == 200
+
+
+def test_service_folders_are_ignored(cloud, storage, batches):
+    storage('Фото/img.jpg', b'x')
+    cloud.folder_stats('')
+    handler = cloud.StorageEventHandler()
+    handler.dispatch(event('created', cloud.storage_path(f'{cloud.INGEST_FOLDER}/abc.part')))
+    assert cloud._watch_take(0) is None
+
+
+def test_watcher_thread_starts_only_with_lease(cloud, client, monkeypatch):
+    started = []
+    monkeypatch.setattr(cloud.threading, 'Thread', lambda **kwargs: SimpleNamespace(start=lambda: started.append(kwargs)))
+    monkeypatch.setattr(cloud, '_watcher_pid', None)
+    monkeypatch.setattr(cloud, '_watcher_checked_at', 0)
+    # Роль держит другой живой процесс
+    with cloud.index_transaction() as conn:
+        conn.execute("INSERT INTO index_meta (key, value) VALUES ('storage_watcher', ?)",
+                     (f'{os.getpid() + 1}:{cloud.time.time()}',))
+    client.get('/storage_info')
+    assert started == [] and cloud._watcher_pid is None
+
+    # Владелец перестал продлевать роль, но повторная попытка - только через WATCHER_POLL
+    with cloud.index_transaction() as conn:
+        conn.execute("UPDATE index_meta SET value = ? WHERE key = 'storage_watcher'",
+                     (f'{os.getpid() + 1}:0',))
+    client.get('/storage_info')
+    assert started == []
+    monkeypatch.setattr(cloud, '_watcher_checked_at', 0)
+    client.get('/storage_info')
+    assert [kwargs['name'] for kwargs in started] == ['storage-watcher']
+    assert cloud._watcher_pid == os.getpid()
@@ -0,0 +1,74 @@
+"""Скачивание архивом: /download/<папка> и /download_zip с выбором нескольких путей"""
+
+import io
+import os
+import warnings
+import zipfile
+
+import pytest
+
+
+@pytest.fixture
+def tree(cloud, storage):
+    storage('Фото/a.txt', b'a')
+    storage('Фото/2024/b.txt', b'b' * 1000)
+    storage('Фото/2024/c.jpg', os.urandom(500))
+    os.makedirs(cloud.storage_path('Фото/Пусто'))
+    storage('Документы/d.txt', b'd')
+    storage(f'{cloud.INGEST_FOLDER}/x.part', b'x')
+    return cloud
+
+
+def archive(response):
+    assert response.status_code == 200 and response.mimetype == 'application/zip'
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')  # zipfile предупреждает о повторе имени в архиве
+        data = response.get_data()
+    zf = zipfile.ZipFile(io.BytesIO(data))
+    assert zf.testzip() is None
+    return zf
+
+
+def test_single_folder(client, tree):
+    response = client.get('/download/Фото')
+    assert 'filename*=UTF-8' in response.headers['Content-Disposition']
+    zf = archive(response)
+    assert sorted(zf.namelist()) == ['Фото/2024/b.txt', 'Фото/2024/c.jpg', 'Фото/a.txt', 'Фото/Пусто/']
+    assert zf.read('Фото/2024/b.txt') == b'b' * 1000
+    # Фото уже сжаты - кладутся как есть
+    assert zf.getinfo('Фото/2024/c.jpg').compress_type == zipfile.ZIP_STORED
+    assert zf.getinfo('Фото/2024/b.txt').compress_type == zipfile.ZIP_DEFLATED
+
+
+def test_multi_select(client, tree):
+    zf = archive(client.post('/download_zip', data={'path': ['Фото/a.txt', 'Фото/2024'], 'current_path': 'Фото'}))
+    assert sorted(zf.namelist()) == ['2024/b.txt', '2024/c.jpg', 'a.txt']
+
+    zf = archive(client.post('/download_zip', data={'path': ['Фото/a.txt', 'Документы/d.txt']}))
+    assert sorted(zf.namelist()) == ['Документы/d.txt', 'Фото/a.txt']
+
+
+def test_root_skips_incoming(client, tree):
+    names = archive(client.get('/download_zip', query_string={'path': ''})).namelist()
+    assert 'Документы/d.txt' in names and not [n for n in names if n.startswith(tree.INGEST_FOLDER)]
+
+
+def test_empty_folder(cloud, client):
+    os.makedirs(cloud.storage_path('Пусто/Внутри'))
+    assert archive(client.get('/download/Пусто')).namelist() == ['Пусто/Внутри/']
+
+
+def test_overlapping_selection(client, tree):
+    zf = archive(client.post('/download_zip', data={'path': ['Фото', 'Фото/2024/b.txt', 'Фото/2024', 'Фото']}))
+    names = zf.namelist()
+    assert len(names) == len(set(names))
+    assert sorted(names) == ['Фото/2024/b.txt', 'Фото/2024/c.jpg', 'Фото/a.txt', 'Фото/Пусто/']
+
+
+@pytest.mark.parametrize('path', ['../', '../etc/passwd', 'Фото/../../x', 'Нет такого'])
+def test_bad_paths(client, tree, path):
+    assert client.get('/download_zip', query_string={'path': path}).status_code == 404
+
+
+def test_nothing_selected(client, tree):
+    assert client.post('/download_zip').status_code == 400